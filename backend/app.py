@@ -1,28 +1,59 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, send_file, stream_with_context
+import click
 from flask_cors import CORS
-import mysql.connector
 from datetime import datetime, timedelta
-import re
-import bcrypt
 import jwt
 import os
 import json
+import base64
+import tempfile
+import zipfile
 from functools import wraps
 from dotenv import load_dotenv
 
-# Load environment variables
+# Load environment variables before the local modules below read their settings
 load_dotenv()
 
+from database import (
+    IntegrityError, get_db_connection, get_pool, init_app as init_database,
+    insert_test_result_rows, is_duplicate_key, is_sqlite, like_prefix
+)
+from reference_ranges import classify_many, evaluate_result, parse_numeric_value
+import importers
+from pdf_reports import ReportPdfCache, render_report_pdf, render_report_pdfs, report_cache_key
+from repository import (
+    CATALOG_ENTRY_COLUMNS, PATIENT_COLUMNS, Patient, Report, TestResult, catalog_tree, columns,
+    fetch_report_tests, make_test_result, patient_json, report_json, report_patient_json, test_result_json
+)
+from cache import commit_table_versions, get_table_version, get_table_versions, make_etag, response_cache
+import compression
+import jobs
+import metrics
+import migrations
+import patient_search
+import rollups
+import sequences
+import trends
+from auth import TokenRevoked, profile_cache, token_versions, verify_token
+from passwords import HashingBusy, check_password, hash_password, needs_rehash
+from ratelimit import login_account_limiter, login_ip_limiter
+
 app = Flask(__name__)
+init_database(app)
+# Request timings, query counts and /metrics; see metrics.py
+metrics.init_app(app)
+# gzip/brotli negotiation; registered after metrics so response sizes are
+# recorded as sent, see compression.py
+compression.init_app(app)
 
 # Update CORS configuration
 CORS(app, 
      resources={r"/api/*": {
          "origins": "http://localhost:5173",
          "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-         "allow_headers": ["Content-Type", "Authorization"],
+         "allow_headers": ["Content-Type", "Authorization", "If-None-Match"],
          "supports_credentials": True,
-         "expose_headers": ["Content-Type", "Authorization"]
+         "expose_headers": ["Content-Type", "Authorization", "ETag"]
      }},
      supports_credentials=True)
 
@@ -44,138 +75,35 @@ def token_required(f):
             return jsonify({'error': 'Token is missing'}), 401
         
         try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
+            # Verified tokens are cached; see auth.py
+            payload = verify_token(token, SECRET_KEY)
             # Add user info to request context
             request.user = payload
         except jwt.ExpiredSignatureError:
             return jsonify({'error': 'Token has expired'}), 401
+        except TokenRevoked:
+            return jsonify({'error': 'Token has been revoked'}), 401
         except jwt.InvalidTokenError:
             return jsonify({'error': 'Invalid token'}), 401
         
         return f(*args, **kwargs)
     return decorated
 
-def get_db_connection():
-    # Use environment variables for MySQL credentials
-    DB_HOST = os.getenv('MYSQL_DB_HOST', 'localhost')
-    DB_USER = os.getenv('MYSQL_DB_USER', 'root')
-    DB_PASSWORD = os.getenv('MYSQL_DB_PASSWORD', '')
-    DB_NAME = os.getenv('MYSQL_DB_NAME', 'metacore_db') # Your new database name
-
-    conn = mysql.connector.connect(
-        host=DB_HOST,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        database=DB_NAME
-    )
-    return conn
-
 def init_db():
-    # This function will now ensure tables exist with MySQL syntax, but won't recreate if they exist
-
+    # Schema changes live in migrations.py; this applies any that are pending
     conn = get_db_connection()
-    db_cursor = conn.cursor()
-    
-    # Create patients table if not exists
-    db_cursor.execute('''
-        CREATE TABLE IF NOT EXISTS patients (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            full_name VARCHAR(255) NOT NULL,
-            age INT NOT NULL,
-            gender VARCHAR(50) NOT NULL,
-            contact_number VARCHAR(50) NOT NULL,
-            email VARCHAR(255) NOT NULL,
-            patient_code VARCHAR(255) NOT NULL UNIQUE,
-            address TEXT NOT NULL,
-            ref_by VARCHAR(255),
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    # Create tests table with updated schema
-    db_cursor.execute('''
-        CREATE TABLE IF NOT EXISTS tests (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            patient_id INT NOT NULL,
-            test_category VARCHAR(255) NOT NULL,
-            test_subcategory VARCHAR(255) NOT NULL,
-            test_name VARCHAR(255) NOT NULL,
-            test_value TEXT NOT NULL,
-            normal_range TEXT,
-            unit VARCHAR(50),
-            test_date DATETIME DEFAULT CURRENT_TIMESTAMP,
-            additional_note TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (patient_id) REFERENCES patients (id)
-        )
-    ''')
-
-    # Create lab_info table if not exists (single lab info)
-    db_cursor.execute('''
-        CREATE TABLE IF NOT EXISTS lab_info (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            name VARCHAR(255) NOT NULL,
-            address TEXT NOT NULL,
-            phone VARCHAR(50) NOT NULL,
-            email VARCHAR(255) NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    # Create test_catalog table if not exists
-    db_cursor.execute('''
-        CREATE TABLE IF NOT EXISTS test_catalog (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            name VARCHAR(255) NOT NULL,
-            category VARCHAR(255) NOT NULL,
-            subcategory VARCHAR(255) NOT NULL,
-            price FLOAT,
-            reference_range TEXT,
-            unit VARCHAR(50),
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    # Create ref_doctors table if not exists
-    db_cursor.execute('''
-        CREATE TABLE IF NOT EXISTS ref_doctors (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            name VARCHAR(255) NOT NULL,
-            specialization VARCHAR(255),
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
+    try:
+        migrations.migrate(conn)
+    finally:
+        conn.close()
 
-    # Create reports table if not exists
-    db_cursor.execute('''
-        CREATE TABLE IF NOT EXISTS reports (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            patient_id INT NOT NULL,
-            generated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (patient_id) REFERENCES patients (id)
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
-    
     return False # No longer based on db file existence
 
 def init_user_table():
+    # The users table itself is created by the migrations
     conn = get_db_connection()
     db_cursor = conn.cursor()
     
-    # Create users table if it doesn't exist
-    db_cursor.execute('''CREATE TABLE IF NOT EXISTS users (
-        id INT AUTO_INCREMENT PRIMARY KEY,
-        email VARCHAR(255) UNIQUE NOT NULL,
-        password VARCHAR(255) NOT NULL,
-        full_name VARCHAR(255),
-        phone VARCHAR(50),
-        role VARCHAR(50),
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )''')
-    
     # Check if any users exist
     db_cursor.execute('SELECT COUNT(*) as count FROM users')
     user_count = db_cursor.fetchone()[0] # Access by index for non-Row factory
@@ -187,23 +115,51 @@ def init_user_table():
         admin_password = os.getenv('ADMIN_PASSWORD', 'metacore@admin123')
         
         # Create admin user
-        hashed_password = bcrypt.hashpw(admin_password.encode('utf-8'), bcrypt.gensalt())
+        hashed_password = hash_password(admin_password)
         # Use %s placeholders for MySQL
         db_cursor.execute('INSERT INTO users (email, password, full_name, role) VALUES (%s, %s, %s, %s)', 
-                         (admin_email, hashed_password.decode('utf-8'), 'Admin User', 'admin'))
+                         (admin_email, hashed_password, 'Admin User', 'admin'))
         print(f"Created initial admin user with email: {admin_email}")
     
     conn.commit()
     conn.close()
 
-# Initialize database when the app starts
-was_fresh_init = init_db()
-init_user_table()
+# Apply pending migrations when the app starts. Once the schema is current
+# this is a single lookup in schema_migrations; deployments that run
+# `flask --app app migrate` themselves can turn it off with AUTO_MIGRATE=0.
+if os.getenv('AUTO_MIGRATE', '1') != '0':
+    was_fresh_init = init_db()
+    init_user_table()
+
+def wants_async():
+    # Long-running endpoints queue a background job instead with ?async=true
+    return request.args.get('async', '').lower() in ('1', 'true', 'yes')
+
+def job_accepted(job_id, **extra):
+    return jsonify({'jobId': job_id, 'status': jobs.QUEUED, **extra}), 202
+
+def current_user_id():
+    user = getattr(request, 'user', None)
+    return user.get('user_id') if user else None
+
+@jobs.job_handler('init-db', max_attempts=1, submittable=True)
+def init_db_job(context, payload):
+    init_db()
+    init_user_table()
+    return {'message': 'Database initialized successfully'}
 
 # Add a route to manually trigger database initialization
 @app.route('/api/init-db', methods=['POST'])
 def initialize_database():
     try:
+        if wants_async():
+            conn = get_db_connection()
+            db_cursor = conn.cursor()
+            job_id = jobs.enqueue(db_cursor, 'init-db')
+            conn.commit()
+            conn.close()
+            return job_accepted(job_id)
+
         init_db()
         init_user_table()
         return jsonify({
@@ -213,38 +169,443 @@ def initialize_database():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+def parse_limit(value, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE, name='limit'):
+    if value in (None, ''):
+        return default
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError(f'{name} must be a positive integer')
+    if limit < 1:
+        raise ValueError(f'{name} must be a positive integer')
+    return min(limit, maximum)
+
+def encode_cursor(created_at, row_id):
+    # Opaque keyset cursor over (created_at, id)
+    raw = json.dumps([created_at.strftime('%Y-%m-%d %H:%M:%S'), row_id])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    try:
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S'), int(row_id)
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+def parse_date_param(value, end_of_day=False):
+    try:
+        date = datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise ValueError(f'Invalid date {value!r}, expected YYYY-MM-DD')
+    return date + timedelta(days=1) if end_of_day else date
+
+PATIENT_LIST_PARAMS = ('limit', 'cursor', 'name', 'patientCode', 'contactNumber', 'refBy', 'createdFrom', 'createdTo')
+
+TEST_LIST_PARAMS = ('limit', 'cursor', 'fields', 'patientId', 'category', 'status', 'createdFrom', 'createdTo')
+# Columns GET /api/tests can project with ?fields=; keys keep the column names
+# the unpaged list has always returned
+TEST_LIST_FIELDS = (
+    'id', 'patient_id', 'test_category', 'test_subcategory', 'test_name', 'test_value', 'normal_range', 'unit',
+    'test_date', 'additional_note', 'created_at', 'numeric_value', 'result_status'
+)
+
+def parse_fields(value, allowed):
+    if not value:
+        return list(allowed)
+    fields = list(dict.fromkeys(field.strip() for field in value.split(',') if field.strip()))
+    unknown = [field for field in fields if field not in allowed]
+    if unknown or not fields:
+        raise ValueError(f"Unknown field(s) {', '.join(unknown) or '(none)'}; expected any of {', '.join(allowed)}")
+    return fields
+
+def reclassify_patient_tests(db_cursor, patient_id):
+    # Statuses depend on the patient's sex and age; re-evaluate their results
+    # after either changes, in the caller's transaction. Returns the number of
+    # results updated; the caller bumps 'tests' once it commits
+    db_cursor.execute('''
+        SELECT t.id, t.test_value, t.normal_range, p.gender, p.age
+        FROM tests t
+        JOIN patients p ON p.id = t.patient_id
+        WHERE t.patient_id = %s
+    ''', (patient_id,))
+    rows = db_cursor.fetchall()
+    if not rows:
+        return 0
+    # One patient, so sex and age are the same on every row
+    gender, age = rows[0][3], rows[0][4]
+    statuses = classify_many([(test_value, normal_range) for _, test_value, normal_range, _, _ in rows], gender, age)
+    updates = [
+        (parse_numeric_value(test_value), result_status, test_id)
+        for (test_id, test_value, _, _, _), result_status in zip(rows, statuses)
+    ]
+    if updates:
+        db_cursor.executemany('UPDATE tests SET numeric_value = %s, result_status = %s WHERE id = %s', updates)
+    return len(updates)
+
+def backfill_test_statuses(conn, batch_size=1000, reclassify_all=False, on_progress=None):
+    # Fill tests.numeric_value/result_status in primary-key order, one
+    # transaction per batch, so an interrupted run simply resumes
+    db_cursor = conn.cursor()
+    last_id = 0
+    updated = 0
+    while True:
+        # Walk the table in primary-key order so each batch is an index range scan
+        db_cursor.execute(f'''
+            SELECT t.id, t.test_value, t.normal_range, p.gender, p.age
+            FROM tests t
+            JOIN patients p ON p.id = t.patient_id
+            WHERE t.id > %s {'' if reclassify_all else 'AND t.result_status IS NULL'}
+            ORDER BY t.id
+            LIMIT %s
+        ''', (last_id, batch_size))
+        rows = db_cursor.fetchall()
+        if not rows:
+            break
+
+        updates = []
+        for test_id, test_value, normal_range, gender, age in rows:
+            numeric_value, result_status = evaluate_result(test_value, normal_range, gender, age)
+            updates.append((numeric_value, result_status, test_id))
+        db_cursor.executemany(
+            'UPDATE tests SET numeric_value = %s, result_status = %s WHERE id = %s',
+            updates
+        )
+        conn.commit()
+        commit_table_versions(conn, 'tests')
+
+        last_id = rows[-1][0]
+        updated += len(rows)
+        if on_progress:
+            on_progress(updated, last_id)
+    if reclassify_all and updated:
+        # Cached PDFs print the statuses just rewritten
+        report_pdf_cache.clear()
+    return updated
+
+@app.cli.command('backfill-test-status')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows classified per transaction.')
+@click.option('--all', 'reclassify_all', is_flag=True, help='Reclassify rows that already have a status.')
+def backfill_test_status(batch_size, reclassify_all):
+    """Fill tests.numeric_value/result_status for rows written before they existed."""
+    conn = get_db_connection()
+    try:
+        updated = backfill_test_statuses(
+            conn, batch_size, reclassify_all,
+            on_progress=lambda updated, last_id: click.echo(f'Classified {updated} test results (last id {last_id})')
+        )
+    finally:
+        conn.close()
+    click.echo(f'Done: {updated} test results classified')
+
+@jobs.job_handler('backfill-test-status', submittable=True)
+def backfill_test_status_job(context, payload):
+    conn = get_db_connection()
+    try:
+        updated = backfill_test_statuses(
+            conn,
+            int(payload.get('batchSize', 1000)),
+            bool(payload.get('all')),
+            on_progress=lambda updated, last_id: context.progress(updated, message=f'Last id {last_id}')
+        )
+    finally:
+        conn.close()
+    return {'resultsClassified': updated}
+
+def rebuild_daily_stats(conn, start=None, end=None):
+    # One transaction, so analytics never read a half-rebuilt range
+    db_cursor = conn.cursor()
+    rows = rollups.rebuild(db_cursor, start, end)
+    conn.commit()
+    return rows
+
+@app.cli.command('rebuild-daily-stats')
+@click.option('--from', 'start', default=None, help='First day to rebuild (YYYY-MM-DD); default all history.')
+@click.option('--to', 'end', default=None, help='Last day to rebuild (YYYY-MM-DD), inclusive.')
+def rebuild_daily_stats_command(start, end):
+    """Recompute the daily analytics rollup from tests, patients and reports."""
+    try:
+        start = parse_date_param(start).date() if start else None
+        end = parse_date_param(end, end_of_day=True).date() if end else None
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    conn = get_db_connection()
+    try:
+        rows = rebuild_daily_stats(conn, start, end)
+    finally:
+        conn.close()
+    click.echo(f'Rebuilt daily stats ({rows} rows in total)')
+
+@jobs.job_handler('rebuild-daily-stats', submittable=True)
+def rebuild_daily_stats_job(context, payload):
+    start = parse_date_param(payload['from']).date() if payload.get('from') else None
+    end = parse_date_param(payload['to'], end_of_day=True).date() if payload.get('to') else None
+    conn = get_db_connection()
+    try:
+        rows = rebuild_daily_stats(conn, start, end)
+    finally:
+        conn.close()
+    return {'rows': rows}
+
+@app.cli.command('import-results')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(sorted(importers.PARSERS)), help='Defaults to the file extension.')
+@click.option('--chunk-size', default=importers.DEFAULT_CHUNK_SIZE, show_default=True, help='Records per transaction.')
+@click.option('--notes', default=None, help='Stored as the additional note on every imported result.')
+def import_results_command(path, file_format, chunk_size, notes):
+    """Stream an analyzer CSV or HL7 ORU file into the tests table."""
+    file_format = file_format or importers.detect_format(path)
+    conn = get_db_connection()
+    try:
+        with open(path, 'rb') as raw:
+            stream = importers.open_text(raw, file_format)
+            report = importers.import_results(
+                conn,
+                importers.PARSERS[file_format](stream),
+                chunk_size=chunk_size,
+                notes=notes,
+                on_progress=lambda report: click.echo(
+                    f'{report.records_read} records read, {report.results_inserted} inserted, '
+                    f'{report.records_skipped} skipped'
+                )
+            )
+    finally:
+        conn.close()
+    for error in report.errors:
+        click.echo(f"line {error['line']}: {error['error']}", err=True)
+    click.echo(json.dumps(report.as_dict(), indent=2))
+
+@app.cli.command('migrate')
+@click.option('--target', type=int, default=None, help='Stop after this migration version.')
+@click.option('--status', 'show_status', is_flag=True, help='List migrations and whether they are applied.')
+def migrate_command(target, show_status):
+    """Apply pending schema migrations."""
+    conn = get_db_connection()
+    try:
+        if show_status:
+            for version, name, applied_at in migrations.migration_status(conn.cursor()):
+                click.echo(f"{version:>4}  {'applied ' + str(applied_at) if applied_at else 'pending':<28}  {name}")
+            return
+        applied = migrations.migrate(
+            conn, target=target,
+            on_apply=lambda version, name: click.echo(f'Applied {version}: {name}')
+        )
+    finally:
+        conn.close()
+    click.echo(f'{len(applied)} migration(s) applied' if applied else 'Schema is up to date')
+
+def hot_queries():
+    # (name, sql, params, {table alias: acceptable indexes}); None accepts a
+    # full scan for queries that read the whole table by design
+    queries = (
+        ('generate_report', REPORT_QUERY.format(test_conditions=''), (1,),
+         {'p': ('PRIMARY',), 't': ('idx_tests_patient_report',)}),
+        ('fetch_report_tests', '''
+            SELECT id FROM tests WHERE patient_id IN (%s, %s)
+            ORDER BY patient_id, test_category, test_subcategory, created_at DESC
+        ''', (1, 2), {'tests': ('idx_tests_patient_report',)}),
+        ('get_patients', '''
+            SELECT id, full_name, created_at FROM patients
+            ORDER BY created_at DESC, id DESC LIMIT 51
+        ''', (), {'patients': ('idx_patients_created',)}),
+        ('get_tests', '''
+            SELECT id, test_name, created_at FROM tests
+            ORDER BY created_at DESC, id DESC LIMIT 51
+        ''', (), {'tests': ('idx_tests_created',)}),
+        ('get_tests by patient', '''
+            SELECT id, test_name, created_at FROM tests WHERE patient_id = %s
+            ORDER BY created_at DESC, id DESC LIMIT 51
+        ''', (1,), {'tests': ('idx_tests_patient_created',)}),
+        ('get_patient_trends', '''
+            SELECT id, test_date, numeric_value FROM tests
+            WHERE patient_id = %s AND test_name IN (%s, %s)
+            ORDER BY test_name, test_date, id
+        ''', (1, 'Hemoglobin', 'TSH'), {'tests': ('idx_tests_patient_trend',)}),
+        ('get_patients by code', 'SELECT id FROM patients WHERE patient_code LIKE %s', ('PAT0001%',),
+         {'patients': ('patient_code', 'idx_patients_code')}),
+        ('search_patients by phone', '''
+            SELECT id FROM patients WHERE contact_digits LIKE %s ORDER BY contact_digits LIMIT 200
+        ''', ('01711%',), {'patients': ('idx_patients_contact_digits',)}),
+        ('search_patients by national number', '''
+            SELECT id FROM patients WHERE contact_national LIKE %s ORDER BY contact_national LIMIT 200
+        ''', ('1711%',), {'patients': ('idx_patients_contact_national',)}),
+        ('get_recent_reports', '''
+            SELECT r.*, p.full_name as patient_name
+            FROM reports r
+            JOIN patients p ON r.patient_id = p.id
+            ORDER BY r.generated_at DESC
+            LIMIT 10
+        ''', (), {'r': ('idx_reports_generated',), 'p': ('PRIMARY',)}),
+        ('get_test_categories', '''
+            SELECT id, name, category, subcategory, reference_range, unit, price, analyzer_code
+            FROM test_catalog
+            ORDER BY category, subcategory, name
+        ''', (), {'test_catalog': ('idx_test_catalog_tree', None)}),
+        ('analytics test volume', '''
+            SELECT DATE(test_date), COUNT(*) FROM tests
+            WHERE test_date >= %s AND test_date < %s
+            GROUP BY DATE(test_date)
+        ''', (datetime.now() - timedelta(days=30), datetime.now()),
+         {'tests': ('idx_tests_test_date', 'idx_tests_category_date', 'idx_tests_status_date')}),
+        ('analytics daily stats', '''
+            SELECT test_category, SUM(tests) FROM daily_stats
+            WHERE stat_date >= %s AND stat_date < %s
+            GROUP BY test_category
+        ''', ((datetime.now() - timedelta(days=30)).date(), datetime.now().date()),
+         {'daily_stats': ('PRIMARY',)}),
+        ('login', 'SELECT id, password, token_version FROM users WHERE email = %s', ('admin@metacore.com',),
+         {'users': ('email',)}),
+    )
+    if is_sqlite():
+        queries += (
+            ('search_patients by name', '''
+                SELECT patient_id, field, COUNT(*) FROM patient_trigrams
+                WHERE trigram IN (%s, %s, %s) GROUP BY patient_id, field
+            ''', ('  r', ' ra', 'rah'), {'patient_trigrams': ('PRIMARY',)}),
+        )
+    else:
+        queries += (
+            ('search_patients by name', '''
+                SELECT id FROM patients WHERE MATCH(full_name, address) AGAINST (%s IN BOOLEAN MODE) LIMIT 200
+            ''', ('+"rahman"',), {'patients': ('ft_patients_search',)}),
+        )
+    return queries
+
+@app.cli.command('check-indexes')
+def check_indexes():
+    """EXPLAIN the hot queries and fail if any of them misses its index."""
+    conn = get_db_connection()
+    failures = 0
+    try:
+        dict_cursor = conn.cursor(dictionary=True)
+        for name, sql, params, expected in hot_queries():
+            for alias, ok, detail in migrations.explain_uses_index(dict_cursor, sql, params, expected):
+                failures += not ok
+                click.echo(f"{'ok  ' if ok else 'FAIL'}  {name} [{alias}]: {detail}")
+    finally:
+        conn.close()
+    if failures:
+        raise click.ClickException(f'{failures} table access(es) without the expected index')
+
+@app.cli.command('run-worker')
+@click.option('--concurrency', type=int, default=None, help='Jobs run at once by this process (default JOB_CONCURRENCY or 2).')
+def run_worker(concurrency):
+    """Process queued background jobs until interrupted."""
+    worker = jobs.Worker(app, concurrency=concurrency)
+    click.echo(f'Worker {worker.name} running {worker.concurrency} job(s) at a time')
+    worker.run_forever()
+
 @app.route('/api/patients', methods=['GET'])
 @token_required
 def get_patients():
     try:
+        args = request.args
+        # Without any paging or filter parameters keep returning the plain list
+        # the existing screens expect.
+        paged = any(param in args for param in PATIENT_LIST_PARAMS)
+
+        conditions = []
+        params = []
+        try:
+            limit = parse_limit(args.get('limit'))
+            if args.get('cursor'):
+                cursor_created_at, cursor_id = decode_cursor(args['cursor'])
+                conditions.append('(created_at < %s OR (created_at = %s AND id < %s))')
+                params.extend([cursor_created_at, cursor_created_at, cursor_id])
+            if args.get('name'):
+                conditions.append('full_name LIKE %s')
+                params.append(like_prefix(args['name'].strip()))
+            if args.get('patientCode'):
+                conditions.append('patient_code LIKE %s')
+                params.append(like_prefix(args['patientCode'].strip()))
+            if args.get('contactNumber'):
+                conditions.append('contact_number LIKE %s')
+                params.append(like_prefix(args['contactNumber'].strip()))
+            if args.get('refBy'):
+                conditions.append('ref_by = %s')
+                params.append(args['refBy'])
+            if args.get('createdFrom'):
+                conditions.append('created_at >= %s')
+                params.append(parse_date_param(args['createdFrom']))
+            if args.get('createdTo'):
+                conditions.append('created_at < %s')
+                params.append(parse_date_param(args['createdTo'], end_of_day=True))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        query = f'SELECT {PATIENT_COLUMNS} FROM patients'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY created_at DESC, id DESC'
+        if paged:
+            # Fetch one extra row to know whether another page exists
+            query += ' LIMIT %s'
+            params.append(limit + 1)
+
         conn = get_db_connection()
         db_cursor = conn.cursor()
+        # A client revalidating an unchanged list costs one version lookup
+        etag = table_etag(db_cursor, ('patients',))
+        if request.if_none_match.contains_weak(etag):
+            conn.close()
+            return not_modified(etag)
         
-        # Execute query to get all patients
-        db_cursor.execute('SELECT * FROM patients ORDER BY created_at DESC')
+        db_cursor.execute(query, params)
         patients = db_cursor.fetchall()  
         conn.close()
         
-        # Convert to list of dictionaries
-        patient_list = []
-        # Using db_cursor.column_names to map tuples to dicts for consistency
-        columns = [desc[0] for desc in db_cursor.description]
-        for patient_row in patients:
-            patient_dict = dict(zip(columns, patient_row))
-            patient_list.append({
-                'id': patient_dict['id'],
-                'fullName': patient_dict['full_name'],
-                'age': patient_dict['age'],
-                'gender': patient_dict['gender'],
-                'contactNumber': patient_dict['contact_number'],
-                'email': patient_dict['email'],
-                'patientCode': patient_dict['patient_code'],
-                'address': patient_dict['address'],
-                'refBy': patient_dict['ref_by'] or '',
-                'createdAt': patient_dict['created_at']
-            })
+        # Rows come back in Patient field order, so they serialize as they are
+        patient_list = [patient_json(row) for row in (patients[:limit] if paged else patients)]
         
-        return jsonify(patient_list)
+        if not paged:
+            return revalidated(jsonify(patient_list), etag)
+
+        next_cursor = None
+        if len(patients) > limit:
+            last = Patient._make(patients[limit - 1])
+            next_cursor = encode_cursor(last.created_at, last.id)
+        return revalidated(jsonify({'patients': patient_list, 'nextCursor': next_cursor}), etag)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/patients/search', methods=['GET'])
+@token_required
+def search_patients():
+    try:
+        # ?q= a name or address fragment, phone digits or a patient code;
+        # ranked best first, see patient_search
+        query = (request.args.get('q') or '').strip()
+        if len(query) < patient_search.MIN_QUERY_LENGTH:
+            return jsonify({'error': f'q must be at least {patient_search.MIN_QUERY_LENGTH} characters'}), 400
+        try:
+            limit = parse_limit(request.args.get('limit'), default=patient_search.DEFAULT_LIMIT,
+                                maximum=patient_search.MAX_LIMIT)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        conn = get_db_connection()
+        db_cursor = conn.cursor()
+        matches = patient_search.search(db_cursor, query, limit)
+        rows = {}
+        if matches:
+            placeholders = ', '.join(['%s'] * len(matches))
+            db_cursor.execute(f'SELECT {PATIENT_COLUMNS} FROM patients WHERE id IN ({placeholders})',
+                              [patient_id for patient_id, _, _ in matches])
+            rows = {row[0]: row for row in db_cursor.fetchall()}
+        conn.close()
+
+        results = []
+        for patient_id, score, match in matches:
+            # A patient deleted since the trigram index was built
+            if patient_id not in rows:
+                continue
+            result = patient_json(rows[patient_id])
+            result['score'] = round(score, 4)
+            result['match'] = match
+            results.append(result)
+        return jsonify({'query': query, 'results': results})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -253,8 +614,9 @@ def get_patients():
 def add_patient():
     data = request.json
     
-    # Validate required fields
-    required_fields = ['fullName', 'age', 'gender', 'contactNumber', 'email', 'patientCode', 'address']
+    # Validate required fields; the patient code is assigned here, any code
+    # sent by the client is ignored
+    required_fields = ['fullName', 'age', 'gender', 'contactNumber', 'email', 'address']
     for field in required_fields:
         if field not in data:
             return jsonify({'error': f'Missing required field: {field}'}), 400
@@ -262,26 +624,39 @@ def add_patient():
     try:
         conn = get_db_connection()
         db_cursor = conn.cursor()
+        patient_code = sequences.format_patient_code(sequences.patient_codes.allocate(db_cursor))
         
         # Execute insert query
         db_cursor.execute('''
-            INSERT INTO patients (full_name, age, gender, contact_number, email, patient_code, address, ref_by)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            INSERT INTO patients (
+                full_name, age, gender, contact_number, contact_digits, contact_national, email, patient_code, address, ref_by
+            )
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
         ''', (
             data['fullName'],
             data['age'],
             data['gender'],
             data['contactNumber'],
+            patient_search.normalize_phone(data['contactNumber']),
+            patient_search.national_phone(data['contactNumber']),
             data['email'],
-            data['patientCode'],
+            patient_code,
             data['address'],
             data.get('refBy', '')  # Optional field
         ))
+        patient_id = db_cursor.lastrowid
+        patient_search.index_patients(db_cursor, [(patient_id, data['fullName'], data['address'])])
+        rollups.record_patient(db_cursor, data.get('refBy', ''))
         conn.commit()
+        commit_table_versions(conn, 'patients')
         conn.close()
-        return jsonify({'message': 'Patient added successfully'}), 201
-    except mysql.connector.IntegrityError as e:
-        if "Duplicate entry" in str(e) and "patient_code" in str(e):
+        return jsonify({
+            'message': 'Patient added successfully',
+            'id': patient_id,
+            'patientCode': patient_code
+        }), 201
+    except IntegrityError as e:
+        if is_duplicate_key(e) and "patient_code" in str(e):
             return jsonify({'error': 'Patient code already exists'}), 400
         return jsonify({'error': str(e)}), 500
     except Exception as e:
@@ -302,33 +677,44 @@ def update_patient(patient_id):
         conn = get_db_connection()
         db_cursor = conn.cursor()
         
-        # Check if patient exists
-        db_cursor.execute('SELECT id FROM patients WHERE id = %s', (patient_id,))
-        if not db_cursor.fetchone():
+        # Check if patient exists (locked: a ref doctor change moves their
+        # stats, a sex or age change reclassifies their results)
+        db_cursor.execute('SELECT ref_by, gender, age FROM patients WHERE id = %s FOR UPDATE', (patient_id,))
+        existing = db_cursor.fetchone()
+        if not existing:
             conn.close()
             return jsonify({'error': 'Patient not found'}), 404
         
         # Update patient
         db_cursor.execute('''
             UPDATE patients 
-            SET full_name = %s, age = %s, gender = %s, contact_number = %s, 
-                email = %s, address = %s, ref_by = %s
+            SET full_name = %s, age = %s, gender = %s, contact_number = %s, contact_digits = %s,
+                contact_national = %s, email = %s, address = %s, ref_by = %s
             WHERE id = %s
         ''', (
             data['fullName'],
             data['age'],
             data['gender'],
             data['contactNumber'],
+            patient_search.normalize_phone(data['contactNumber']),
+            patient_search.national_phone(data['contactNumber']),
             data['email'],
             data['address'],
             data.get('refBy', ''),
             patient_id
         ))
+        patient_search.index_patients(db_cursor, [(patient_id, data['fullName'], data['address'])])
+        rollups.move_patient(db_cursor, patient_id, existing[0], data.get('refBy', ''))
+        changed = ('patients',)
+        if (existing[1], str(existing[2])) != (data['gender'], str(data['age'])):
+            if reclassify_patient_tests(db_cursor, patient_id):
+                changed += ('tests',)
         conn.commit()
+        commit_table_versions(conn, *changed)
         conn.close()
         return jsonify({'message': 'Patient updated successfully'}), 200
-    except mysql.connector.IntegrityError as e:
-        if "Duplicate entry" in str(e) and "patient_code" in str(e):
+    except IntegrityError as e:
+        if is_duplicate_key(e) and "patient_code" in str(e):
             return jsonify({'error': 'Patient code already exists'}), 400
         return jsonify({'error': str(e)}), 500
     except Exception as e:
@@ -342,30 +728,156 @@ def delete_patient(patient_id):
         db_cursor = conn.cursor()
         
         # Check if patient exists
-        db_cursor.execute('SELECT id FROM patients WHERE id = %s', (patient_id,))
-        if not db_cursor.fetchone():
+        db_cursor.execute('SELECT ref_by FROM patients WHERE id = %s FOR UPDATE', (patient_id,))
+        existing = db_cursor.fetchone()
+        if not existing:
             conn.close()
             return jsonify({'error': 'Patient not found'}), 404
         
         # Delete patient
+        rollups.remove_patient(db_cursor, patient_id, existing[0])
         db_cursor.execute('DELETE FROM patients WHERE id = %s', (patient_id,))
+        patient_search.unindex_patients(db_cursor, [patient_id])
         conn.commit()
+        commit_table_versions(conn, 'patients')
         conn.close()
         
         return jsonify({'message': 'Patient deleted successfully'}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/patients/<int:patient_id>/trends', methods=['GET'])
+@token_required
+def get_patient_trends(patient_id):
+    try:
+        # ?test=Hemoglobin&test=TSH or ?test=Hemoglobin,TSH, optionally within
+        # ?from=&to= (test dates, inclusive) and thinned to ?maxPoints= per series
+        test_names = list(dict.fromkeys(
+            name.strip() for value in request.args.getlist('test') for name in value.split(',') if name.strip()
+        ))
+        if not test_names:
+            return jsonify({'error': 'At least one test name is required (?test=...)'}), 400
+        if len(test_names) > trends.MAX_TESTS:
+            return jsonify({'error': f'At most {trends.MAX_TESTS} tests per request'}), 400
+
+        conditions = ''
+        params = [patient_id] + test_names
+        try:
+            max_points = parse_limit(request.args.get('maxPoints'), default=trends.DEFAULT_MAX_POINTS,
+                                     maximum=trends.MAX_POINTS, name='maxPoints')
+            if request.args.get('from'):
+                conditions += ' AND test_date >= %s'
+                params.append(parse_date_param(request.args['from']))
+            if request.args.get('to'):
+                conditions += ' AND test_date < %s'
+                params.append(parse_date_param(request.args['to'], end_of_day=True))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        conn = get_db_connection()
+        db_cursor = conn.cursor()
+        db_cursor.execute('SELECT gender, age FROM patients WHERE id = %s', (patient_id,))
+        patient = db_cursor.fetchone()
+        if not patient:
+            conn.close()
+            return jsonify({'error': 'Patient not found'}), 404
+
+        # Read in index order off (patient_id, test_name, test_date)
+        placeholders = ', '.join(['%s'] * len(test_names))
+        db_cursor.execute(f'''
+            SELECT {trends.TREND_COLUMNS}
+            FROM tests
+            WHERE patient_id = %s AND test_name IN ({placeholders}){conditions}
+            ORDER BY test_name, test_date, id
+        ''', params)
+        rows = db_cursor.fetchall()
+        conn.close()
+
+        return jsonify({
+            'patientId': patient_id,
+            'series': trends.trend_series(rows, test_names, patient[0], patient[1], max_points)
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/tests', methods=['GET'])
 @token_required
 def get_tests():
     try:
+        args = request.args
+        # Without any paging, filter or projection parameters keep returning
+        # the full list the existing screens expect.
+        if not any(param in args for param in TEST_LIST_PARAMS):
+            conn = get_db_connection()
+            etag = table_etag(conn.cursor(), ('tests',))
+            if request.if_none_match.contains_weak(etag):
+                conn.close()
+                return not_modified(etag)
+            db_cursor = conn.cursor(dictionary=True) # Fetch as dictionary
+            db_cursor.execute('SELECT * FROM tests ORDER BY created_at DESC')
+            tests = db_cursor.fetchall()
+            conn.close()
+            return revalidated(jsonify(tests), etag)
+
+        conditions = []
+        params = []
+        try:
+            limit = parse_limit(args.get('limit'))
+            fields = parse_fields(args.get('fields'), TEST_LIST_FIELDS)
+            if args.get('cursor'):
+                cursor_created_at, cursor_id = decode_cursor(args['cursor'])
+                conditions.append('(created_at < %s OR (created_at = %s AND id < %s))')
+                params.extend([cursor_created_at, cursor_created_at, cursor_id])
+            if args.get('patientId'):
+                if not args['patientId'].isdigit():
+                    raise ValueError('patientId must be an integer')
+                conditions.append('patient_id = %s')
+                params.append(int(args['patientId']))
+            if args.get('category'):
+                conditions.append('test_category = %s')
+                params.append(args['category'])
+            if args.get('status'):
+                # Rows recorded before statuses were persisted only match once
+                # backfill-test-status has classified them
+                conditions.append('result_status = %s')
+                params.append(args['status'])
+            if args.get('createdFrom'):
+                conditions.append('created_at >= %s')
+                params.append(parse_date_param(args['createdFrom']))
+            if args.get('createdTo'):
+                conditions.append('created_at < %s')
+                params.append(parse_date_param(args['createdTo'], end_of_day=True))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        # The cursor needs created_at and id even when they are not projected;
+        # zip() below stops at the requested fields
+        selected = fields + [column for column in ('created_at', 'id') if column not in fields]
+        query = f"SELECT {', '.join(selected)} FROM tests"
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        # Fetch one extra row to know whether another page exists
+        query += ' ORDER BY created_at DESC, id DESC LIMIT %s'
+        params.append(limit + 1)
+
         conn = get_db_connection()
-        db_cursor = conn.cursor(dictionary=True) # Fetch as dictionary
-        db_cursor.execute('SELECT * FROM tests ORDER BY created_at DESC')
-        tests = db_cursor.fetchall()
+        db_cursor = conn.cursor()
+        etag = table_etag(db_cursor, ('tests',))
+        if request.if_none_match.contains_weak(etag):
+            conn.close()
+            return not_modified(etag)
+        db_cursor.execute(query, params)
+        rows = db_cursor.fetchall()
         conn.close()
-        return jsonify(tests)
+
+        next_cursor = None
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            next_cursor = encode_cursor(last[selected.index('created_at')], last[selected.index('id')])
+        return revalidated(jsonify({
+            'tests': [dict(zip(fields, row)) for row in rows[:limit]],
+            'nextCursor': next_cursor
+        }), etag)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -383,77 +895,283 @@ def add_test():
         db_cursor = conn.cursor()
         
         db_cursor.execute('''
-            INSERT INTO test_catalog (name, category, subcategory, reference_range, unit, price)
-            VALUES (%s, %s, %s, %s, %s, %s)
+            INSERT INTO test_catalog (name, category, subcategory, reference_range, unit, price, analyzer_code)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
         ''', (
             data['name'],
             data['category'],
             data['subcategory'],
             data.get('referenceRange'),  # Optional
             data.get('unit'),  # Optional
-            data.get('price')  # Optional
+            data.get('price'),  # Optional
+            data.get('analyzerCode')  # Optional
         ))
-        
         conn.commit()
+        commit_table_versions(conn, 'test_catalog')
+        response_cache.invalidate('test_categories')
         conn.close()
         return jsonify({'message': 'Test added successfully'}), 201
-    except mysql.connector.IntegrityError as e:
-        if "Duplicate entry" in str(e) and "name" in str(e) and "category" in str(e) and "subcategory" in str(e):
+    except IntegrityError as e:
+        if is_duplicate_key(e) and "name" in str(e) and "category" in str(e) and "subcategory" in str(e):
             return jsonify({'error': 'Test with this name, category, and subcategory already exists'}), 400
         return jsonify({'error': str(e)}), 500
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def validate_test_panel(panel):
+    if not isinstance(panel, dict):
+        return 'Panel must be an object'
+    for field in ['patientId', 'category', 'subcategory', 'tests']:
+        if field not in panel:
+            return f'Missing required field: {field}'
+    try:
+        int(panel['patientId'])
+    except (TypeError, ValueError):
+        return 'patientId must be an integer'
+    if not isinstance(panel['tests'], list) or not panel['tests']:
+        return 'tests must be a non-empty list'
+    for position, test in enumerate(panel['tests']):
+        if not isinstance(test, dict) or 'testName' not in test or 'value' not in test:
+            return f'tests[{position}] must include testName and value'
+    if panel.get('testDate'):
+        try:
+            importers.parse_result_date(str(panel['testDate']))
+        except ValueError as e:
+            return f'testDate: {e}'
+    return None
+
+def build_test_result_rows(db_cursor, panels):
+    # panels is a list of (index, panel) pairs that passed validate_test_panel.
+    # Patients and catalog ranges for the whole batch are fetched with one query
+    # each, then every result is classified in memory.
+    patient_ids = sorted({int(panel['patientId']) for _, panel in panels})
+    placeholders = ', '.join(['%s'] * len(patient_ids))
+    db_cursor.execute(f'SELECT id, gender, age FROM patients WHERE id IN ({placeholders})', patient_ids)
+    patients = {row[0]: (row[1], row[2]) for row in db_cursor.fetchall()}
+
+    groups = sorted({(panel['category'], panel['subcategory']) for _, panel in panels})
+    group_conditions = ' OR '.join(['(category = %s AND subcategory = %s)'] * len(groups))
+    db_cursor.execute(f'''
+        SELECT category, subcategory, name, reference_range, price FROM test_catalog
+        WHERE {group_conditions}
+    ''', [value for group in groups for value in group])
+    catalog_ranges = {}
+    catalog_prices = {}
+    for category, subcategory, name, reference_range, price in db_cursor.fetchall():
+        key = (category, subcategory, name)
+        catalog_ranges[key] = reference_range
+        # Each result keeps the price it was billed at (the highest, should
+        # the catalog list a test twice); daily_stats revenue sums it
+        if price is not None:
+            catalog_prices[key] = max(price, catalog_prices.get(key, price))
+
+    rows = []
+    inserted_panels = []
+    errors = []
+    default_test_date = datetime.now().replace(microsecond=0)
+    for index, panel in panels:
+        patient_id = int(panel['patientId'])
+        if patient_id not in patients:
+            errors.append({'index': index, 'error': 'Patient not found'})
+            continue
+        gender, age = patients[patient_id]
+        # Parsed rather than passed through, so date-only values are stored
+        # as midnight on SQLite too and compare correctly against ranges
+        test_date = importers.parse_result_date(str(panel.get('testDate') or '')) or default_test_date
+        for test in panel['tests']:
+            normal_range = test.get('normalRange') or catalog_ranges.get(
+                (panel['category'], panel['subcategory'], test['testName'])
+            )
+            numeric_value, result_status = evaluate_result(test['value'], normal_range, gender, age)
+            rows.append((
+                patient_id,
+                panel['category'],
+                panel['subcategory'],
+                test['testName'],
+                test['value'],
+                normal_range,
+                test.get('unit'),
+                test_date,
+                panel.get('notes'),
+                numeric_value,
+                result_status,
+                catalog_prices.get((panel['category'], panel['subcategory'], test['testName']))
+            ))
+        inserted_panels.append(index)
+    return rows, inserted_panels, errors
+
 @app.route('/api/test-results', methods=['POST'])
 @token_required
 def add_test_results():
     try:
         data = request.json
-        required_fields = ['patientId', 'category', 'subcategory', 'tests']
-        for field in required_fields:
-            if field not in data:
-                return jsonify({'error': f'Missing required field: {field}'}), 400
+        if not data:
+            return jsonify({'error': 'No data provided'}), 400
 
-        conn = get_db_connection()
+        # A body with "panels" is a batch upload covering any number of
+        # patients/panels; otherwise it is the single panel the UI posts.
+        bulk = 'panels' in data
+        panels = data['panels'] if bulk else [data]
+        if bulk and (not isinstance(panels, list) or not panels):
+            return jsonify({'error': 'panels must be a non-empty list'}), 400
+
+        valid_panels = []
+        errors = []
+        for index, panel in enumerate(panels):
+            error = validate_test_panel(panel)
+            if error:
+                if not bulk:
+                    return jsonify({'error': error}), 400
+                errors.append({'index': index, 'error': error})
+            else:
+                valid_panels.append((index, panel))
+
+        if wants_async():
+            if not valid_panels:
+                return jsonify({'error': 'No valid panels', 'errors': errors}), 400
+            conn = get_db_connection()
+            db_cursor = conn.cursor()
+            job_id = jobs.enqueue(db_cursor, 'test-results', {
+                'panels': valid_panels,
+                'errors': errors
+            }, created_by=current_user_id())
+            conn.commit()
+            conn.close()
+            return job_accepted(job_id, errors=errors)
+
+        rows = []
+        inserted_panels = []
+        if valid_panels:
+            conn = get_db_connection()
+            db_cursor = conn.cursor()
+
+            rows, inserted_panels, lookup_errors = build_test_result_rows(db_cursor, valid_panels)
+            if lookup_errors and not bulk:
+                conn.close()
+                return jsonify({'error': lookup_errors[0]['error']}), 404
+            errors.extend(lookup_errors)
+
+            # All valid panels land in one transaction
+            insert_test_result_rows(db_cursor, rows)
+            rollups.record_test_results(db_cursor, rows)
+            conn.commit()
+            commit_table_versions(conn, 'tests')
+            conn.close()
+
+        if not bulk:
+            return jsonify({'message': 'Test results added successfully'}), 201
+
+        errors.sort(key=lambda error: error['index'])
+        return jsonify({
+            'message': 'Test results added successfully' if not errors else 'Some panels were rejected',
+            'panelsInserted': len(inserted_panels),
+            'resultsInserted': len(rows),
+            'errors': errors
+        }), 201 if inserted_panels else 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@jobs.job_handler('test-results')
+def add_test_results_job(context, payload):
+    conn = get_db_connection()
+    try:
         db_cursor = conn.cursor()
-        
-        # Get test date from request or use current timestamp
-        test_date = data.get('testDate', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-        
-        # Insert each test result
-        for test in data['tests']:
-            db_cursor.execute('''
-                INSERT INTO tests (
-                    patient_id, 
-                    test_category, 
-                    test_subcategory,
-                    test_name, 
-                    test_value, 
-                    normal_range, 
-                    unit, 
-                    test_date,
-                    additional_note
-                )
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ''', (
-                data['patientId'],
-                data['category'],
-                data['subcategory'],
-                test['testName'],
-                test['value'],
-                test.get('normalRange'),
-                test.get('unit'),
-                test_date,
-                data.get('notes')
-            ))
-        
+        rows, inserted_panels, errors = build_test_result_rows(
+            db_cursor, [(index, panel) for index, panel in payload['panels']]
+        )
+        context.progress(0, total=len(rows), message='Inserting results', force=True)
+        insert_test_result_rows(db_cursor, rows)
+        rollups.record_test_results(db_cursor, rows)
+        # Nothing is committed until here, so a cancel or retry leaves no rows behind
+        context.check_cancelled()
         conn.commit()
+        commit_table_versions(conn, 'tests')
+    finally:
         conn.close()
-        
-        return jsonify({'message': 'Test results added successfully'}), 201
+    context.progress(len(rows), force=True)
+
+    errors = sorted(payload.get('errors', []) + errors, key=lambda error: error['index'])
+    return {
+        'panelsInserted': len(inserted_panels),
+        'resultsInserted': len(rows),
+        'errors': errors
+    }
+
+@app.route('/api/test-results/import', methods=['POST'])
+@token_required
+def import_test_results():
+    try:
+        upload = request.files.get('file')
+        if not upload:
+            return jsonify({'error': 'Missing file upload'}), 400
+
+        file_format = request.form.get('format') or importers.detect_format(upload.filename)
+        if file_format not in importers.PARSERS:
+            return jsonify({'error': f'Unsupported format: {file_format}'}), 400
+        try:
+            chunk_size = parse_limit(request.form.get('chunkSize'), default=importers.DEFAULT_CHUNK_SIZE, maximum=5000)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        if wants_async():
+            # The upload outlives this request, so it is kept in the job spool
+            path = jobs.spool_path('import', f'.{file_format}')
+            upload.save(path)
+            conn = get_db_connection()
+            db_cursor = conn.cursor()
+            job_id = jobs.enqueue(db_cursor, 'import-results', {
+                'path': path,
+                'format': file_format,
+                'chunkSize': chunk_size,
+                'notes': request.form.get('notes'),
+                'spoolFiles': [path]
+            }, created_by=current_user_id())
+            conn.commit()
+            conn.close()
+            return job_accepted(job_id)
+
+        # Werkzeug spools large uploads to a temporary file; reading it through
+        # a text wrapper keeps only the current chunk in memory.
+        stream = importers.open_text(upload.stream, file_format)
+        conn = get_db_connection()
+        try:
+            report = importers.import_results(
+                conn,
+                importers.PARSERS[file_format](stream),
+                chunk_size=chunk_size,
+                notes=request.form.get('notes')
+            )
+        except importers.ImportFormatError as e:
+            conn.close()
+            return jsonify({'error': str(e)}), 400
+        conn.close()
+
+        return jsonify(report.as_dict()), 201 if report.results_inserted else 400
     except Exception as e:
+        print(f"Error importing test results: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+# Imports commit chunk by chunk, so a failed run is not retried automatically
+@jobs.job_handler('import-results', max_attempts=1)
+def import_results_job(context, payload):
+    conn = get_db_connection()
+    try:
+        with open(payload['path'], 'rb') as raw:
+            stream = importers.open_text(raw, payload['format'])
+            report = importers.import_results(
+                conn,
+                importers.PARSERS[payload['format']](stream),
+                chunk_size=payload['chunkSize'],
+                notes=payload.get('notes'),
+                on_progress=lambda report: context.progress(
+                    report.records_read,
+                    message=f'{report.results_inserted} inserted, {report.records_skipped} skipped'
+                )
+            )
+    finally:
+        conn.close()
+    return report.as_dict()
+
 @app.route('/api/tests/<int:test_id>', methods=['PUT'])
 @token_required
 def update_test(test_id):
@@ -478,7 +1196,8 @@ def update_test(test_id):
         # Update test
         db_cursor.execute('''
             UPDATE test_catalog 
-            SET name = %s, category = %s, subcategory = %s, reference_range = %s, unit = %s, price = %s
+            SET name = %s, category = %s, subcategory = %s, reference_range = %s, unit = %s, price = %s,
+                analyzer_code = %s
             WHERE id = %s
         ''', (
             data['name'],
@@ -487,14 +1206,16 @@ def update_test(test_id):
             data.get('referenceRange'),  # Optional
             data.get('unit'),  # Optional
             data.get('price'),  # Optional
+            data.get('analyzerCode'),  # Optional
             test_id
         ))
-        
         conn.commit()
+        commit_table_versions(conn, 'test_catalog')
+        response_cache.invalidate('test_categories')
         conn.close()
         return jsonify({'message': 'Test updated successfully'}), 200
-    except mysql.connector.IntegrityError as e:
-        if "Duplicate entry" in str(e) and "name" in str(e) and "category" in str(e) and "subcategory" in str(e):
+    except IntegrityError as e:
+        if is_duplicate_key(e) and "name" in str(e) and "category" in str(e) and "subcategory" in str(e):
             return jsonify({'error': 'Test with this name, category, and subcategory already exists'}), 400
         return jsonify({'error': str(e)}), 500
     except Exception as e:
@@ -516,6 +1237,8 @@ def delete_test(test_id):
         # Delete test
         db_cursor.execute('DELETE FROM test_catalog WHERE id = %s', (test_id,))
         conn.commit()
+        commit_table_versions(conn, 'test_catalog')
+        response_cache.invalidate('test_categories')
         conn.close()
         return jsonify({'message': 'Test deleted successfully'}), 200
     except Exception as e:
@@ -558,105 +1281,356 @@ def add_lab():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# A Patient followed by a TestResult per row (the test half is NULL when the
+# patient has no matching results)
+REPORT_QUERY = f'''
+    SELECT {columns(Patient, 'p')},
+           {columns(TestResult, 't')}
+    FROM patients p
+    LEFT JOIN tests t ON t.patient_id = p.id {{test_conditions}}
+    WHERE p.id = %s
+    ORDER BY t.test_category, t.test_subcategory, t.created_at DESC
+'''
+REPORT_TEST_OFFSET = len(Patient._fields)
+
 @app.route('/api/reports/<int:patient_id>', methods=['GET'])
 @token_required
 def generate_report(patient_id):
     try:
+        # Optional restriction to a date range (?from=&to=) or the most recent
+        # visit day (?latest=true); conditions sit in the JOIN so the patient
+        # row still comes back when no tests match.
+        test_conditions = ''
+        params = []
+        try:
+            if request.args.get('latest', '').lower() in ('1', 'true', 'yes'):
+                test_conditions += ''' AND t.test_date >= (
+                    SELECT DATE(MAX(latest.test_date)) FROM tests latest WHERE latest.patient_id = %s
+                )'''
+                params.append(patient_id)
+            if request.args.get('from'):
+                test_conditions += ' AND t.test_date >= %s'
+                params.append(parse_date_param(request.args['from']))
+            if request.args.get('to'):
+                test_conditions += ' AND t.test_date < %s'
+                params.append(parse_date_param(request.args['to'], end_of_day=True))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        params.append(patient_id)
+
         conn = get_db_connection()
-        db_cursor = conn.cursor() # Fetch as tuples by default
-        
-        # Get patient information
-        db_cursor.execute('SELECT * FROM patients WHERE id = %s', (patient_id,))
-        patient_row = db_cursor.fetchone()
+        # Unbuffered: rows are pulled from the server as the response is written
+        db_cursor = conn.cursor(buffered=False)
+        # The report is the patient row plus their results
+        etag = table_etag(db_cursor, ('patients', 'tests'))
+        if request.if_none_match.contains_weak(etag):
+            conn.close()
+            return not_modified(etag)
+        db_cursor.execute(REPORT_QUERY.format(test_conditions=test_conditions), params)
+        first_row = db_cursor.fetchone()
         
-        if not patient_row:
+        if not first_row:
+            conn.close()
             return jsonify({'error': 'Patient not found'}), 404
 
-        # Convert patient row to dictionary for easier access
-        patient_columns = [desc[0] for desc in db_cursor.description]
-        patient = dict(zip(patient_columns, patient_row))
-        
-        # Get all tests for the patient
-        db_cursor.execute('''
-            SELECT * FROM tests 
-            WHERE patient_id = %s 
-            ORDER BY test_category, test_subcategory, created_at DESC
-        ''', (patient_id,))
-        tests_rows = db_cursor.fetchall()
-        
+        patient = Patient._make(first_row[:REPORT_TEST_OFFSET])
+        header = json.dumps(report_patient_json(patient))
+
+        def generate():
+            try:
+                # Splice the tests array into the patient object as rows arrive
+                yield header[:-1] + ', "tests": ['
+                row = first_row
+                separator = ''
+                while row is not None:
+                    if row[REPORT_TEST_OFFSET] is not None:
+                        test = make_test_result(row[REPORT_TEST_OFFSET:], patient.gender, patient.age)
+                        yield separator + json.dumps(test_result_json(test))
+                        separator = ', '
+                    row = db_cursor.fetchone()
+                yield ']}'
+            except Exception as e:
+                print(f"Error streaming report: {str(e)}")
+                raise
+            finally:
+                conn.close()
+
+        return revalidated(app.response_class(stream_with_context(generate()), mimetype='application/json'), etag)
+    except Exception as e:
+        print(f"Error generating report: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+report_pdf_cache = ReportPdfCache(
+    os.getenv('REPORT_CACHE_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'report_cache')
+)
+
+REPORT_PDF_HEADER_QUERY = f'''
+    SELECT {columns(Patient, 'p')},
+           l.name, l.address, l.phone, l.email,
+           (SELECT COUNT(*) FROM tests t WHERE t.patient_id = p.id) AS test_count,
+           (SELECT MAX(t.id) FROM tests t WHERE t.patient_id = p.id) AS latest_test_id
+    FROM patients p
+    LEFT JOIN lab_info l ON l.id = 1
+    WHERE p.id IN ({{placeholders}})
+'''
+
+def fetch_report_headers(db_cursor, patient_ids):
+    # Patient details, lab header and the (count, max id) revision of each
+    # patient's results, for any number of patients in one query
+    placeholders = ', '.join(['%s'] * len(patient_ids))
+    db_cursor.execute(REPORT_PDF_HEADER_QUERY.format(placeholders=placeholders), list(patient_ids))
+    headers = {}
+    fields = len(Patient._fields)
+    for row in db_cursor.fetchall():
+        patient = Patient._make(row[:fields])
+        lab_name, lab_address, lab_phone, lab_email, test_count, latest_test_id = row[fields:]
+        lab = {'name': lab_name, 'address': lab_address, 'phone': lab_phone, 'email': lab_email}
+        headers[patient.id] = (patient, lab, report_cache_key(lab, patient, test_count, latest_test_id))
+    return headers
+
+@app.route('/api/reports/<int:patient_id>/pdf', methods=['GET'])
+@token_required
+def download_report_pdf(patient_id):
+    try:
+        conn = get_db_connection()
+        db_cursor = conn.cursor()
+
+        headers = fetch_report_headers(db_cursor, [patient_id])
+        if patient_id not in headers:
+            conn.close()
+            return jsonify({'error': 'Patient not found'}), 404
+        patient, lab, cache_key = headers[patient_id]
+
+        # The browser already has this exact PDF
+        if request.if_none_match.contains_weak(cache_key):
+            conn.close()
+            return not_modified(cache_key)
+
+        # Render only when nothing on the page has changed since the last download
+        path = report_pdf_cache.get(patient_id, cache_key)
+        if not path:
+            tests = fetch_report_tests(db_cursor, {patient_id: patient})[patient_id]
+            path = report_pdf_cache.put(patient_id, cache_key, render_report_pdf(lab, patient, tests))
+
+        response = send_file(
+            path,
+            mimetype='application/pdf',
+            as_attachment=request.args.get('download', '').lower() in ('1', 'true', 'yes'),
+            download_name=f'{patient.patient_code}.pdf',
+            etag=cache_key,
+            conditional=True
+        )
+
+        # Downloading the PDF is what issuing a report means, so track it
+        # here; revalidations (304) and range requests (206) are not new reports
+        if response.status_code == 200 and request.args.get('track', 'true').lower() not in ('0', 'false', 'no'):
+            db_cursor.execute('INSERT INTO reports (patient_id) VALUES (%s)', (patient_id,))
+            rollups.record_reports(db_cursor, [patient_id])
+            conn.commit()
         conn.close()
-        
-        # Convert tests to list of dictionaries and calculate status
-        test_list = []
-        test_columns = [desc[0] for desc in db_cursor.description]
+        return response
+    except Exception as e:
+        print(f"Error rendering report PDF: {str(e)}")
+        return jsonify({'error': str(e)}), 500
 
-        for test_row in tests_rows:
-            test = dict(zip(test_columns, test_row))
-            
-            # Calculate status
-            value = test['test_value']
-            ref_range = str(test['normal_range'])
-            status = 'Normal'
-            
-            # parse reference range (e.g., '32–36', 'M: 13–16; F: 11.5–14.5', '<1.1', 'Up to 60')
-            ref = ref_range.replace('–', '-').replace(' ', '')
-            match = re.match(r'^(\d+(?:\.\d+)?)-(\d+(?:\.\d+)?)$', ref)
-            if match:
-                low, high = float(match.group(1)), float(match.group(2))
-                if float(value) < low:
-                    status = 'Low'
-                elif float(value) > high:
-                    status = 'High'
-            elif ref.startswith('<'):
-                try:
-                    high = float(ref[1:])
-                    if float(value) >= high:
-                        status = 'High'
-                except:
-                    pass
-            elif ref.lower().startswith('upto') or ref.lower().startswith('up to'):
-                try:
-                    high = float(re.findall(r'\d+(?:\.\d+)?', ref)[0])
-                    if float(value) > high:
-                        status = 'High'
-                except:
-                    pass
-            elif ref.lower() == 'positive':
-                if str(value).lower() != 'positive':
-                    status = 'Abnormal' # Or some other specific status
-            elif ref.lower() == 'negative':
-                if str(value).lower() != 'negative':
-                    status = 'Abnormal' # Or some other specific status
-
-            test_list.append({
-                'id': test['id'],
-                'testCategory': test['test_category'],
-                'testSubcategory': test['test_subcategory'],
-                'testName': test['test_name'],
-                'testValue': value,
-                'normalRange': test['normal_range'],
-                'unit': test['unit'],
-                'additionalNote': test['additional_note'],
-                'createdAt': test['created_at'].strftime('%Y-%m-%d %H:%M:%S') if test['created_at'] else None, # Format datetime objects
-                'status': status
-            })
-        
-        # Create report object
-        report = {
-            'patientName': patient['full_name'],
-            'patientCode': patient['patient_code'],
-            'patientAge': patient['age'],
-            'patientGender': patient['gender'],
-            'contactNumber': patient['contact_number'],
-            'refBy': patient['ref_by'],
-            'tests': test_list
-        }
-        
-        return jsonify(report)
+MAX_BATCH_REPORTS = 500
+
+def prepare_report_renders(db_cursor, headers, patient_ids):
+    # (patient_id, render args) for every report not already in the PDF cache
+    to_render = [patient_id for patient_id in patient_ids
+                 if not report_pdf_cache.get(patient_id, headers[patient_id][2])]
+    if not to_render:
+        return []
+    tests = fetch_report_tests(db_cursor, {patient_id: headers[patient_id][0] for patient_id in to_render})
+    return [(patient_id, (headers[patient_id][1], headers[patient_id][0], tests[patient_id]))
+            for patient_id in to_render]
+
+def write_report_archive(archive, headers, found, missing, renders):
+    contents = render_report_pdfs([render for _, render in renders])
+    for (patient_id, _), content in zip(renders, contents):
+        report_pdf_cache.put(patient_id, headers[patient_id][2], content)
+
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as bundle:
+        for patient_id in found:
+            patient, _, cache_key = headers[patient_id]
+            bundle.write(report_pdf_cache.path(patient_id, cache_key), f'{patient.patient_code}.pdf')
+        if missing:
+            bundle.writestr('missing-patients.txt', '\n'.join(str(patient_id) for patient_id in missing))
+
+@jobs.job_handler('report-batch')
+def report_batch_job(context, payload):
+    found = payload['patientIds']
+    missing = payload.get('missingPatientIds', [])
+    context.progress(0, total=len(found), message='Loading reports', force=True)
+    conn = get_db_connection()
+    try:
+        db_cursor = conn.cursor()
+        headers = fetch_report_headers(db_cursor, found) if found else {}
+        # Patients deleted since the job was queued
+        missing = missing + [patient_id for patient_id in found if patient_id not in headers]
+        found = [patient_id for patient_id in found if patient_id in headers]
+        renders = prepare_report_renders(db_cursor, headers, found)
+    finally:
+        conn.close()
+
+    context.progress(0, message=f'Rendering {len(renders)} PDFs', force=True)
+    path = jobs.spool_path('reports', '.zip')
+    with open(path, 'wb') as archive:
+        write_report_archive(archive, headers, found, missing, renders)
+    context.check_cancelled()
+
+    # Tracked only once the archive exists, so a retried job counts each report once
+    if payload.get('track', True) and found:
+        conn = get_db_connection()
+        try:
+            db_cursor = conn.cursor()
+            db_cursor.executemany('INSERT INTO reports (patient_id) VALUES (%s)', [(patient_id,) for patient_id in found])
+            rollups.record_reports(db_cursor, found)
+            conn.commit()
+        finally:
+            conn.close()
+    context.progress(len(found), force=True)
+    return {
+        'file': os.path.basename(path),
+        'fileName': payload.get('fileName', 'reports.zip'),
+        'reports': len(found),
+        'missingPatientIds': missing
+    }
+
+@app.route('/api/reports/batch', methods=['POST'])
+@token_required
+def generate_reports_batch():
+    try:
+        data = request.get_json() or {}
+        output_format = data.get('format', 'json')
+        if output_format not in ('json', 'zip'):
+            return jsonify({'error': 'format must be json or zip'}), 400
+
+        conn = get_db_connection()
+        db_cursor = conn.cursor()
+
+        # Either an explicit list of patients or everyone with results on a day
+        if data.get('date'):
+            try:
+                day_start = parse_date_param(data['date'])
+            except ValueError as e:
+                conn.close()
+                return jsonify({'error': str(e)}), 400
+            db_cursor.execute('''
+                SELECT DISTINCT patient_id FROM tests
+                WHERE test_date >= %s AND test_date < %s
+                ORDER BY patient_id
+            ''', (day_start, day_start + timedelta(days=1)))
+            patient_ids = [row[0] for row in db_cursor.fetchall()]
+        elif isinstance(data.get('patientIds'), list) and data['patientIds']:
+            try:
+                patient_ids = list(dict.fromkeys(int(patient_id) for patient_id in data['patientIds']))
+            except (TypeError, ValueError):
+                conn.close()
+                return jsonify({'error': 'patientIds must be integers'}), 400
+        else:
+            conn.close()
+            return jsonify({'error': 'Provide patientIds or date'}), 400
+
+        if len(patient_ids) > MAX_BATCH_REPORTS:
+            conn.close()
+            return jsonify({'error': f'At most {MAX_BATCH_REPORTS} reports per batch'}), 400
+        if not patient_ids:
+            conn.close()
+            if output_format == 'zip':
+                return jsonify({'error': 'No patients with results on that date'}), 404
+            return jsonify({'reports': [], 'missingPatientIds': []})
+
+        headers = fetch_report_headers(db_cursor, patient_ids)
+        missing = [patient_id for patient_id in patient_ids if patient_id not in headers]
+        found = [patient_id for patient_id in patient_ids if patient_id in headers]
+
+        if output_format == 'json':
+            tests = fetch_report_tests(db_cursor, {patient_id: headers[patient_id][0] for patient_id in found}) if found else {}
+            reports = [report_json(Report(headers[patient_id][0], tests[patient_id])) for patient_id in found]
+            if data.get('track') and found:
+                db_cursor.executemany('INSERT INTO reports (patient_id) VALUES (%s)', [(patient_id,) for patient_id in found])
+                rollups.record_reports(db_cursor, found)
+                conn.commit()
+            conn.close()
+            return jsonify({'reports': reports, 'missingPatientIds': missing})
+
+        name = f"reports-{data['date']}.zip" if data.get('date') else 'reports.zip'
+        track = data.get('track', True)
+        if wants_async():
+            job_id = jobs.enqueue(db_cursor, 'report-batch', {
+                'patientIds': found,
+                'missingPatientIds': missing,
+                'fileName': name,
+                'track': track
+            }, created_by=current_user_id())
+            conn.commit()
+            conn.close()
+            return job_accepted(job_id, missingPatientIds=missing)
+
+        # ZIP of PDFs: reuse cached renders and render the rest in one pass
+        renders = prepare_report_renders(db_cursor, headers, found)
+        conn.close()
+
+        archive = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+        write_report_archive(archive, headers, found, missing, renders)
+        archive.seek(0)
+
+        # Tracked only once the archive exists, as in report_batch_job
+        if track and found:
+            conn = get_db_connection()
+            try:
+                db_cursor = conn.cursor()
+                db_cursor.executemany('INSERT INTO reports (patient_id) VALUES (%s)', [(patient_id,) for patient_id in found])
+                rollups.record_reports(db_cursor, found)
+                conn.commit()
+            finally:
+                conn.close()
+        return send_file(archive, mimetype='application/zip', as_attachment=True, download_name=name)
     except Exception as e:
-        print(f"Error generating report: {str(e)}")
+        print(f"Error generating batch reports: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+def issue_token(user_id, email, token_version):
+    payload = {
+        'user_id': user_id,
+        'email': email,
+        'ver': token_version,
+        'exp': datetime.utcnow() + timedelta(days=1)
+    }
+    return jwt.encode(payload, SECRET_KEY, algorithm='HS256')
+
+def revoke_user_tokens(db_cursor, user_id):
+    # Invalidates every token issued so far for the user; call before commit
+    db_cursor.execute('UPDATE users SET token_version = token_version + 1 WHERE id = %s', (user_id,))
+    db_cursor.execute('SELECT token_version FROM users WHERE id = %s', (user_id,))
+    return db_cursor.fetchone()[0]
+
+def too_many_attempts(retry_after):
+    response = jsonify({'error': 'Too many attempts, please try again later'})
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 429
+
+def hashing_busy(e):
+    response = jsonify({'error': str(e)})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+def account_limit_key(email):
+    return f"account:{(email or '').strip().lower()}"
+
+def verify_current_password(email, password, hashed):
+    # Current-password checks on credential changes share the per-account
+    # failure limit with login (same key). Returns an error response or None.
+    limit_key = account_limit_key(email)
+    retry_after = login_account_limiter.retry_after(limit_key)
+    if retry_after:
+        return too_many_attempts(retry_after)
+    if not hashed or not check_password(password, hashed):
+        login_account_limiter.hit(limit_key)
+        return jsonify({'error': 'Current password is incorrect'}), 401
+    return None
+
 @app.route('/api/login', methods=['POST', 'OPTIONS'])
 def login():
     if request.method == 'OPTIONS':
@@ -672,28 +1646,47 @@ def login():
         
         if not email or not password:
             return jsonify({'error': 'Missing email or password'}), 400
+
+        # Every attempt from an address counts; only failures count against
+        # the account, so a locked-out attacker cannot lock out the owner for long
+        ip_key = f'ip:{request.remote_addr}'
+        account_key = account_limit_key(email)
+        retry_after = max(login_ip_limiter.retry_after(ip_key), login_account_limiter.retry_after(account_key))
+        if retry_after:
+            return too_many_attempts(retry_after)
+        login_ip_limiter.hit(ip_key)
         
         conn = get_db_connection()
         db_cursor = conn.cursor()
-        db_cursor.execute('SELECT id, password FROM users WHERE email = %s', (email,))
+        db_cursor.execute('SELECT id, password, token_version FROM users WHERE email = %s', (email,))
         user = db_cursor.fetchone()
         conn.close()
         
         if not user:
+            login_account_limiter.hit(account_key)
             return jsonify({'error': 'Invalid email address'}), 401
             
         # user[1] is the hashed password from the database
-        if not bcrypt.checkpw(password.encode('utf-8'), user[1].encode('utf-8')):
+        if not check_password(password, user[1]):
+            login_account_limiter.hit(account_key)
             return jsonify({'error': 'Invalid password'}), 401
+        login_account_limiter.reset(account_key)
+
+        # Hashes made with a lower cost than BCRYPT_ROUNDS are upgraded while
+        # the plain password is at hand
+        if needs_rehash(user[1]):
+            conn = get_db_connection()
+            db_cursor = conn.cursor()
+            db_cursor.execute('UPDATE users SET password = %s WHERE id = %s AND password = %s',
+                              (hash_password(password), user[0], user[1]))
+            conn.commit()
+            conn.close()
             
-        payload = {
-            'user_id': user[0],
-            'email': email,
-            'exp': datetime.utcnow() + timedelta(days=1)
-        }
-        token = jwt.encode(payload, SECRET_KEY, algorithm='HS256')
+        token = issue_token(user[0], email, user[2])
         return jsonify({'token': token, 'email': email})
             
+    except HashingBusy as e:
+        return hashing_busy(e)
     except Exception as e:
         print(f"Login error: {str(e)}")  # Add logging
         return jsonify({'error': 'Internal server error'}), 500
@@ -717,22 +1710,35 @@ def update_admin_credentials():
         db_cursor = conn.cursor()
         
         # Verify current password
-        db_cursor.execute('SELECT password FROM users WHERE email = %s', (request.user['email'],))
+        db_cursor.execute('SELECT id, password FROM users WHERE email = %s', (request.user['email'],))
         user = db_cursor.fetchone()
         
-        if not user or not bcrypt.checkpw(current_password.encode('utf-8'), user[0].encode('utf-8')):
+        if not user:
             conn.close()
             return jsonify({'error': 'Current password is incorrect'}), 401
+        error = verify_current_password(request.user['email'], current_password, user[1])
+        if error:
+            conn.close()
+            return error
             
         # Update credentials
-        hashed_password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
-        db_cursor.execute('UPDATE users SET email = %s, password = %s WHERE email = %s',
-                         (new_email, hashed_password.decode('utf-8'), request.user['email']))
+        hashed_password = hash_password(new_password)
+        db_cursor.execute('UPDATE users SET email = %s, password = %s WHERE id = %s',
+                         (new_email, hashed_password, user[0]))
+        token_version = revoke_user_tokens(db_cursor, user[0])
         conn.commit()
         conn.close()
+        token_versions.set(user[0], token_version)
+        profile_cache.invalidate(user[0])
         
-        return jsonify({'message': 'Credentials updated successfully'})
+        # Existing sessions are signed out; this one continues with a new token
+        return jsonify({
+            'message': 'Credentials updated successfully',
+            'token': issue_token(user[0], new_email, token_version)
+        })
         
+    except HashingBusy as e:
+        return hashing_busy(e)
     except Exception as e:
         print(f"Update credentials error: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
@@ -753,6 +1759,7 @@ def track_report():
             INSERT INTO reports (patient_id)
             VALUES (%s)
         ''', (data['patientId'],))
+        rollups.record_reports(db_cursor, [data['patientId']])
         
         conn.commit()
         conn.close()
@@ -872,11 +1879,15 @@ def update_lab_info():
 def get_ref_doctors():
     try:
         conn = get_db_connection()
+        etag = table_etag(conn.cursor(), ('ref_doctors',))
+        if request.if_none_match.contains_weak(etag):
+            conn.close()
+            return not_modified(etag)
         db_cursor = conn.cursor(dictionary=True) # Fetch as dictionary
         db_cursor.execute('SELECT * FROM ref_doctors ORDER BY name ASC')
         doctors = db_cursor.fetchall()
         conn.close()
-        return jsonify(doctors)
+        return revalidated(jsonify(doctors), etag)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -894,12 +1905,12 @@ def add_ref_doctor():
             INSERT INTO ref_doctors (name, specialization)
             VALUES (%s, %s)
         ''', (data['name'], data.get('specialization')))
-        
         conn.commit()
+        commit_table_versions(conn, 'ref_doctors')
         conn.close()
         return jsonify({'message': 'Reference doctor added successfully'}), 201
-    except mysql.connector.IntegrityError as e:
-        if "Duplicate entry" in str(e) and "name" in str(e):
+    except IntegrityError as e:
+        if is_duplicate_key(e) and "name" in str(e):
             return jsonify({'error': 'Reference doctor with this name already exists'}), 400
         return jsonify({'error': str(e)}), 500
     except Exception as e:
@@ -927,12 +1938,12 @@ def update_ref_doctor(doctor_id):
             SET name = %s, specialization = %s
             WHERE id = %s
         ''', (data['name'], data.get('specialization'), doctor_id))
-        
         conn.commit()
+        commit_table_versions(conn, 'ref_doctors')
         conn.close()
         return jsonify({'message': 'Reference doctor updated successfully'}), 200
-    except mysql.connector.IntegrityError as e:
-        if "Duplicate entry" in str(e) and "name" in str(e):
+    except IntegrityError as e:
+        if is_duplicate_key(e) and "name" in str(e):
             return jsonify({'error': 'Reference doctor with this name already exists'}), 400
         return jsonify({'error': str(e)}), 500
     except Exception as e:
@@ -953,68 +1964,60 @@ def delete_ref_doctor(doctor_id):
         
         db_cursor.execute('DELETE FROM ref_doctors WHERE id = %s', (doctor_id,))
         conn.commit()
+        commit_table_versions(conn, 'ref_doctors')
         conn.close()
         return jsonify({'message': 'Reference doctor deleted successfully'}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def table_etag(db_cursor, tables):
+    # Derived from the versions of the tables a response reads (every write
+    # to them bumps one) and the request's path and query, so it can be
+    # checked before any row is fetched or serialized
+    versions = get_table_versions(db_cursor, tables)
+    key = repr((request.path, sorted(request.args.items(multi=True)), tables, versions))
+    return make_etag(key.encode('utf-8'))
+
+def revalidated(response, etag):
+    # Clients may keep the response but must revalidate it before reuse
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def not_modified(etag):
+    return revalidated(app.response_class(status=304), etag)
+
+def cached_json_response(entry):
+    # Serve a pre-serialized body, or 304 when the client already has it.
+    # Weak comparison: compressed responses carry the weak form of the tag
+    if request.if_none_match.contains_weak(entry.etag):
+        return not_modified(entry.etag)
+    return revalidated(app.response_class(entry.body, mimetype='application/json'), entry.etag)
+
 @app.route('/api/tests/categories', methods=['GET'])
 @token_required
 def get_test_categories():
     try:
         conn = get_db_connection()
-        db_cursor = conn.cursor(dictionary=True) # Fetch as dictionary
+        db_cursor = conn.cursor()
 
-        # Get all tests without grouping or JSON functions
-        db_cursor.execute('''
-            SELECT id, name, category, subcategory, reference_range, unit, price
+        # The catalog changes rarely; the tree is rebuilt only when its version moves
+        version = get_table_version(db_cursor, 'test_catalog')
+        cached = response_cache.get('test_categories', version)
+        if cached:
+            conn.close()
+            return cached_json_response(cached)
+
+        db_cursor.execute(f'''
+            SELECT {CATALOG_ENTRY_COLUMNS}
             FROM test_catalog
+            ORDER BY category, subcategory, name
         ''')
-
         all_tests = db_cursor.fetchall()
         conn.close()
 
-        # Group by category first, then subcategory in Python
-        result = {}
-        for test in all_tests:
-            category = test['category']
-            subcategory = test['subcategory']
-
-            if category not in result:
-                result[category] = {
-                    'category': category,
-                    'subcategories': []
-                }
-
-            # Find existing subcategory or create a new one
-            found_subcategory = None
-            for sub_item in result[category]['subcategories']:
-                if sub_item['subcategory'] == subcategory:
-                    found_subcategory = sub_item
-                    break
-            
-            if not found_subcategory:
-                found_subcategory = {
-                    'subcategory': subcategory,
-                    'tests': []
-                }
-                result[category]['subcategories'].append(found_subcategory)
-            
-            found_subcategory['tests'].append({
-                'id': test['id'],
-                'name': test['name'],
-                'referenceRange': test['reference_range'],
-                'unit': test['unit'],
-                'price': test['price']
-            })
-        
-        # Sort subcategories and tests for consistent order
-        for category_data in result.values():
-            category_data['subcategories'].sort(key=lambda x: x['subcategory'])
-            for subcategory_data in category_data['subcategories']:
-                subcategory_data['tests'].sort(key=lambda x: x['name'])
-
-        return jsonify(list(result.values()))
+        body = json.dumps(catalog_tree(all_tests)).encode('utf-8')
+        return cached_json_response(response_cache.put('test_categories', version, body))
     except Exception as e:
         print(f"Error fetching test categories: {str(e)}") # Add logging for debugging
         return jsonify({'error': str(e)}), 500
@@ -1022,26 +2025,15 @@ def get_test_categories():
 @app.route('/api/patients/latest-code', methods=['GET'])
 @token_required
 def get_latest_patient_code():
+    # Preview only: the code is assigned when the patient is saved, so a
+    # concurrent registration may take this one first
     try:
         conn = get_db_connection()
         db_cursor = conn.cursor()
-        db_cursor.execute('SELECT patient_code FROM patients ORDER BY id DESC LIMIT 1')
-        latest_code_row = db_cursor.fetchone()
+        next_value = sequences.peek(db_cursor, 'patient_code')
         conn.close()
 
-        if latest_code_row and latest_code_row[0]:
-            latest_code = latest_code_row[0]
-            # Extract number, increment, and format to PAT000001
-            match = re.match(r'PAT(\d+)', latest_code)
-            if match:
-                num = int(match.group(1))
-                new_num = num + 1
-                new_code = f'PAT{new_num:06d}' # Format as PAT000001, PAT000002, etc.
-            else:
-                new_code = 'PAT000001' # Fallback if format is unexpected
-        else:
-            new_code = 'PAT000001' # First patient
-
+        new_code = sequences.format_patient_code(next_value or 1)
         return jsonify({'code': new_code})
     except Exception as e:
         print(f"Error fetching latest patient code: {str(e)}") # Add logging for debugging
@@ -1061,8 +2053,10 @@ def delete_test_result(test_id):
             return jsonify({'error': 'Test result not found'}), 404
         
         # Delete test result
+        rollups.remove_test_result(db_cursor, test_id)
         db_cursor.execute('DELETE FROM tests WHERE id = %s', (test_id,))
         conn.commit()
+        commit_table_versions(conn, 'tests')
         conn.close()
         return jsonify({'message': 'Test result deleted successfully'}), 200
     except Exception as e:
@@ -1072,22 +2066,29 @@ def delete_test_result(test_id):
 @token_required
 def get_profile():
     try:
+        user_id = request.user['user_id']
+        profile = profile_cache.get(user_id)
+        if profile is not None:
+            return jsonify(profile)
+
         conn = get_db_connection()
         db_cursor = conn.cursor(dictionary=True) # Fetch as dictionary
         
         # Get user profile from database using user_id from token
         db_cursor.execute('SELECT email, full_name, phone, role FROM users WHERE id = %s', 
-                           (request.user['user_id'],))
+                           (user_id,))
         user = db_cursor.fetchone()
         conn.close()
         
         if user:
-            return jsonify({
+            profile = {
                 'email': user['email'],
                 'fullName': user['full_name'],
                 'phone': user['phone'],
                 'role': user['role']
-            })
+            }
+            profile_cache.put(user_id, profile)
+            return jsonify(profile)
         return jsonify({'error': 'User profile not found'}), 404
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -1112,6 +2113,7 @@ def update_profile():
         ))
         conn.commit()
         conn.close()
+        profile_cache.invalidate(request.user['user_id'])
         return jsonify({'message': 'Profile updated successfully'}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -1131,12 +2133,14 @@ def change_email():
         db_cursor = conn.cursor()
         
         # Verify current password
-        db_cursor.execute('SELECT password FROM users WHERE id = %s', (request.user['user_id'],))
+        db_cursor.execute('SELECT password, email FROM users WHERE id = %s', (request.user['user_id'],))
         user = db_cursor.fetchone()
         
-        if not user or not bcrypt.checkpw(current_password.encode('utf-8'), user[0].encode('utf-8')):
+        error = verify_current_password(user[1] if user else request.user['email'], current_password,
+                                        user[0] if user else None)
+        if error:
             conn.close()
-            return jsonify({'error': 'Current password is incorrect'}), 401
+            return error
             
         # Check if new email already exists
         db_cursor.execute('SELECT id FROM users WHERE email = %s', (new_email,))
@@ -1144,12 +2148,21 @@ def change_email():
             conn.close()
             return jsonify({'error': 'Email already in use'}), 400
             
-        # Update email
+        # Update email; tokens carrying the old address are revoked
+        user_id = request.user['user_id']
         db_cursor.execute('UPDATE users SET email = %s WHERE id = %s',
-                          (new_email, request.user['user_id']))
+                          (new_email, user_id))
+        token_version = revoke_user_tokens(db_cursor, user_id)
         conn.commit()
         conn.close()
-        return jsonify({'message': 'Email updated successfully'}), 200
+        token_versions.set(user_id, token_version)
+        profile_cache.invalidate(user_id)
+        return jsonify({
+            'message': 'Email updated successfully',
+            'token': issue_token(user_id, new_email, token_version)
+        }), 200
+    except HashingBusy as e:
+        return hashing_busy(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -1168,20 +2181,462 @@ def change_password():
         db_cursor = conn.cursor()
         
         # Verify current password
-        db_cursor.execute('SELECT password FROM users WHERE id = %s', (request.user['user_id'],))
+        db_cursor.execute('SELECT password, email FROM users WHERE id = %s', (request.user['user_id'],))
         user = db_cursor.fetchone()
         
-        if not user or not bcrypt.checkpw(current_password.encode('utf-8'), user[0].encode('utf-8')):
+        error = verify_current_password(user[1] if user else request.user['email'], current_password,
+                                        user[0] if user else None)
+        if error:
             conn.close()
-            return jsonify({'error': 'Current password is incorrect'}), 401
+            return error
             
-        # Update password
-        hashed_password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
+        # Update password and sign out every other session
+        user_id = request.user['user_id']
+        hashed_password = hash_password(new_password)
         db_cursor.execute('UPDATE users SET password = %s WHERE id = %s',
-                          (hashed_password.decode('utf-8'), request.user['user_id']))
+                          (hashed_password, user_id))
+        token_version = revoke_user_tokens(db_cursor, user_id)
+        conn.commit()
+        conn.close()
+        token_versions.set(user_id, token_version)
+        profile_cache.invalidate(user_id)
+        return jsonify({
+            'message': 'Password updated successfully',
+            'token': issue_token(user_id, request.user['email'], token_version)
+        }), 200
+    except HashingBusy as e:
+        return hashing_busy(e)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def parse_window(args, default_days=30):
+    # Analytics window from ?from=YYYY-MM-DD&to=YYYY-MM-DD, both inclusive
+    if args.get('to'):
+        window_end = parse_date_param(args['to'], end_of_day=True)
+    else:
+        window_end = datetime.combine(datetime.now().date(), datetime.min.time()) + timedelta(days=1)
+    if args.get('from'):
+        window_start = parse_date_param(args['from'])
+    else:
+        window_start = window_end - timedelta(days=default_days)
+    if window_start >= window_end:
+        raise ValueError('from must not be after to')
+    return window_start, window_end
+
+def window_json(window_start, window_end):
+    return {
+        'from': window_start.strftime('%Y-%m-%d'),
+        'to': (window_end - timedelta(days=1)).strftime('%Y-%m-%d')
+    }
+
+@app.route('/api/analytics/summary', methods=['GET'])
+@token_required
+def get_analytics_summary():
+    try:
+        try:
+            window_start, window_end = parse_window(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        today = datetime.combine(datetime.now().date(), datetime.min.time())
+        # Weeks start on Sunday, matching the dashboard
+        week_start = today - timedelta(days=(today.weekday() + 1) % 7)
+        month_start = today.replace(day=1)
+
+        # Counts come from the daily rollup; only the abnormal count, which
+        # depends on result statuses, is read from tests
+        first_day, last_day = window_start.date(), window_end.date()
+        conn = get_db_connection()
+        db_cursor = conn.cursor(dictionary=True)
+        db_cursor.execute('''
+            SELECT
+                COALESCE(SUM(patients), 0) AS total_patients,
+                COALESCE(SUM(CASE WHEN stat_date >= %s AND stat_date < %s THEN patients END), 0) AS window_patients,
+                COALESCE(SUM(CASE WHEN stat_date >= %s THEN patients END), 0) AS month_patients,
+                COALESCE(SUM(tests), 0) AS total_tests,
+                COALESCE(SUM(CASE WHEN stat_date >= %s AND stat_date < %s THEN tests END), 0) AS window_tests,
+                COALESCE(SUM(CASE WHEN stat_date >= %s THEN tests END), 0) AS today_tests,
+                COALESCE(SUM(CASE WHEN stat_date >= %s THEN tests END), 0) AS week_tests,
+                (SELECT COUNT(*) FROM tests
+                 WHERE result_status IN ('Low', 'High', 'Abnormal') AND test_date >= %s AND test_date < %s) AS window_abnormal,
+                COALESCE(SUM(reports), 0) AS total_reports,
+                COALESCE(SUM(CASE WHEN stat_date >= %s AND stat_date < %s THEN reports END), 0) AS window_reports,
+                COALESCE(SUM(CASE WHEN stat_date >= %s AND stat_date < %s THEN revenue END), 0) AS window_revenue
+            FROM daily_stats
+        ''', (
+            first_day, last_day,
+            month_start.date(),
+            first_day, last_day,
+            today.date(),
+            week_start.date(),
+            window_start, window_end,
+            first_day, last_day,
+            first_day, last_day
+        ))
+        row = db_cursor.fetchone()
+        conn.close()
+
+        return jsonify({
+            'window': window_json(window_start, window_end),
+            'totalPatients': int(row['total_patients']),
+            'patientsInWindow': int(row['window_patients']),
+            'thisMonthPatients': int(row['month_patients']),
+            'totalTests': int(row['total_tests']),
+            'testsInWindow': int(row['window_tests']),
+            'testsToday': int(row['today_tests']),
+            'testsThisWeek': int(row['week_tests']),
+            'abnormalResultsInWindow': row['window_abnormal'],
+            'reportsGenerated': int(row['total_reports']),
+            'reportsInWindow': int(row['window_reports']),
+            'revenueInWindow': float(row['window_revenue'])
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/analytics/tests/volume', methods=['GET'])
+@token_required
+def get_analytics_test_volume():
+    try:
+        try:
+            window_start, window_end = parse_window(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        interval = request.args.get('interval', 'day')
+        bucket_formats = {'day': '%Y-%m-%d', 'month': '%Y-%m'}
+        if interval not in bucket_formats:
+            return jsonify({'error': 'interval must be day or month'}), 400
+
+        conn = get_db_connection()
+        db_cursor = conn.cursor(dictionary=True)
+        db_cursor.execute('''
+            SELECT DATE_FORMAT(stat_date, %s) AS bucket, test_category,
+                   SUM(tests) AS count, SUM(revenue) AS revenue
+            FROM daily_stats
+            WHERE stat_date >= %s AND stat_date < %s AND test_category <> ''
+            GROUP BY bucket, test_category
+            HAVING SUM(tests) > 0
+            ORDER BY bucket, test_category
+        ''', (bucket_formats[interval], window_start.date(), window_end.date()))
+        rows = db_cursor.fetchall()
+        conn.close()
+
+        buckets = {}
+        for row in rows:
+            bucket = buckets.setdefault(row['bucket'], {'period': row['bucket'], 'count': 0, 'revenue': 0.0, 'categories': {}})
+            bucket['count'] += int(row['count'])
+            bucket['revenue'] += float(row['revenue'])
+            bucket['categories'][row['test_category']] = int(row['count'])
+
+        return jsonify({
+            'window': window_json(window_start, window_end),
+            'interval': interval,
+            'series': list(buckets.values())
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/analytics/tests/by-category', methods=['GET'])
+@token_required
+def get_analytics_tests_by_category():
+    try:
+        try:
+            window_start, window_end = parse_window(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        conn = get_db_connection()
+        db_cursor = conn.cursor(dictionary=True)
+        db_cursor.execute('''
+            SELECT test_category, test_subcategory, COUNT(*) AS count
+            FROM tests
+            WHERE test_date >= %s AND test_date < %s
+            GROUP BY test_category, test_subcategory
+            ORDER BY test_category, test_subcategory
+        ''', (window_start, window_end))
+        rows = db_cursor.fetchall()
+        conn.close()
+
+        categories = {}
+        for row in rows:
+            category = categories.setdefault(row['test_category'], {
+                'category': row['test_category'],
+                'count': 0,
+                'subcategories': []
+            })
+            category['count'] += row['count']
+            category['subcategories'].append({'subcategory': row['test_subcategory'], 'count': row['count']})
+
+        return jsonify({
+            'window': window_json(window_start, window_end),
+            'categories': list(categories.values())
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/analytics/patients/demographics', methods=['GET'])
+@token_required
+def get_analytics_demographics():
+    try:
+        # Without a window the breakdown covers every registered patient
+        conditions = ''
+        params = ()
+        if request.args.get('from') or request.args.get('to'):
+            try:
+                window_start, window_end = parse_window(request.args)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            conditions = 'WHERE created_at >= %s AND created_at < %s'
+            params = (window_start, window_end)
+
+        conn = get_db_connection()
+        db_cursor = conn.cursor(dictionary=True)
+        db_cursor.execute(f'''
+            SELECT
+                CASE LOWER(gender) WHEN 'male' THEN 'male' WHEN 'female' THEN 'female' ELSE 'other' END AS gender_group,
+                CASE
+                    WHEN age < 18 THEN '0-17 years'
+                    WHEN age < 30 THEN '18-29 years'
+                    WHEN age < 45 THEN '30-44 years'
+                    WHEN age < 60 THEN '45-59 years'
+                    ELSE '60+ years'
+                END AS age_group,
+                COUNT(*) AS count
+            FROM patients
+            {conditions}
+            GROUP BY gender_group, age_group
+        ''', params)
+        rows = db_cursor.fetchall()
+        conn.close()
+
+        gender_counts = {'male': 0, 'female': 0, 'other': 0}
+        age_groups = {label: 0 for label in ('0-17 years', '18-29 years', '30-44 years', '45-59 years', '60+ years')}
+        for row in rows:
+            gender_counts[row['gender_group']] += row['count']
+            age_groups[row['age_group']] += row['count']
+
+        return jsonify({
+            'genderCounts': gender_counts,
+            'ageGroups': [{'label': label, 'count': count} for label, count in age_groups.items()]
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/analytics/ref-doctors', methods=['GET'])
+@token_required
+def get_analytics_ref_doctors():
+    try:
+        try:
+            window_start, window_end = parse_window(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        conn = get_db_connection()
+        db_cursor = conn.cursor(dictionary=True)
+        db_cursor.execute('''
+            SELECT COALESCE(NULLIF(ref_by, ''), 'Self') AS ref_by,
+                   SUM(patients) AS patients, SUM(tests) AS tests, SUM(reports) AS reports, SUM(revenue) AS revenue
+            FROM daily_stats
+            WHERE stat_date >= %s AND stat_date < %s
+            GROUP BY 1
+            HAVING SUM(patients) > 0 OR SUM(tests) > 0 OR SUM(reports) > 0
+            ORDER BY tests DESC
+        ''', (window_start.date(), window_end.date()))
+        rows = db_cursor.fetchall()
+        conn.close()
+
+        # patients counts registrations referred in the window
+        return jsonify({
+            'window': window_json(window_start, window_end),
+            'refDoctors': [
+                {
+                    'refBy': row['ref_by'],
+                    'patients': int(row['patients']),
+                    'tests': int(row['tests']),
+                    'reports': int(row['reports']),
+                    'revenue': float(row['revenue'])
+                }
+                for row in rows
+            ]
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/analytics/recent-activity', methods=['GET'])
+@token_required
+def get_analytics_recent_activity():
+    try:
+        try:
+            limit = parse_limit(request.args.get('limit'), default=10, maximum=50)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        conn = get_db_connection()
+        db_cursor = conn.cursor(dictionary=True)
+        db_cursor.execute('''
+            SELECT id, full_name, created_at FROM patients
+            ORDER BY created_at DESC, id DESC LIMIT %s
+        ''', (limit,))
+        patients = db_cursor.fetchall()
+        db_cursor.execute('''
+            SELECT t.id, t.test_name, t.created_at, p.full_name AS patient_name
+            FROM tests t
+            JOIN patients p ON p.id = t.patient_id
+            ORDER BY t.id DESC LIMIT %s
+        ''', (limit,))
+        tests = db_cursor.fetchall()
+        conn.close()
+
+        return jsonify({
+            'patients': [
+                {'id': row['id'], 'fullName': row['full_name'], 'createdAt': row['created_at']}
+                for row in patients
+            ],
+            'tests': [
+                {
+                    'id': row['id'],
+                    'testName': row['test_name'],
+                    'patientName': row['patient_name'],
+                    'createdAt': row['created_at']
+                }
+                for row in tests
+            ]
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/system/db-pool', methods=['GET'])
+@token_required
+def get_db_pool_stats():
+    try:
+        return jsonify(get_pool().stats()), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/jobs', methods=['GET'])
+@token_required
+def list_jobs():
+    try:
+        try:
+            limit = parse_limit(request.args.get('limit'), default=DEFAULT_PAGE_SIZE, maximum=200)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        conditions = []
+        params = []
+        for column in ('status', 'kind'):
+            if request.args.get(column):
+                conditions.append(f'{column} = %s')
+                params.append(request.args[column])
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+        conn = get_db_connection()
+        db_cursor = conn.cursor()
+        db_cursor.execute(f'''
+            SELECT {jobs.JOB_COLUMNS} FROM jobs
+            {where}
+            ORDER BY id DESC
+            LIMIT %s
+        ''', params + [limit])
+        job_list = [jobs.job_json(row) for row in db_cursor.fetchall()]
+        conn.close()
+        return jsonify(job_list)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/jobs', methods=['POST'])
+@token_required
+def submit_job():
+    try:
+        data = request.get_json() or {}
+        job_type = jobs.HANDLERS.get(data.get('kind'))
+        if job_type is None or not job_type.submittable:
+            submittable = sorted(kind for kind, registered in jobs.HANDLERS.items() if registered.submittable)
+            return jsonify({'error': f"kind must be one of: {', '.join(submittable)}"}), 400
+        if not isinstance(data.get('payload', {}), dict):
+            return jsonify({'error': 'payload must be an object'}), 400
+
+        conn = get_db_connection()
+        db_cursor = conn.cursor()
+        job_id = jobs.enqueue(db_cursor, data['kind'], data.get('payload'), created_by=current_user_id())
         conn.commit()
         conn.close()
-        return jsonify({'message': 'Password updated successfully'}), 200
+        return job_accepted(job_id)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/jobs/<int:job_id>', methods=['GET'])
+@token_required
+def get_job_status(job_id):
+    try:
+        conn = get_db_connection()
+        db_cursor = conn.cursor()
+        job = jobs.get_job(db_cursor, job_id)
+        conn.close()
+        if not job:
+            return jsonify({'error': 'Job not found'}), 404
+        return jsonify(job)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/jobs/<int:job_id>/cancel', methods=['POST'])
+@token_required
+def cancel_job(job_id):
+    try:
+        conn = get_db_connection()
+        db_cursor = conn.cursor()
+        status = jobs.cancel_job(db_cursor, job_id)
+        conn.commit()
+        job = jobs.get_job(db_cursor, job_id)
+        conn.close()
+        if not job:
+            return jsonify({'error': 'Job not found'}), 404
+        if status is None:
+            return jsonify({'error': f"Job already {job['status']}"}), 409
+        return jsonify(job)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/jobs/<int:job_id>/retry', methods=['POST'])
+@token_required
+def retry_job(job_id):
+    try:
+        conn = get_db_connection()
+        db_cursor = conn.cursor()
+        try:
+            retried = jobs.retry_job(db_cursor, job_id)
+        except jobs.JobFilesMissing as e:
+            conn.close()
+            return jsonify({'error': str(e)}), 409
+        conn.commit()
+        job = jobs.get_job(db_cursor, job_id)
+        conn.close()
+        if not job:
+            return jsonify({'error': 'Job not found'}), 404
+        if not retried:
+            return jsonify({'error': 'Only failed or cancelled jobs can be retried'}), 409
+        return jsonify(job)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/jobs/<int:job_id>/file', methods=['GET'])
+@token_required
+def download_job_file(job_id):
+    # Files produced by a job (e.g. the ZIP of a report batch)
+    try:
+        conn = get_db_connection()
+        db_cursor = conn.cursor()
+        job = jobs.get_job(db_cursor, job_id)
+        conn.close()
+        if not job:
+            return jsonify({'error': 'Job not found'}), 404
+        result = job['result'] or {}
+        if job['status'] != jobs.SUCCEEDED or not result.get('file'):
+            return jsonify({'error': 'Job has no file to download'}), 404
+        path = os.path.join(jobs.SPOOL_DIR, os.path.basename(result['file']))
+        if not os.path.exists(path):
+            return jsonify({'error': 'File has expired'}), 410
+        return send_file(path, as_attachment=True, download_name=result.get('fileName') or result['file'])
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -1201,47 +2656,15 @@ def get_current_date():
 #     try:
 #         conn = get_db_connection()
 #         db_cursor = conn.cursor()
-#         db_cursor.execute('SELECT * FROM patients WHERE patient_code = %s', (patient_code,))
+#         db_cursor.execute(f'SELECT {PATIENT_COLUMNS} FROM patients WHERE patient_code = %s', (patient_code,))
 #         patient_row = db_cursor.fetchone()
 #         if not patient_row:
 #             return jsonify({'error': 'Patient not found'}), 404
 
-#         patient_columns = [desc[0] for desc in db_cursor.description]
-#         patient = dict(zip(patient_columns, patient_row))
-
-#         db_cursor.execute('''
-#             SELECT * FROM tests 
-#             WHERE patient_id = %s 
-#             ORDER BY test_category, test_subcategory, created_at DESC
-#         ''', (patient['id'],))
-#         tests_rows = db_cursor.fetchall()
-#         test_columns = [desc[0] for desc in db_cursor.description]
-#         test_list = []
-#         for test_row in tests_rows:
-#             test = dict(zip(test_columns, test_row))
-#             test_list.append({
-#                 'id': test['id'],
-#                 'testCategory': test['test_category'],
-#                 'testSubcategory': test['test_subcategory'],
-#                 'testName': test['test_name'],
-#                 'testValue': test['test_value'],
-#                 'normalRange': test['normal_range'],
-#                 'unit': test['unit'],
-#                 'additionalNote': test['additional_note'],
-#                 'createdAt': test['created_at'].strftime('%Y-%m-%d %H:%M:%S') if test['created_at'] else None,
-#             })
-
-#         report = {
-#             'patientName': patient['full_name'],
-#             'patientCode': patient['patient_code'],
-#             'patientAge': patient['age'],
-#             'patientGender': patient['gender'],
-#             'contactNumber': patient['contact_number'],
-#             'refBy': patient['ref_by'],
-#             'tests': test_list
-#         }
+#         patient = Patient._make(patient_row)
+#         tests = fetch_report_tests(db_cursor, {patient.id: patient})[patient.id]
 #         conn.close()
-#         return jsonify(report)
+#         return jsonify(report_json(Report(patient, tests)))
 #     except Exception as e:
 #         print(f"Error generating public report: {str(e)}")
 #         return jsonify({'error': str(e)}), 500
@@ -1251,4 +2674,9 @@ if __name__ == '__main__':
     # Ensure database is initialized before starting the server
     init_db()
     init_user_table()
+    # Optionally process background jobs inside the dev server (only in the
+    # reloader's child, which is the process that serves requests)
+    embedded_workers = int(os.getenv('JOB_EMBEDDED_WORKERS', '0'))
+    if embedded_workers and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        jobs.Worker(app, concurrency=embedded_workers).start()
     app.run(debug=True, port=5000)
\ No newline at end of file
@@ -0,0 +1,167 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import jwt
+
+from database import get_db_connection
+
+# Request authentication without repeated work. Verified tokens are kept in a
+# bounded LRU keyed by the token's SHA-256, so a token is decoded and
+# HMAC-checked once rather than on every request, and entries lapse at the
+# token's own `exp`. Revocation is a per-user token_version carried in the
+# token's `ver` claim: changing credentials bumps the user's version, and
+# tokens with an older one are rejected. Versions for all users are held in
+# memory and refreshed at most every AUTH_TOKEN_VERSION_TTL seconds, so the
+# check costs no query per request.
+
+TOKEN_CACHE_SIZE = int(os.getenv('AUTH_TOKEN_CACHE_SIZE', '4096'))
+TOKEN_VERSION_TTL = float(os.getenv('AUTH_TOKEN_VERSION_TTL', '5'))
+PROFILE_CACHE_TTL = float(os.getenv('AUTH_PROFILE_CACHE_TTL', '30'))
+PROFILE_CACHE_SIZE = 1024
+
+
+class TokenRevoked(jwt.InvalidTokenError):
+    pass
+
+
+def token_digest(token):
+    return hashlib.sha256(token.encode('utf-8')).digest()
+
+
+class VerifiedTokenCache:
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, digest):
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            payload, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[digest]
+                return None
+            self._entries.move_to_end(digest)
+            return payload
+
+    def put(self, digest, payload):
+        expires_at = payload.get('exp')
+        if not isinstance(expires_at, (int, float)):
+            # Only tokens that expire are cached
+            return
+        with self._lock:
+            self._entries[digest] = (payload, expires_at)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _load_token_versions():
+    # The users table holds lab staff accounts, so loading every version at
+    # once is a single small query
+    conn = get_db_connection()
+    try:
+        db_cursor = conn.cursor()
+        db_cursor.execute('SELECT id, token_version FROM users')
+        return dict(db_cursor.fetchall())
+    finally:
+        conn.close()
+
+
+class TokenVersions:
+    def __init__(self, loader=_load_token_versions, ttl=TOKEN_VERSION_TTL):
+        self._loader = loader
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._versions = None
+        self._loaded_at = 0.0
+
+    def _current(self, refresh=False):
+        versions = self._versions
+        if refresh or versions is None or time.monotonic() - self._loaded_at > self.ttl:
+            with self._lock:
+                if refresh or self._versions is None or time.monotonic() - self._loaded_at > self.ttl:
+                    self._versions = self._loader()
+                    self._loaded_at = time.monotonic()
+                versions = self._versions
+        return versions
+
+    def is_current(self, user_id, version):
+        versions = self._current()
+        current = versions.get(user_id)
+        if current is None or current < version:
+            # A user or version this process has not seen yet, e.g. a token
+            # issued by another worker after a credential change
+            versions = self._current(refresh=True)
+            current = versions.get(user_id)
+        return current is not None and version >= current
+
+    def set(self, user_id, version):
+        # Applied immediately in this process; other processes pick it up on
+        # their next refresh
+        with self._lock:
+            if self._versions is not None:
+                self._versions = {**self._versions, user_id: version}
+
+    def invalidate(self):
+        with self._lock:
+            self._versions = None
+
+
+class ProfileCache:
+    def __init__(self, ttl=PROFILE_CACHE_TTL, maxsize=PROFILE_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            profile, stored_at = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._entries[user_id]
+                return None
+            return profile
+
+    def put(self, user_id, profile):
+        with self._lock:
+            self._entries[user_id] = (profile, time.monotonic())
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+
+token_cache = VerifiedTokenCache()
+token_versions = TokenVersions()
+profile_cache = ProfileCache()
+
+
+def verify_token(token, secret_key):
+    # Raises jwt.ExpiredSignatureError, TokenRevoked or jwt.InvalidTokenError
+    digest = token_digest(token)
+    payload = token_cache.get(digest)
+    if payload is None:
+        payload = jwt.decode(token, secret_key, algorithms=['HS256'])
+        token_cache.put(digest, payload)
+    if not token_versions.is_current(payload.get('user_id'), payload.get('ver', 0)):
+        raise TokenRevoked('Token has been revoked')
+    return payload
@@ -0,0 +1,3 @@
+# Login the seeder creates and the runner signs in with
+BENCH_EMAIL = 'bench@metacore.local'
+BENCH_PASSWORD = 'benchmark'
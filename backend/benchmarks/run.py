@@ -0,0 +1,387 @@
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlsplit
+
+from benchmarks import BENCH_EMAIL, BENCH_PASSWORD
+
+# Drives the main API endpoints at a fixed concurrency and records latency
+# percentiles and throughput per scenario. Seed a database first
+# (benchmarks/seed.py), start the API against it, then from backend/:
+#
+#   python -m benchmarks.run --base-url http://localhost:5000 --concurrency 16 --duration 20
+#
+# --in-process runs the Flask app inside this process through its test client
+# instead, which leaves the network and WSGI server out of the numbers;
+# --in-memory does the same against a freshly seeded throwaway SQLite database,
+# so no server or MySQL is needed at all.
+# Results go to benchmarks/results/ as JSON; pass an earlier file as
+# --baseline to print the change against it.
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+PERCENTILES = (50, 95, 99)
+
+
+class HttpClient:
+    # One keep-alive connection per worker thread
+    def __init__(self, base_url, timeout=30):
+        parts = urlsplit(base_url)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.connection = None
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = self.connection_class(self.netloc, timeout=self.timeout)
+            try:
+                self.connection.request(method, self.prefix + path, body=payload, headers=headers)
+                response = self.connection.getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, ConnectionError):
+                # The server closed an idle keep-alive connection; retry once
+                # on a fresh one
+                self.connection.close()
+                self.connection = None
+                if attempt:
+                    raise
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+
+class InProcessClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None, headers=None):
+        response = self.client.open(path, method=method, json=body, headers=headers)
+        return response.status_code, response.get_data()
+
+    def close(self):
+        pass
+
+
+def load_app():
+    import app as api
+    return api.app
+
+
+def load_memory_app(patients, tests_per_patient, catalog, seed):
+    # A throwaway SQLite database, seeded before the app starts serving. Set
+    # before the app is imported, since its modules read them at import.
+    os.environ.update(DB_BACKEND='sqlite', SQLITE_PATH=':memory:')
+    os.environ.setdefault('JWT_SECRET_KEY', 'benchmark')
+    os.environ.setdefault('LOGIN_RATE_IP_LIMIT', '1000000')
+    os.environ.setdefault('LOGIN_RATE_ACCOUNT_LIMIT', '1000000')
+    app = load_app()
+
+    from benchmarks import seed as seeder
+    from database import get_db_connection
+    conn = get_db_connection()
+    try:
+        seeder.seed(conn, patients, tests_per_patient, catalog, seeder.DEFAULT_REF_DOCTORS, seeder.DEFAULT_DAYS,
+                    seed, BENCH_EMAIL, BENCH_PASSWORD)
+    finally:
+        conn.close()
+    return app
+
+
+def percentile(sorted_values, pct):
+    # Nearest-rank percentile
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(latencies, statuses, response_bytes, elapsed):
+    ordered = sorted(latencies)
+    errors = sum(1 for status in statuses if status is None or status >= 400)
+    summary = {
+        'requests': len(ordered),
+        'errors': errors,
+        'statusCounts': {str(status): statuses.count(status) for status in sorted(set(statuses), key=str)},
+        'elapsedSeconds': round(elapsed, 3),
+        'throughput': round(len(ordered) / elapsed, 2) if elapsed else 0.0,
+        'meanMs': round(sum(ordered) / len(ordered) * 1000, 2) if ordered else None,
+        'maxMs': round(ordered[-1] * 1000, 2) if ordered else None,
+        'avgResponseBytes': round(sum(response_bytes) / len(response_bytes)) if response_bytes else 0
+    }
+    for pct in PERCENTILES:
+        value = percentile(ordered, pct)
+        summary[f'p{pct}Ms'] = round(value * 1000, 2) if value is not None else None
+    return summary
+
+
+class Fixtures:
+    # Ids and catalog panels the scenarios draw from, fetched once up front
+    def __init__(self, client, email, password, sample_size):
+        self.email = email
+        self.password = password
+        status, body = client.request('POST', '/api/login', {'email': email, 'password': password})
+        if status != 200:
+            raise SystemExit(f'Login failed ({status}): {body[:200]!r}; run benchmarks.seed first')
+        self.headers = {'Authorization': f'Bearer {json.loads(body)["token"]}'}
+
+        status, body = client.request('GET', f'/api/patients?limit={sample_size}', headers=self.headers)
+        if status != 200:
+            raise SystemExit(f'Could not list patients ({status}): {body[:200]!r}')
+        self.patient_ids = [patient['id'] for patient in json.loads(body)['patients']]
+        if not self.patient_ids:
+            raise SystemExit('No patients in the database; run benchmarks.seed first')
+
+        status, body = client.request('GET', '/api/tests/categories', headers=self.headers)
+        if status != 200:
+            raise SystemExit(f'Could not load the test catalog ({status}): {body[:200]!r}')
+        self.panels = [
+            (category['category'], subcategory['subcategory'], subcategory['tests'])
+            for category in json.loads(body)
+            for subcategory in category['subcategories']
+            if subcategory['tests']
+        ]
+        if not self.panels:
+            raise SystemExit('The test catalog is empty; run benchmarks.seed first')
+
+
+def scenario_patients(fixtures, rng):
+    return 'GET', '/api/patients?limit=50', None, fixtures.headers
+
+
+def scenario_patients_all(fixtures, rng):
+    # The unpaginated list the older screens still request
+    return 'GET', '/api/patients', None, fixtures.headers
+
+
+def scenario_report(fixtures, rng):
+    return 'GET', f'/api/reports/{rng.choice(fixtures.patient_ids)}', None, fixtures.headers
+
+
+def scenario_test_results(fixtures, rng):
+    category, subcategory, tests = rng.choice(fixtures.panels)
+    panel = {
+        'patientId': rng.choice(fixtures.patient_ids),
+        'category': category,
+        'subcategory': subcategory,
+        'tests': [{'testName': test['name'], 'value': str(round(rng.uniform(0, 200), 2))} for test in tests[:8]]
+    }
+    return 'POST', '/api/test-results', panel, fixtures.headers
+
+
+def scenario_categories(fixtures, rng):
+    return 'GET', '/api/tests/categories', None, fixtures.headers
+
+
+def scenario_login(fixtures, rng):
+    # Each request costs a bcrypt check; raise LOGIN_RATE_IP_LIMIT and
+    # LOGIN_RATE_ACCOUNT_LIMIT on the server or most of these come back 429
+    return 'POST', '/api/login', {'email': fixtures.email, 'password': fixtures.password}, None
+
+
+SCENARIOS = {
+    'patients': scenario_patients,
+    'patients-all': scenario_patients_all,
+    'report': scenario_report,
+    'test-results': scenario_test_results,
+    'categories': scenario_categories,
+    'login': scenario_login,
+}
+DEFAULT_SCENARIOS = ['patients', 'report', 'test-results', 'categories', 'login']
+
+
+def run_scenario(make_client, fixtures, scenario, concurrency, duration, warmup, max_requests, seed):
+    latencies = []
+    statuses = []
+    response_bytes = []
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(concurrency + 1)
+    state = {'measure_from': None, 'stop_at': None, 'remaining': max_requests}
+
+    def worker(index):
+        rng = random.Random(seed * 1000 + index)
+        client = make_client()
+        local = []
+        try:
+            start_barrier.wait()
+            while True:
+                now = time.perf_counter()
+                if now >= state['stop_at']:
+                    break
+                measured = now >= state['measure_from']
+                if measured and max_requests:
+                    with lock:
+                        if state['remaining'] <= 0:
+                            break
+                        state['remaining'] -= 1
+                method, path, body, headers = scenario(fixtures, rng)
+                started = time.perf_counter()
+                try:
+                    status, payload = client.request(method, path, body, headers)
+                    size = len(payload)
+                except Exception:
+                    status, size = None, 0
+                if measured:
+                    local.append((time.perf_counter() - started, status, size))
+        finally:
+            client.close()
+            with lock:
+                for latency, status, size in local:
+                    latencies.append(latency)
+                    statuses.append(status)
+                    response_bytes.append(size)
+
+    threads = [threading.Thread(target=worker, args=(index,), daemon=True) for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    now = time.perf_counter()
+    state['measure_from'] = now + warmup
+    # With a request budget the duration is only an upper bound
+    state['stop_at'] = state['measure_from'] + duration
+    start_barrier.wait()
+    for thread in threads:
+        thread.join()
+    elapsed = min(time.perf_counter(), state['stop_at']) - state['measure_from']
+    return summarize(latencies, statuses, response_bytes, max(elapsed, 0.0))
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(results, baseline=None):
+    header = f'{"scenario":<14}{"reqs":>8}{"errors":>8}{"req/s":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}'
+    if baseline:
+        header += f'{"Δp95":>10}{"Δreq/s":>10}'
+    print(header)
+    for name, summary in results.items():
+        line = (f'{name:<14}{summary["requests"]:>8}{summary["errors"]:>8}{summary["throughput"]:>10.1f}'
+                f'{summary["p50Ms"] or 0:>10.1f}{summary["p95Ms"] or 0:>10.1f}{summary["p99Ms"] or 0:>10.1f}')
+        previous = (baseline or {}).get(name)
+        if previous:
+            line += f'{change(previous.get("p95Ms"), summary["p95Ms"]):>10}'
+            line += f'{change(previous.get("throughput"), summary["throughput"]):>10}'
+        print(line)
+
+
+def change(before, after):
+    if not before or after is None:
+        return '-'
+    return f'{(after - before) / before * 100:+.1f}%'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the MetaCore API')
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--base-url', default='http://localhost:5000')
+    target.add_argument('--in-process', action='store_true', help='call the Flask app directly via its test client')
+    target.add_argument('--in-memory', action='store_true',
+                        help='seed a throwaway SQLite database and benchmark the app in-process against it')
+    parser.add_argument('--scenarios', default=','.join(DEFAULT_SCENARIOS),
+                        help=f'comma separated, from: {", ".join(SCENARIOS)}')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=15, help='measured seconds per scenario')
+    parser.add_argument('--warmup', type=float, default=2, help='unmeasured seconds before each scenario')
+    parser.add_argument('--requests', type=int, default=0, help='stop each scenario after this many requests')
+    parser.add_argument('--email', default=BENCH_EMAIL)
+    parser.add_argument('--password', default=BENCH_PASSWORD)
+    parser.add_argument('--sample-patients', type=int, default=200, help='patients the scenarios pick from')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--patients', type=int, default=2000, help='with --in-memory: patients to seed')
+    parser.add_argument('--tests-per-patient', type=int, default=20, help='with --in-memory')
+    parser.add_argument('--catalog', type=int, default=200, help='with --in-memory: catalog entries to seed')
+    parser.add_argument('--label', default='', help='stored with the results, e.g. a branch name')
+    parser.add_argument('--output', help='results file (default: benchmarks/results/<time>-<commit>.json)')
+    parser.add_argument('--baseline', help='earlier results file to compare against')
+    args = parser.parse_args(argv)
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f'Unknown scenario(s): {", ".join(unknown)}')
+
+    if args.in_memory:
+        app = load_memory_app(args.patients, args.tests_per_patient, args.catalog, args.seed)
+        make_client = lambda: InProcessClient(app)
+    elif args.in_process:
+        app = load_app()
+        make_client = lambda: InProcessClient(app)
+    else:
+        make_client = lambda: HttpClient(args.base_url)
+
+    setup_client = make_client()
+    try:
+        fixtures = Fixtures(setup_client, args.email, args.password, args.sample_patients)
+    finally:
+        setup_client.close()
+
+    results = {}
+    for name in names:
+        print(f'Running {name} ({args.concurrency} concurrent)...', flush=True)
+        results[name] = run_scenario(
+            make_client, fixtures, SCENARIOS[name], args.concurrency, args.duration, args.warmup,
+            args.requests, args.seed
+        )
+        if results[name]['statusCounts'].get('429'):
+            print(f'  {results[name]["statusCounts"]["429"]} requests were rate limited (429)')
+
+    commit = git_commit()
+    started_at = datetime.now()
+    document = {
+        'meta': {
+            'label': args.label,
+            'timestamp': started_at.isoformat(timespec='seconds'),
+            'gitCommit': commit,
+            'target': 'sqlite-memory' if args.in_memory else 'in-process' if args.in_process else args.base_url,
+            'concurrency': args.concurrency,
+            'durationSeconds': args.duration,
+            'warmupSeconds': args.warmup,
+            'requestLimit': args.requests or None,
+            'seed': args.seed,
+            'python': platform.python_version(),
+            'platform': platform.platform()
+        },
+        'scenarios': results
+    }
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f'{started_at:%Y%m%d-%H%M%S}-{commit or "nogit"}.json')
+    with open(output, 'w') as f:
+        json.dump(document, f, indent=2)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['scenarios']
+    print()
+    print_table(results, baseline)
+    print(f'\nResults saved to {output}')
+    return 1 if any(summary['requests'] == 0 for summary in results.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,230 @@
+import argparse
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from benchmarks import BENCH_EMAIL, BENCH_PASSWORD
+import migrations
+import rollups
+import sequences
+from cache import commit_table_versions
+import sqlite_backend
+from database import get_db_connection, insert_test_result_rows, is_sqlite
+from passwords import hash_password
+from patient_search import index_patients, national_phone, normalize_phone
+from reference_ranges import evaluate_result
+
+# Fills the configured database with synthetic but realistic looking data for
+# the benchmark runner. The same --seed always produces the same rows, so runs
+# against different versions of the API see identical volumes and shapes.
+#
+#   python -m benchmarks.seed --patients 5000 --tests-per-patient 30 --catalog 300
+#
+# Run from backend/ against a throwaway database (MYSQL_DB_NAME=metacore_bench,
+# or DB_BACKEND=sqlite with SQLITE_PATH=metacore_bench.db); --reset empties the
+# data tables first and refuses unless the database name contains "bench".
+
+CATEGORIES = {
+    'Hematology': ['Complete Blood Count', 'Coagulation', 'ESR'],
+    'Biochemistry': ['Liver Function', 'Kidney Function', 'Lipid Profile', 'Electrolytes'],
+    'Endocrinology': ['Thyroid Profile', 'Diabetes', 'Hormones'],
+    'Immunology': ['Serology', 'Allergy Panel'],
+    'Urinalysis': ['Routine Examination', 'Microscopy'],
+    'Microbiology': ['Culture', 'Stain'],
+}
+UNITS = ['mg/dL', 'g/dL', 'mmol/L', 'U/L', 'IU/mL', '%', 'x10^3/uL', 'ng/mL']
+SPECIALIZATIONS = ['General Physician', 'Cardiology', 'Endocrinology', 'Nephrology', 'Gynecology', 'Pediatrics']
+FIRST_NAMES = ['Ayesha', 'Rahim', 'Karim', 'Nusrat', 'Tanvir', 'Farhana', 'Imran', 'Sadia', 'Jamal', 'Mitu',
+               'Arif', 'Shirin', 'Hasan', 'Laila', 'Rafiq', 'Sumaiya', 'Nabil', 'Ruma', 'Zahid', 'Tania']
+LAST_NAMES = ['Ahmed', 'Hossain', 'Rahman', 'Islam', 'Chowdhury', 'Khan', 'Akter', 'Uddin', 'Sarkar', 'Begum']
+
+DATA_TABLES = ['daily_stats', 'tests', 'reports', 'patients', 'test_catalog', 'ref_doctors']
+PATIENT_CHUNK = 500
+DEFAULT_REF_DOCTORS = 25
+DEFAULT_DAYS = 365
+
+
+def catalog_entries(rng, count):
+    pairs = [(category, subcategory) for category, subcategories in CATEGORIES.items() for subcategory in subcategories]
+    entries = []
+    for index in range(count):
+        category, subcategory = pairs[index % len(pairs)]
+        low = round(rng.uniform(0.5, 100), 1)
+        high = round(low * rng.uniform(1.3, 3), 1)
+        shape = rng.random()
+        if shape < 0.6:
+            reference_range = f'{low}-{high}'
+        elif shape < 0.8:
+            reference_range = f'M: {low}-{high}; F: {round(low * 0.9, 1)}-{round(high * 0.9, 1)}'
+        elif shape < 0.9:
+            reference_range = f'<{high}'
+        else:
+            reference_range = 'Negative'
+        entries.append((
+            f'{subcategory} Test {index + 1}',
+            category,
+            subcategory,
+            round(rng.uniform(100, 3000), 2),
+            reference_range,
+            rng.choice(UNITS),
+            f'BX{index + 1:04d}'
+        ))
+    return entries
+
+
+def result_value(rng, reference_range):
+    if reference_range == 'Negative':
+        return 'Negative' if rng.random() < 0.9 else 'Positive'
+    numbers = [float(part) for part in reference_range.replace('M:', '').replace('F:', '').replace('<', '')
+               .replace(';', '-').split('-') if part.strip()]
+    low, high = (0, numbers[0]) if len(numbers) == 1 else (numbers[0], numbers[1])
+    # Mostly in range, with a tail of abnormal results on either side
+    return str(round(rng.uniform(low * 0.7, high * 1.3), 2))
+
+
+def reset(conn):
+    db_cursor = conn.cursor()
+    if is_sqlite():
+        name = sqlite_backend.SQLITE_PATH
+    else:
+        db_cursor.execute('SELECT DATABASE()')
+        name = db_cursor.fetchone()[0] or ''
+    if 'bench' not in name.lower():
+        raise SystemExit(f'Refusing to reset database {name!r}: use a dedicated benchmark database')
+    for table in DATA_TABLES + (['patient_trigrams'] if is_sqlite() else []):
+        db_cursor.execute(f'DELETE FROM {table}')
+    conn.commit()
+
+
+def seed(conn, patients, tests_per_patient, catalog_size, ref_doctors, days, seed_value, email, password, log=print):
+    rng = random.Random(seed_value)
+    db_cursor = conn.cursor()
+    now = datetime.now().replace(microsecond=0)
+
+    db_cursor.execute('SELECT id FROM lab_info LIMIT 1')
+    if not db_cursor.fetchone():
+        db_cursor.execute(
+            'INSERT INTO lab_info (name, address, phone, email) VALUES (%s, %s, %s, %s)',
+            ('Benchmark Diagnostics', '1 Load Test Road', '+8800000000000', 'lab@metacore.local')
+        )
+
+    db_cursor.execute('SELECT id FROM users WHERE email = %s', (email,))
+    if not db_cursor.fetchone():
+        db_cursor.execute(
+            'INSERT INTO users (email, password, full_name, role) VALUES (%s, %s, %s, %s)',
+            (email, hash_password(password), 'Benchmark User', 'admin')
+        )
+
+    doctors = [(f'Dr. {rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}', rng.choice(SPECIALIZATIONS))
+               for _ in range(ref_doctors)]
+    db_cursor.executemany('INSERT INTO ref_doctors (name, specialization) VALUES (%s, %s)', doctors)
+
+    catalog = catalog_entries(rng, catalog_size)
+    db_cursor.executemany('''
+        INSERT INTO test_catalog (name, category, subcategory, price, reference_range, unit, analyzer_code)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+    ''', catalog)
+    conn.commit()
+    log(f'Catalog: {len(catalog)} tests, {len(doctors)} referring doctors')
+
+    panels = {}
+    for entry in catalog:
+        panels.setdefault((entry[1], entry[2]), []).append(entry)
+    panel_list = list(panels.values())
+
+    started = time.monotonic()
+    test_count = 0
+    for chunk_start in range(0, patients, PATIENT_CHUNK):
+        size = min(PATIENT_CHUNK, patients - chunk_start)
+        first_code = sequences.reserve(db_cursor, 'patient_code', size)
+        rows = []
+        for offset in range(size):
+            gender = rng.choice(['Male', 'Female'])
+            rows.append((
+                f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}',
+                rng.randint(1, 90),
+                gender,
+                f'01{rng.randint(300000000, 999999999)}',
+                f'patient{chunk_start + offset + 1}@example.com',
+                sequences.format_patient_code(first_code + offset),
+                f'House {rng.randint(1, 200)}, Road {rng.randint(1, 50)}, Dhaka',
+                rng.choice(doctors)[0] if doctors and rng.random() < 0.7 else None,
+                now - timedelta(days=rng.uniform(0, days))
+            ))
+        db_cursor.executemany('''
+            INSERT INTO patients (
+                full_name, age, gender, contact_number, email, patient_code, address, ref_by, created_at,
+                contact_digits, contact_national
+            )
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ''', [row + (normalize_phone(row[3]), national_phone(row[3])) for row in rows])
+        # Ids of a multi-row insert are not guaranteed to be consecutive, so
+        # they are looked up by the codes just assigned
+        placeholders = ', '.join(['%s'] * len(rows))
+        db_cursor.execute(f'SELECT patient_code, id FROM patients WHERE patient_code IN ({placeholders})',
+                          [row[5] for row in rows])
+        patient_ids = dict(db_cursor.fetchall())
+        index_patients(db_cursor, [(patient_ids[row[5]], row[0], row[6]) for row in rows])
+
+        test_rows = []
+        for patient in rows:
+            remaining = tests_per_patient
+            test_date = patient[8]
+            while remaining > 0 and panel_list:
+                # Results arrive a panel at a time, as they do from the UI
+                panel = rng.choice(panel_list)[:remaining]
+                for name, category, subcategory, price, reference_range, unit, _code in panel:
+                    value = result_value(rng, reference_range)
+                    numeric_value, status = evaluate_result(value, reference_range, patient[2], patient[1])
+                    test_rows.append((
+                        patient_ids[patient[5]], category, subcategory, name, value, reference_range, unit,
+                        min(test_date, now), None, numeric_value, status, price
+                    ))
+                remaining -= len(panel)
+                test_date += timedelta(days=rng.uniform(0, 30))
+        insert_test_result_rows(db_cursor, test_rows)
+        conn.commit()
+        test_count += len(test_rows)
+        log(f'Patients: {chunk_start + size}/{patients}, tests: {test_count}')
+
+    # Rows above carry backdated timestamps, so the rollup is built in one go
+    rollups.rebuild(db_cursor)
+    conn.commit()
+    commit_table_versions(conn, 'patients', 'tests', 'test_catalog', 'ref_doctors')
+    log(f'Seeded {patients} patients and {test_count} tests in {time.monotonic() - started:.1f}s')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Seed the configured database with benchmark data')
+    parser.add_argument('--patients', type=int, default=2000)
+    parser.add_argument('--tests-per-patient', type=int, default=20)
+    parser.add_argument('--catalog', type=int, default=200, help='test catalog entries')
+    parser.add_argument('--ref-doctors', type=int, default=DEFAULT_REF_DOCTORS)
+    parser.add_argument('--days', type=int, default=DEFAULT_DAYS, help='spread registrations over this many days')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--email', default=BENCH_EMAIL, help='login created for the benchmark runner')
+    parser.add_argument('--password', default=BENCH_PASSWORD)
+    parser.add_argument('--reset', action='store_true', help='empty the data tables first')
+    args = parser.parse_args(argv)
+
+    conn = get_db_connection()
+    try:
+        applied = migrations.migrate(conn)
+        if applied:
+            print(f'Applied migrations: {", ".join(map(str, applied))}')
+        if args.reset:
+            reset(conn)
+        seed(conn, args.patients, args.tests_per_patient, args.catalog, args.ref_doctors, args.days,
+             args.seed, args.email, args.password)
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+import hashlib
+import threading
+
+from database import is_sqlite
+
+# Write handlers bump a per-table counter once their change has committed;
+# readers compare it against the version their cached payload was built
+# from. The check is a primary-key lookup on a tiny table, so every worker
+# process notices a change without re-reading the underlying table.
+#
+# The bump runs in a short transaction of its own (commit_table_versions):
+# inside the writer's transaction the upsert would hold the table's row lock
+# until that commit, serializing every concurrent writer of the table (import
+# chunks, jobs) on it. Bumping after the commit means a reader may briefly
+# see the new rows under the old version; whatever it caches is dropped at
+# the bump. It can never pair the new version with the old rows.
+
+TABLE_VERSIONS_DDL = '''
+    CREATE TABLE IF NOT EXISTS table_versions (
+        table_name VARCHAR(64) PRIMARY KEY,
+        version BIGINT NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+    )
+'''
+
+
+def bump_table_version(db_cursor, table):
+    if is_sqlite():
+        upsert = 'ON CONFLICT (table_name) DO UPDATE SET version = version + 1, updated_at = CURRENT_TIMESTAMP'
+    else:
+        upsert = 'ON DUPLICATE KEY UPDATE version = version + 1'
+    db_cursor.execute(f'''
+        INSERT INTO table_versions (table_name, version) VALUES (%s, 1)
+        {upsert}
+    ''', (table,))
+
+
+def commit_table_versions(conn, *tables):
+    # Call right after the data change is committed
+    db_cursor = conn.cursor()
+    for table in tables:
+        bump_table_version(db_cursor, table)
+    conn.commit()
+
+
+def get_table_version(db_cursor, table):
+    db_cursor.execute('SELECT version FROM table_versions WHERE table_name = %s', (table,))
+    row = db_cursor.fetchone()
+    return row[0] if row else 0
+
+
+def get_table_versions(db_cursor, tables):
+    # Several tables in one round trip, in the order given
+    placeholders = ', '.join(['%s'] * len(tables))
+    db_cursor.execute(f'SELECT table_name, version FROM table_versions WHERE table_name IN ({placeholders})',
+                      list(tables))
+    versions = dict(db_cursor.fetchall())
+    return tuple(versions.get(table, 0) for table in tables)
+
+
+def make_etag(body):
+    # Unquoted; Response.set_etag adds the quotes
+    return hashlib.sha1(body).hexdigest()[:20]
+
+
+class CachedPayload:
+    __slots__ = ('version', 'body', 'etag')
+
+    def __init__(self, version, body):
+        self.version = version
+        self.body = body
+        self.etag = make_etag(body)
+
+
+class VersionedCache:
+    # Serialized response bodies keyed by name, each tagged with the table
+    # version it was built from.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry.version == version:
+            return entry
+        return None
+
+    def put(self, key, version, body):
+        entry = CachedPayload(version, body)
+        with self._lock:
+            current = self._entries.get(key)
+            # Never replace a payload built from a newer version
+            if current is None or current.version <= version:
+                self._entries[key] = entry
+        return entry
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+response_cache = VersionedCache()
@@ -0,0 +1,97 @@
+import gzip
+import os
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+# Response compression, negotiated from Accept-Encoding: brotli when the
+# client takes it and the module is installed, else gzip. Buffered bodies
+# under COMPRESS_MIN_SIZE bytes go out as they are (the headers would eat
+# most of the saving); streamed bodies (reports) are compressed as they are
+# written, since their size is not known up front.
+#
+# A compressed body is a different representation of the same resource, so
+# a strong ETag is downgraded to a weak one (as nginx does); If-None-Match
+# uses weak comparison, so the client's revalidation still gets its 304.
+
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE') or 1024)
+# Fast settings: these bodies are compressed per request, not ahead of time
+GZIP_LEVEL = int(os.getenv('COMPRESS_GZIP_LEVEL') or 6)
+BROTLI_QUALITY = int(os.getenv('COMPRESS_BROTLI_QUALITY') or 5)
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/html', 'text/plain', 'text/csv', 'application/javascript')
+
+
+def available_encodings():
+    # Server preference order; the client's q-values decide first
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def _compressor(encoding):
+    if encoding == 'br':
+        return brotli.Compressor(quality=BROTLI_QUALITY)
+    # wbits 31: zlib stream with a gzip header and trailer
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def compress_stream(chunks, encoding):
+    compressor = _compressor(encoding)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            # Output comes in blocks as the compressor's window fills, so a
+            # large report is still sent incrementally
+            data = compressor.process(chunk) if encoding == 'br' else compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.finish() if encoding == 'br' else compressor.flush()
+    finally:
+        # Lets the wrapped generator release its connection
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+def _negotiate(response):
+    if request.method == 'HEAD' or response.status_code < 200 or response.status_code in (204, 206, 304):
+        return None
+    if response.direct_passthrough or 'Content-Encoding' in response.headers:
+        return None
+    if response.mimetype not in COMPRESSIBLE_TYPES:
+        return None
+    response.vary.add('Accept-Encoding')
+    return request.accept_encodings.best_match(available_encodings())
+
+
+def compress_response(response):
+    encoding = _negotiate(response)
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+    else:
+        body = response.get_data()
+        if len(body) < COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(compress(body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_app(app):
+    app.after_request(compress_response)
@@ -0,0 +1,463 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+
+from flask import g, has_app_context
+
+import sqlite_backend
+
+try:
+    import mysql.connector
+except ImportError:  # SQLite-only installs
+    mysql = None
+
+# 'mysql' (default) or 'sqlite'; see sqlite_backend.py
+DB_BACKEND = os.getenv('DB_BACKEND', 'mysql').strip().lower()
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+def _env_int(name, default):
+    value = os.getenv(name)
+    return int(value) if value not in (None, '') else default
+
+
+def _env_float(name, default):
+    value = os.getenv(name)
+    return float(value) if value not in (None, '') else default
+
+
+def _env_bool(name, default):
+    value = os.getenv(name)
+    if value in (None, ''):
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+# Set by metrics.init_app: returns the recorder for the current request, or
+# None outside one. Cursors are only wrapped while it returns a recorder.
+_query_observer = None
+
+
+def set_query_observer(observer):
+    global _query_observer
+    _query_observer = observer
+
+
+class TimedCursor:
+    # Cursor proxy that reports statement and fetch time, and the number of
+    # rows fetched, to a request recorder
+
+    def __init__(self, cursor, recorder):
+        self._cursor = cursor
+        self._recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._cursor.close()
+
+    def execute(self, operation, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self._cursor.execute(operation, *args, **kwargs)
+        finally:
+            self._recorder.query(operation, time.perf_counter() - started)
+
+    def executemany(self, operation, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self._cursor.executemany(operation, *args, **kwargs)
+        finally:
+            self._recorder.query(operation, time.perf_counter() - started)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = self._cursor.fetchone()
+        self._recorder.fetch(0 if row is None else 1, time.perf_counter() - started)
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        started = time.perf_counter()
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        self._recorder.fetch(len(rows), time.perf_counter() - started)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = self._cursor.fetchall()
+        self._recorder.fetch(len(rows), time.perf_counter() - started)
+        return rows
+
+
+class PooledConnection:
+    # Thin proxy around a driver connection; close() hands it back to the pool
+    # instead of tearing down the socket.
+
+    def __init__(self, pool, raw, created_at):
+        self._pool = pool
+        self._raw = raw
+        self._created_at = created_at
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    @property
+    def raw(self):
+        return self._raw
+
+    def cursor(self, *args, **kwargs):
+        cursor = self._raw.cursor(*args, **kwargs)
+        recorder = _query_observer() if _query_observer else None
+        return TimedCursor(cursor, recorder) if recorder is not None else cursor
+
+    def close(self):
+        if self._released:
+            return
+        self._released = True
+        self._pool.release(self)
+
+
+class ConnectionPool:
+    def __init__(self, factory, size=5, max_overflow=10, timeout=30.0,
+                 recycle=3600, pre_ping=True, ping_interval=30.0):
+        self._factory = factory
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.recycle = recycle
+        self.pre_ping = pre_ping
+        self.ping_interval = ping_interval
+
+        self._lock = threading.Condition()
+        # Idle entries are (raw_connection, created_at, returned_at); reused LIFO
+        # so the warmest connection is handed out first.
+        self._idle = deque()
+        self._open = 0
+        self._checked_out = 0
+        self._stats = {
+            'checkouts': 0,
+            'connectionsCreated': 0,
+            'connectionsRecycled': 0,
+            'connectionsInvalidated': 0,
+            'waits': 0,
+            'waitTimeTotal': 0.0,
+            'timeouts': 0,
+        }
+
+    @property
+    def capacity(self):
+        return self.size + self.max_overflow
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        wait_started = None
+
+        with self._lock:
+            while True:
+                if self._idle:
+                    raw, created_at, returned_at = self._idle.pop()
+                    break
+                if self._open < self.capacity:
+                    self._open += 1
+                    raw, created_at, returned_at = None, None, None
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    if waited:
+                        self._stats['waitTimeTotal'] += time.monotonic() - wait_started
+                    raise PoolTimeoutError(
+                        f'Timed out after {self.timeout}s waiting for a database connection'
+                    )
+                if not waited:
+                    waited = True
+                    wait_started = time.monotonic()
+                    self._stats['waits'] += 1
+                self._lock.wait(remaining)
+
+            if waited:
+                self._stats['waitTimeTotal'] += time.monotonic() - wait_started
+            self._checked_out += 1
+            self._stats['checkouts'] += 1
+
+        try:
+            if raw is not None:
+                raw, created_at = self._validate(raw, created_at, returned_at)
+            else:
+                raw, created_at = self._connect()
+        except Exception:
+            with self._lock:
+                self._open -= 1
+                self._checked_out -= 1
+                self._lock.notify()
+            raise
+
+        return PooledConnection(self, raw, created_at)
+
+    def release(self, conn):
+        raw = conn.raw
+        now = time.monotonic()
+        reusable = self._reset(raw) and (now - conn._created_at) < self.recycle
+
+        with self._lock:
+            self._checked_out -= 1
+            if reusable and len(self._idle) < self.size:
+                self._idle.append((raw, conn._created_at, now))
+                raw = None
+            else:
+                self._open -= 1
+            self._lock.notify()
+
+        if raw is not None:
+            self._discard(raw)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                'size': self.size,
+                'maxOverflow': self.max_overflow,
+                'open': self._open,
+                'idle': len(self._idle),
+                'checkedOut': self._checked_out,
+                'overflow': max(0, self._open - self.size),
+            })
+        stats['waitTimeTotal'] = round(stats['waitTimeTotal'], 6)
+        return stats
+
+    def dispose(self):
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._open -= len(idle)
+            self._lock.notify_all()
+        for raw, _, _ in idle:
+            self._discard(raw)
+
+    def _connect(self):
+        raw = self._factory()
+        with self._lock:
+            self._stats['connectionsCreated'] += 1
+        return raw, time.monotonic()
+
+    def _validate(self, raw, created_at, returned_at):
+        now = time.monotonic()
+        if now - created_at >= self.recycle:
+            self._discard(raw)
+            with self._lock:
+                self._stats['connectionsRecycled'] += 1
+            return self._connect()
+
+        # Only ping connections that have sat idle long enough for the server
+        # (or a firewall) to have dropped them.
+        if self.pre_ping and now - returned_at >= self.ping_interval:
+            try:
+                raw.ping(reconnect=False)
+            except Exception:
+                self._discard(raw)
+                with self._lock:
+                    self._stats['connectionsInvalidated'] += 1
+                return self._connect()
+        return raw, created_at
+
+    def _reset(self, raw):
+        # Leave no open transaction or pending result set behind for the next
+        # borrower; anything that fails here is not worth keeping.
+        try:
+            if getattr(raw, 'unread_result', False):
+                raw.consume_results()
+            if getattr(raw, 'in_transaction', False):
+                raw.rollback()
+            return True
+        except Exception:
+            with self._lock:
+                self._stats['connectionsInvalidated'] += 1
+            return False
+
+    @staticmethod
+    def _discard(raw):
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+# Catch this rather than a driver's own class so handlers work on either backend
+IntegrityError = (sqlite3.IntegrityError,) + ((mysql.connector.IntegrityError,) if mysql else ())
+
+
+def is_duplicate_key(error):
+    # MySQL: "1062 (23000): Duplicate entry ... for key ..."; SQLite: "UNIQUE
+    # constraint failed: table.column"
+    message = str(error)
+    return 'Duplicate entry' in message or 'UNIQUE constraint failed' in message
+
+
+def is_sqlite():
+    return DB_BACKEND == 'sqlite'
+
+
+def configure(backend, sqlite_path=None):
+    # Switches backend at runtime (benchmarks and tests); open connections of
+    # the previous pool are closed
+    global DB_BACKEND, _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.dispose()
+        _pool = None
+        DB_BACKEND = backend
+        if sqlite_path is not None:
+            sqlite_backend.SQLITE_PATH = sqlite_path
+
+
+def _mysql_connect():
+    if mysql is None:
+        raise RuntimeError('mysql-connector-python is not installed; install it or set DB_BACKEND=sqlite')
+    return mysql.connector.connect(
+        host=os.getenv('MYSQL_DB_HOST', 'localhost'),
+        port=_env_int('MYSQL_DB_PORT', 3306),
+        user=os.getenv('MYSQL_DB_USER', 'root'),
+        password=os.getenv('MYSQL_DB_PASSWORD', ''),
+        database=os.getenv('MYSQL_DB_NAME', 'metacore_db')
+    )
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    sqlite_backend.connect if is_sqlite() else _mysql_connect,
+                    size=_env_int('MYSQL_POOL_SIZE', 5),
+                    max_overflow=_env_int('MYSQL_POOL_MAX_OVERFLOW', 10),
+                    timeout=_env_float('MYSQL_POOL_TIMEOUT', 30.0),
+                    recycle=_env_float('MYSQL_POOL_RECYCLE', 3600),
+                    pre_ping=_env_bool('MYSQL_POOL_PRE_PING', True),
+                    ping_interval=_env_float('MYSQL_POOL_PING_INTERVAL', 30.0)
+                )
+    return _pool
+
+
+def ensure_index(db_cursor, table, index_name, columns, kind='', options=''):
+    # MySQL has no CREATE INDEX IF NOT EXISTS, so look the index up first.
+    # kind/options are MySQL-only (e.g. 'FULLTEXT', 'WITH PARSER ngram')
+    if is_sqlite():
+        db_cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'index' AND name = %s", (index_name,))
+        # SQLite indexes whole values; drop MySQL prefix lengths
+        columns = re.sub(r'\(\d+\)', '', columns)
+    else:
+        db_cursor.execute('''
+            SELECT COUNT(*) FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+        ''', (table, index_name))
+    if db_cursor.fetchone()[0]:
+        return False
+    db_cursor.execute(f'CREATE {kind} INDEX {index_name} ON {table} ({columns}) {options}')
+    return True
+
+
+def like_prefix(value):
+    # Escape LIKE wildcards so user input only ever matches as a literal prefix
+    escaped = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return escaped + '%'
+
+
+def table_columns(db_cursor, table):
+    # {column name: declared type} for a SQLite table
+    db_cursor.execute(f'PRAGMA table_info({table})')
+    return {row[1]: row[2] for row in db_cursor.fetchall()}
+
+
+def ensure_column(db_cursor, table, column, definition):
+    if is_sqlite():
+        if column in table_columns(db_cursor, table):
+            return False
+        # SQLite always appends new columns
+        definition = re.sub(r'\s+AFTER\s+\w+\s*$', '', definition, flags=re.I)
+    else:
+        db_cursor.execute('''
+            SELECT COUNT(*) FROM information_schema.columns
+            WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+        ''', (table, column))
+        if db_cursor.fetchone()[0]:
+            return False
+    db_cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    return True
+
+
+TEST_RESULT_INSERT = '''
+    INSERT INTO tests (
+        patient_id, 
+        test_category, 
+        test_subcategory,
+        test_name, 
+        test_value, 
+        normal_range, 
+        unit, 
+        test_date,
+        additional_note,
+        numeric_value,
+        result_status,
+        price
+    )
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+'''
+
+# Rows per multi-VALUES INSERT; keeps large batch uploads under max_allowed_packet
+TEST_RESULT_INSERT_CHUNK = 500
+
+
+def insert_test_result_rows(db_cursor, rows):
+    # executemany folds an INSERT ... VALUES into a single multi-row statement
+    for start in range(0, len(rows), TEST_RESULT_INSERT_CHUNK):
+        db_cursor.executemany(TEST_RESULT_INSERT, rows[start:start + TEST_RESULT_INSERT_CHUNK])
+
+
+def get_db_connection():
+    started = time.perf_counter()
+    conn = get_pool().acquire()
+    recorder = _query_observer() if _query_observer else None
+    if recorder is not None:
+        # Time spent waiting for (or opening) a connection
+        recorder.pool_wait(time.perf_counter() - started)
+    # Connections borrowed inside a request are tracked so they are returned at
+    # teardown even if the handler bails out early or raises.
+    if has_app_context():
+        g.setdefault('_db_connections', []).append(conn)
+    return conn
+
+
+def release_request_connections(exc=None):
+    for conn in g.pop('_db_connections', []):
+        conn.close()
+
+
+def init_app(app):
+    app.teardown_appcontext(release_request_connections)
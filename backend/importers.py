@@ -0,0 +1,291 @@
+import csv
+import io
+from datetime import datetime
+from itertools import islice
+
+from cache import commit_table_versions
+from database import insert_test_result_rows
+import rollups
+from reference_ranges import evaluate_result
+
+# Streaming loader for analyzer/LIS result files. Parsers yield one record per
+# result line, records are resolved against the catalog and patients in chunks,
+# and each chunk is committed on its own, so memory stays bounded by the chunk
+# size no matter how large the run file is.
+
+DEFAULT_CHUNK_SIZE = 500
+MAX_REPORTED_ERRORS = 1000
+
+CSV_COLUMNS = {
+    'patient_code': ('patient_code', 'patientcode', 'patient', 'sample_id', 'sample', 'pid'),
+    'code': ('test_code', 'code', 'analyte', 'assay', 'test', 'test_name'),
+    'value': ('value', 'result'),
+    'unit': ('unit', 'units'),
+    'normal_range': ('normal_range', 'reference_range', 'ref_range', 'range'),
+    'test_date': ('test_date', 'date', 'datetime', 'result_date', 'run_date'),
+}
+
+DATE_FORMATS = (
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d %H:%M',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%d',
+    '%d/%m/%Y %H:%M:%S',
+    '%d/%m/%Y %H:%M',
+    '%d/%m/%Y',
+)
+
+
+class ImportFormatError(Exception):
+    pass
+
+
+def parse_result_date(value):
+    if not value:
+        return None
+    value = value.strip()
+    # HL7 timestamps: YYYYMMDD[HHMM[SS]] with optional fraction/zone suffix
+    if value[:8].isdigit():
+        digits = ''.join(ch for ch in value[:14] if ch.isdigit())
+        for length, fmt in ((14, '%Y%m%d%H%M%S'), (12, '%Y%m%d%H%M'), (8, '%Y%m%d')):
+            if len(digits) >= length:
+                return datetime.strptime(digits[:length], fmt)
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    raise ValueError(f'Unrecognised date {value!r}')
+
+
+def _normalize_header(name):
+    return (name or '').strip().lower().replace(' ', '_').replace('-', '_')
+
+
+def iter_csv_records(stream):
+    reader = csv.reader(stream)
+    try:
+        header = [_normalize_header(name) for name in next(reader)]
+    except StopIteration:
+        return
+
+    positions = {}
+    for field, aliases in CSV_COLUMNS.items():
+        for alias in aliases:
+            if alias in header:
+                positions[field] = header.index(alias)
+                break
+    missing = [field for field in ('patient_code', 'code', 'value') if field not in positions]
+    if missing:
+        raise ImportFormatError(f'CSV header is missing required columns: {", ".join(missing)}')
+
+    for row in reader:
+        if not any(cell.strip() for cell in row):
+            continue
+        record = {'line': reader.line_num}
+        for field, position in positions.items():
+            record[field] = row[position].strip() if position < len(row) else ''
+        yield record
+
+
+def iter_hl7_records(stream):
+    # Minimal ORU^R01 reader: PID-3 carries the patient code, OBR-7 the
+    # observation time, and each OBX is one result (3 id, 5 value, 6 units,
+    # 7 reference range, 14 observation time).
+    patient_code = None
+    observed_at = None
+    for line_number, line in enumerate(stream, start=1):
+        segment = line.strip()
+        if not segment:
+            continue
+        fields = segment.split('|')
+        kind = fields[0]
+        if kind == 'MSH':
+            patient_code = None
+            observed_at = None
+        elif kind == 'PID':
+            patient_code = _component(fields, 3)
+        elif kind == 'OBR':
+            observed_at = _field(fields, 7) or None
+        elif kind == 'OBX':
+            yield {
+                'line': line_number,
+                'patient_code': patient_code or '',
+                'code': _component(fields, 3),
+                'name': _component(fields, 3, 1),
+                'value': _field(fields, 5),
+                'unit': _component(fields, 6),
+                'normal_range': _field(fields, 7),
+                'test_date': _field(fields, 14) or observed_at,
+            }
+
+
+def _field(fields, index):
+    return fields[index].strip() if index < len(fields) else ''
+
+
+def _component(fields, index, component=0):
+    parts = _field(fields, index).split('^')
+    return parts[component].strip() if component < len(parts) else ''
+
+
+PARSERS = {
+    'csv': iter_csv_records,
+    'hl7': iter_hl7_records,
+}
+
+
+def detect_format(filename, default='csv'):
+    lowered = (filename or '').lower()
+    if lowered.endswith(('.hl7', '.oru')):
+        return 'hl7'
+    if lowered.endswith('.csv'):
+        return 'csv'
+    return default
+
+
+def open_text(binary_stream, file_format):
+    # csv wants newline='' so quoted newlines survive; HL7 segments may be
+    # separated by bare CR, which universal newlines turns into line breaks.
+    newline = '' if file_format == 'csv' else None
+    return io.TextIOWrapper(binary_stream, encoding='utf-8-sig', errors='replace', newline=newline)
+
+
+class ImportReport:
+    def __init__(self):
+        self.records_read = 0
+        self.results_inserted = 0
+        self.records_skipped = 0
+        self.chunks_committed = 0
+        self.errors = []
+        self.errors_truncated = False
+
+    def add_error(self, line, error):
+        self.records_skipped += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'error': error})
+        else:
+            self.errors_truncated = True
+
+    def as_dict(self):
+        return {
+            'recordsRead': self.records_read,
+            'resultsInserted': self.results_inserted,
+            'recordsSkipped': self.records_skipped,
+            'chunksCommitted': self.chunks_committed,
+            'errors': self.errors,
+            'errorsTruncated': self.errors_truncated,
+        }
+
+
+class CatalogIndex:
+    # Analyzer codes are matched against test_catalog.analyzer_code first and
+    # the catalog test name second, both case-insensitively.
+
+    def __init__(self, db_cursor):
+        db_cursor.execute('''
+            SELECT name, category, subcategory, reference_range, unit, analyzer_code, price
+            FROM test_catalog
+        ''')
+        self.by_code = {}
+        self.by_name = {}
+        for name, category, subcategory, reference_range, unit, analyzer_code, price in db_cursor.fetchall():
+            entry = (name, category, subcategory, reference_range, unit, price)
+            if analyzer_code:
+                self.by_code.setdefault(analyzer_code.strip().lower(), entry)
+            self.by_name.setdefault(name.strip().lower(), entry)
+
+    def lookup(self, code, name=None):
+        for key in (code, name):
+            if key:
+                key = key.strip().lower()
+                entry = self.by_code.get(key) or self.by_name.get(key)
+                if entry:
+                    return entry
+        return None
+
+
+def _resolve_patients(db_cursor, codes, patients):
+    unknown = sorted({code for code in codes if code and code not in patients})
+    if not unknown:
+        return
+    placeholders = ', '.join(['%s'] * len(unknown))
+    db_cursor.execute(
+        f'SELECT patient_code, id, gender, age FROM patients WHERE patient_code IN ({placeholders})',
+        unknown
+    )
+    for patient_code, patient_id, gender, age in db_cursor.fetchall():
+        patients[patient_code] = (patient_id, gender, age)
+    for code in unknown:
+        patients.setdefault(code, None)
+
+
+def import_results(conn, records, chunk_size=DEFAULT_CHUNK_SIZE, notes=None, on_progress=None):
+    db_cursor = conn.cursor()
+    catalog = CatalogIndex(db_cursor)
+    # patient_code -> (id, gender, age), or None once known to be missing
+    patients = {}
+    report = ImportReport()
+    default_test_date = datetime.now()
+
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            break
+        report.records_read += len(chunk)
+        _resolve_patients(db_cursor, (record.get('patient_code') for record in chunk), patients)
+
+        rows = []
+        for record in chunk:
+            line = record.get('line')
+            patient = patients.get(record.get('patient_code'))
+            if not record.get('patient_code'):
+                report.add_error(line, 'Missing patient code')
+                continue
+            if patient is None:
+                report.add_error(line, f"Unknown patient code {record['patient_code']!r}")
+                continue
+            entry = catalog.lookup(record.get('code'), record.get('name'))
+            if entry is None:
+                report.add_error(line, f"No catalog test for analyzer code {record.get('code')!r}")
+                continue
+            if record.get('value', '') == '':
+                report.add_error(line, 'Missing result value')
+                continue
+            try:
+                test_date = parse_result_date(record.get('test_date')) or default_test_date
+            except ValueError as e:
+                report.add_error(line, str(e))
+                continue
+
+            patient_id, gender, age = patient
+            name, category, subcategory, catalog_range, catalog_unit, price = entry
+            normal_range = record.get('normal_range') or catalog_range
+            numeric_value, result_status = evaluate_result(record['value'], normal_range, gender, age)
+            rows.append((
+                patient_id,
+                category,
+                subcategory,
+                name,
+                record['value'],
+                normal_range,
+                record.get('unit') or catalog_unit,
+                test_date,
+                notes,
+                numeric_value,
+                result_status,
+                price
+            ))
+
+        if rows:
+            insert_test_result_rows(db_cursor, rows)
+            rollups.record_test_results(db_cursor, rows)
+            conn.commit()
+            commit_table_versions(conn, 'tests')
+            report.results_inserted += len(rows)
+            report.chunks_committed += 1
+        if on_progress:
+            on_progress(report)
+
+    return report
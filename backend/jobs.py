@@ -0,0 +1,400 @@
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+from database import get_db_connection
+
+# Background jobs for work too slow for a request thread. Endpoints insert a
+# row into `jobs` and return its id; `flask --app app run-worker` processes
+# claim queued rows with SELECT ... FOR UPDATE SKIP LOCKED (MySQL 8), so any
+# number of worker processes can share the table. Each worker runs up to
+# `concurrency` jobs at a time, heartbeats the rows it holds, and puts back
+# jobs whose worker died. Failed jobs are retried with exponential backoff
+# until max_attempts is reached.
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+TERMINAL_STATUSES = (SUCCEEDED, FAILED, CANCELLED)
+
+JOBS_DDL = '''
+    CREATE TABLE IF NOT EXISTS jobs (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        kind VARCHAR(64) NOT NULL,
+        status VARCHAR(16) NOT NULL DEFAULT 'queued',
+        payload LONGTEXT,
+        result LONGTEXT,
+        error TEXT,
+        progress_done INT NOT NULL DEFAULT 0,
+        progress_total INT,
+        progress_message VARCHAR(255),
+        attempts INT NOT NULL DEFAULT 0,
+        max_attempts INT NOT NULL DEFAULT 3,
+        cancel_requested TINYINT(1) NOT NULL DEFAULT 0,
+        run_after DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        locked_by VARCHAR(128),
+        heartbeat_at DATETIME,
+        created_by INT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        started_at DATETIME,
+        finished_at DATETIME
+    )
+'''
+
+JOB_COLUMNS = '''
+    id, kind, status, result, error, progress_done, progress_total, progress_message,
+    attempts, max_attempts, cancel_requested, created_by, created_at, started_at, finished_at
+'''
+
+DEFAULT_MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY = int(os.getenv('JOB_RETRY_BASE_DELAY', '30'))
+POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '1'))
+HEARTBEAT_INTERVAL = 15
+# A running job whose heartbeat is older than this belongs to a dead worker
+STALE_AFTER = int(os.getenv('JOB_STALE_AFTER', '120'))
+PROGRESS_INTERVAL = 1.0
+
+SPOOL_DIR = os.getenv('JOB_SPOOL_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'job_files')
+# Uploads and generated files are removed this long after they were written
+SPOOL_RETENTION = int(os.getenv('JOB_SPOOL_RETENTION', str(7 * 24 * 3600)))
+
+
+class JobFilesMissing(Exception):
+    pass
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobType:
+    __slots__ = ('func', 'max_attempts', 'submittable')
+
+    def __init__(self, func, max_attempts, submittable):
+        self.func = func
+        self.max_attempts = max_attempts
+        self.submittable = submittable
+
+
+HANDLERS = {}
+
+
+def job_handler(kind, max_attempts=DEFAULT_MAX_ATTEMPTS, submittable=False):
+    # Registers func(context, payload) -> JSON-serializable result. Submittable
+    # kinds may also be queued directly through POST /api/jobs.
+    def register(func):
+        HANDLERS[kind] = JobType(func, max_attempts, submittable)
+        return func
+    return register
+
+
+def enqueue(db_cursor, kind, payload=None, created_by=None):
+    # Uses the caller's cursor so the job commits together with the caller's
+    # own writes
+    if kind not in HANDLERS:
+        raise ValueError(f'Unknown job kind: {kind}')
+    db_cursor.execute(
+        'INSERT INTO jobs (kind, payload, max_attempts, created_by) VALUES (%s, %s, %s, %s)',
+        (kind, json.dumps(payload or {}), HANDLERS[kind].max_attempts, created_by)
+    )
+    return db_cursor.lastrowid
+
+
+def job_json(row):
+    (job_id, kind, status, result, error, progress_done, progress_total, progress_message,
+     attempts, max_attempts, cancel_requested, created_by, created_at, started_at, finished_at) = row
+    return {
+        'id': job_id,
+        'kind': kind,
+        'status': status,
+        'result': json.loads(result) if result else None,
+        'error': error,
+        'progress': {
+            'done': progress_done,
+            'total': progress_total,
+            'message': progress_message
+        },
+        'attempts': attempts,
+        'maxAttempts': max_attempts,
+        'cancelRequested': bool(cancel_requested),
+        'createdBy': created_by,
+        'createdAt': created_at.strftime('%Y-%m-%d %H:%M:%S') if created_at else None,
+        'startedAt': started_at.strftime('%Y-%m-%d %H:%M:%S') if started_at else None,
+        'finishedAt': finished_at.strftime('%Y-%m-%d %H:%M:%S') if finished_at else None
+    }
+
+
+def get_job(db_cursor, job_id):
+    db_cursor.execute(f'SELECT {JOB_COLUMNS} FROM jobs WHERE id = %s', (job_id,))
+    row = db_cursor.fetchone()
+    return job_json(row) if row else None
+
+
+def cancel_job(db_cursor, job_id):
+    # Queued jobs are cancelled outright; running ones are flagged and stop at
+    # their next progress report. Returns the resulting status, or None when
+    # the job has already finished.
+    db_cursor.execute(f'''
+        UPDATE jobs SET status = '{CANCELLED}', finished_at = NOW()
+        WHERE id = %s AND status = '{QUEUED}'
+    ''', (job_id,))
+    if db_cursor.rowcount:
+        return CANCELLED
+    db_cursor.execute(f'''
+        UPDATE jobs SET cancel_requested = 1
+        WHERE id = %s AND status = '{RUNNING}'
+    ''', (job_id,))
+    if db_cursor.rowcount:
+        return RUNNING
+    return None
+
+
+def retry_job(db_cursor, job_id):
+    # A failed job keeps its uploads until SPOOL_RETENTION prunes them; past
+    # that there is nothing left to rerun it on
+    db_cursor.execute(f'''
+        SELECT payload FROM jobs
+        WHERE id = %s AND status IN ('{FAILED}', '{CANCELLED}')
+    ''', (job_id,))
+    row = db_cursor.fetchone()
+    if row is None:
+        return False
+    payload = json.loads(row[0]) if row[0] else {}
+    if not all(os.path.exists(path) for path in payload.get('spoolFiles', ())):
+        raise JobFilesMissing('The uploaded file for this job has expired; upload it again')
+    db_cursor.execute(f'''
+        UPDATE jobs
+        SET status = '{QUEUED}', attempts = 0, cancel_requested = 0, error = NULL,
+            run_after = NOW(), started_at = NULL, finished_at = NULL
+        WHERE id = %s AND status IN ('{FAILED}', '{CANCELLED}')
+    ''', (job_id,))
+    return bool(db_cursor.rowcount)
+
+
+def spool_path(prefix, extension=''):
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    return os.path.join(SPOOL_DIR, f'{prefix}-{uuid.uuid4().hex}{extension}')
+
+
+def remove_spool_file(path):
+    # Only ever delete inside the spool directory
+    if path and os.path.dirname(os.path.abspath(path)) == os.path.abspath(SPOOL_DIR):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class JobContext:
+    def __init__(self, job_id, attempt):
+        self.job_id = job_id
+        self.attempt = attempt
+        self.done = 0
+        self._last_report = 0.0
+
+    def progress(self, done, total=None, message=None, force=False):
+        # Throttled to one write per PROGRESS_INTERVAL; each write also picks
+        # up a cancellation request
+        self.done = done
+        now = time.monotonic()
+        if not force and now - self._last_report < PROGRESS_INTERVAL:
+            return
+        self._last_report = now
+        conn = get_db_connection()
+        try:
+            db_cursor = conn.cursor()
+            db_cursor.execute('''
+                UPDATE jobs
+                SET progress_done = %s,
+                    progress_total = COALESCE(%s, progress_total),
+                    progress_message = COALESCE(%s, progress_message)
+                WHERE id = %s
+            ''', (done, total, message[:255] if message else None, self.job_id))
+            db_cursor.execute('SELECT cancel_requested FROM jobs WHERE id = %s', (self.job_id,))
+            row = db_cursor.fetchone()
+            conn.commit()
+        finally:
+            conn.close()
+        if row and row[0]:
+            raise JobCancelled()
+
+    def check_cancelled(self):
+        self.progress(self.done, force=True)
+
+
+class Worker:
+    def __init__(self, app, concurrency=None, poll_interval=POLL_INTERVAL, name=None):
+        self.app = app
+        self.concurrency = concurrency or int(os.getenv('JOB_CONCURRENCY', '2'))
+        self.poll_interval = poll_interval
+        self.name = name or f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}'
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for slot in range(self.concurrency):
+            thread = threading.Thread(target=self._run_slot, name=f'job-worker-{slot}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        thread = threading.Thread(target=self._maintain, name='job-heartbeat', daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        # Running jobs finish; nothing new is claimed
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def run_forever(self):
+        self.start()
+        try:
+            while not self._stop.wait(1):
+                pass
+        except KeyboardInterrupt:
+            self.stop()
+
+    def _run_slot(self):
+        while not self._stop.is_set():
+            try:
+                job = self._claim()
+            except Exception as e:
+                print(f'Job worker could not claim a job: {e}')
+                job = None
+            if job is None:
+                self._stop.wait(self.poll_interval)
+                continue
+            self._execute(*job)
+
+    def _claim(self):
+        conn = get_db_connection()
+        try:
+            db_cursor = conn.cursor()
+            db_cursor.execute(f'''
+                SELECT id, kind, payload, attempts FROM jobs
+                WHERE status = '{QUEUED}' AND run_after <= NOW()
+                ORDER BY run_after, id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            ''')
+            row = db_cursor.fetchone()
+            if row is None:
+                conn.rollback()
+                return None
+            job_id, kind, payload, attempts = row
+            # The status check keeps the claim atomic where the SELECT could
+            # not lock the row (SQLite has no FOR UPDATE)
+            db_cursor.execute(f'''
+                UPDATE jobs
+                SET status = '{RUNNING}', attempts = attempts + 1, locked_by = %s,
+                    heartbeat_at = NOW(), started_at = NOW()
+                WHERE id = %s AND status = '{QUEUED}'
+            ''', (self.name, job_id))
+            if db_cursor.rowcount != 1:
+                conn.rollback()
+                return None
+            conn.commit()
+            return job_id, kind, json.loads(payload or '{}'), attempts + 1
+        finally:
+            conn.close()
+
+    def _execute(self, job_id, kind, payload, attempt):
+        job_type = HANDLERS.get(kind)
+        context = JobContext(job_id, attempt)
+        try:
+            if job_type is None:
+                raise ValueError(f'No handler registered for job kind {kind!r}')
+            with self.app.app_context():
+                result = job_type.func(context, payload)
+        except JobCancelled:
+            self._finish(job_id, CANCELLED, error='Cancelled')
+        except Exception as e:
+            traceback.print_exc()
+            retry = job_type is not None and attempt < job_type.max_attempts
+            # Uploads stay (until pruned) so a failed job can be retried
+            self._finish(job_id, QUEUED if retry else FAILED, error=str(e) or e.__class__.__name__,
+                         delay=RETRY_BASE_DELAY * 2 ** (attempt - 1))
+        else:
+            self._finish(job_id, SUCCEEDED, result=result)
+            self._discard_files(payload)
+
+    def _finish(self, job_id, status, result=None, error=None, delay=0):
+        conn = get_db_connection()
+        try:
+            db_cursor = conn.cursor()
+            if status == QUEUED:
+                # Back off before the next attempt, unless a cancel came in
+                db_cursor.execute(f'''
+                    UPDATE jobs
+                    SET status = IF(cancel_requested, '{CANCELLED}', '{QUEUED}'),
+                        finished_at = IF(cancel_requested, NOW(), NULL),
+                        error = %s, locked_by = NULL, heartbeat_at = NULL,
+                        run_after = NOW() + INTERVAL %s SECOND
+                    WHERE id = %s AND locked_by = %s
+                ''', (error, delay, job_id, self.name))
+            else:
+                completed = ', progress_done = COALESCE(progress_total, progress_done)' if status == SUCCEEDED else ''
+                db_cursor.execute(f'''
+                    UPDATE jobs
+                    SET status = %s, result = %s, error = %s, locked_by = NULL,
+                        heartbeat_at = NULL, finished_at = NOW(){completed}
+                    WHERE id = %s AND locked_by = %s
+                ''', (status, json.dumps(result) if result is not None else None, error, job_id, self.name))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _discard_files(self, payload):
+        # Uploads staged for a job are only needed until it succeeds
+        for path in payload.get('spoolFiles', ()):
+            remove_spool_file(path)
+
+    def _maintain(self):
+        while not self._stop.wait(HEARTBEAT_INTERVAL):
+            try:
+                self._heartbeat()
+                prune_spool()
+            except Exception as e:
+                print(f'Job worker maintenance failed: {e}')
+
+    def _heartbeat(self):
+        conn = get_db_connection()
+        try:
+            db_cursor = conn.cursor()
+            db_cursor.execute(f'''
+                UPDATE jobs SET heartbeat_at = NOW()
+                WHERE locked_by = %s AND status = '{RUNNING}'
+            ''', (self.name,))
+            # Jobs held by workers that stopped heartbeating go back to the
+            # queue, or fail once they are out of attempts
+            db_cursor.execute(f'''
+                UPDATE jobs
+                SET status = IF(attempts < max_attempts AND NOT cancel_requested, '{QUEUED}',
+                                IF(cancel_requested, '{CANCELLED}', '{FAILED}')),
+                    finished_at = IF(attempts < max_attempts AND NOT cancel_requested, NULL, NOW()),
+                    error = 'Worker stopped responding', locked_by = NULL, heartbeat_at = NULL
+                WHERE status = '{RUNNING}' AND heartbeat_at < NOW() - INTERVAL %s SECOND
+            ''', (STALE_AFTER,))
+            conn.commit()
+        finally:
+            conn.close()
+
+
+def prune_spool():
+    if not os.path.isdir(SPOOL_DIR):
+        return
+    cutoff = time.time() - SPOOL_RETENTION
+    for name in os.listdir(SPOOL_DIR):
+        path = os.path.join(SPOOL_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
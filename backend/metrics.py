@@ -0,0 +1,259 @@
+import os
+import threading
+import time
+
+from flask import Response, g, has_app_context, request
+
+import database
+
+# Per-request instrumentation. Every request gets a RequestRecorder on `g`;
+# cursors handed out by the pool report statement time, fetch time and rows
+# to it (see database.TimedCursor), and get_db_connection reports how long the
+# pool took to produce a connection. When the request ends the totals feed
+# per-route histograms, exposed in the Prometheus text format on /metrics.
+#
+# Metrics live in process memory, so with several gunicorn workers each one
+# reports its own requests; scrape every worker or aggregate on the
+# Prometheus side.
+#
+# Requests slower than SLOW_REQUEST_MS are logged with their slowest
+# statements. Only the path and SQL text are logged, never query strings or
+# statement parameters, which carry patient data.
+
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', '500'))
+SLOW_REQUEST_STATEMENTS = 5
+SLOW_REQUEST_SQL_LENGTH = 400
+# Bearer token required on /metrics when set
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets, labelnames):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        # labels -> [count per bucket (non-cumulative), +Inf count, sum]
+        self._series = {}
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[position] += 1
+                    break
+            else:
+                series[len(self.buckets)] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((labels, list(values)) for labels, values in self._series.items())
+        for labels, values in series:
+            label_text = format_labels(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values[:-1]):
+                cumulative += count
+                bucket_labels = format_labels(list(zip(self.labelnames, labels)) + [('le', format_bound(bound))])
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{label_text} {values[-1]:.6f}')
+            lines.append(f'{self.name}_count{label_text} {cumulative}')
+        return lines
+
+
+def format_bound(bound):
+    return bound if isinstance(bound, str) else repr(float(bound))
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(pairs):
+    pairs = list(pairs)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+
+REQUEST_LABELS = ('method', 'route', 'status')
+ROUTE_LABELS = ('method', 'route')
+
+request_duration = Histogram(
+    'metacore_http_request_duration_seconds', 'Time from the start of the request to the response being returned',
+    LATENCY_BUCKETS, REQUEST_LABELS
+)
+request_db_time = Histogram(
+    'metacore_http_request_db_seconds', 'Time spent executing statements and fetching rows per request',
+    LATENCY_BUCKETS, ROUTE_LABELS
+)
+request_python_time = Histogram(
+    'metacore_http_request_python_seconds', 'Request time outside the database and the connection pool',
+    LATENCY_BUCKETS, ROUTE_LABELS
+)
+request_pool_wait = Histogram(
+    'metacore_http_request_pool_wait_seconds', 'Time spent obtaining database connections per request',
+    LATENCY_BUCKETS, ROUTE_LABELS
+)
+request_queries = Histogram(
+    'metacore_http_request_queries', 'Statements executed per request', COUNT_BUCKETS, ROUTE_LABELS
+)
+request_rows = Histogram(
+    'metacore_http_request_rows_fetched', 'Rows fetched from the database per request', ROW_BUCKETS, ROUTE_LABELS
+)
+response_size = Histogram(
+    'metacore_http_response_size_bytes', 'Response body size', BYTE_BUCKETS, ROUTE_LABELS
+)
+HISTOGRAMS = [
+    request_duration, request_db_time, request_python_time, request_pool_wait,
+    request_queries, request_rows, response_size
+]
+
+# Reported from ConnectionPool.stats() at scrape time
+POOL_METRICS = [
+    ('metacore_db_pool_open_connections', 'gauge', 'open', 'Open database connections'),
+    ('metacore_db_pool_idle_connections', 'gauge', 'idle', 'Idle database connections in the pool'),
+    ('metacore_db_pool_checked_out_connections', 'gauge', 'checkedOut', 'Database connections currently borrowed'),
+    ('metacore_db_pool_checkouts_total', 'counter', 'checkouts', 'Connections handed out by the pool'),
+    ('metacore_db_pool_connections_created_total', 'counter', 'connectionsCreated', 'Database connections opened'),
+    ('metacore_db_pool_waits_total', 'counter', 'waits', 'Checkouts that had to wait for a free connection'),
+    ('metacore_db_pool_wait_seconds_total', 'counter', 'waitTimeTotal', 'Seconds spent waiting for a free connection'),
+    ('metacore_db_pool_timeouts_total', 'counter', 'timeouts', 'Checkouts that timed out'),
+]
+
+_in_progress_lock = threading.Lock()
+_in_progress = 0
+
+
+class RequestRecorder:
+    __slots__ = ('started', 'db_time', 'pool_wait_time', 'queries', 'rows', 'statements')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db_time = 0.0
+        self.pool_wait_time = 0.0
+        self.queries = 0
+        self.rows = 0
+        # (seconds, sql) per statement, for the slow request log
+        self.statements = []
+
+    def query(self, sql, seconds):
+        self.db_time += seconds
+        self.queries += 1
+        self.statements.append((seconds, sql))
+
+    def fetch(self, rows, seconds):
+        self.db_time += seconds
+        self.rows += rows
+
+    def pool_wait(self, seconds):
+        self.pool_wait_time += seconds
+
+
+def current_recorder():
+    if not has_app_context():
+        return None
+    return g.get('_request_recorder')
+
+
+def route_label():
+    # The URL rule rather than the path, so ids do not create new series
+    rule = request.url_rule
+    return rule.rule if rule is not None else 'unmatched'
+
+
+def compact_sql(sql):
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace')
+    sql = ' '.join(str(sql).split())
+    if len(sql) > SLOW_REQUEST_SQL_LENGTH:
+        sql = sql[:SLOW_REQUEST_SQL_LENGTH] + '...'
+    return sql
+
+
+def log_slow_request(logger, recorder, method, route, status, duration, size):
+    lines = [
+        f'Slow request: {method} {request.path} ({route}) -> {status} in {duration * 1000:.0f}ms; '
+        f'db {recorder.db_time * 1000:.0f}ms over {recorder.queries} queries, {recorder.rows} rows, '
+        f'pool wait {recorder.pool_wait_time * 1000:.0f}ms, {size if size is not None else "?"} bytes'
+    ]
+    for seconds, sql in sorted(recorder.statements, key=lambda statement: statement[0], reverse=True)[:SLOW_REQUEST_STATEMENTS]:
+        lines.append(f'  {seconds * 1000:8.1f}ms  {compact_sql(sql)}')
+    logger.warning('\n'.join(lines))
+
+
+def render_metrics():
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+
+    lines.append('# HELP metacore_http_requests_in_progress Requests currently being handled')
+    lines.append('# TYPE metacore_http_requests_in_progress gauge')
+    lines.append(f'metacore_http_requests_in_progress {_in_progress}')
+
+    pool = database.get_pool().stats()
+    for name, kind, key, help_text in POOL_METRICS:
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}', f'{name} {pool[key]}']
+    return '\n'.join(lines) + '\n'
+
+
+def init_app(app):
+    database.set_query_observer(current_recorder)
+
+    @app.before_request
+    def start_request_timer():
+        global _in_progress
+        g._request_recorder = RequestRecorder()
+        with _in_progress_lock:
+            _in_progress += 1
+
+    @app.after_request
+    def record_response(response):
+        g._response_status = response.status_code
+        # Streamed and file responses may not know their length up front
+        g._response_size = response.calculate_content_length()
+        return response
+
+    @app.teardown_request
+    def finish_request(exc=None):
+        global _in_progress
+        recorder = g.pop('_request_recorder', None)
+        if recorder is None:
+            return
+        with _in_progress_lock:
+            _in_progress -= 1
+
+        duration = time.perf_counter() - recorder.started
+        status = g.pop('_response_status', 500)
+        size = g.pop('_response_size', None)
+        method = request.method
+        route = route_label()
+        labels = (method, route)
+
+        request_duration.observe((method, route, str(status)), duration)
+        request_db_time.observe(labels, recorder.db_time)
+        request_pool_wait.observe(labels, recorder.pool_wait_time)
+        request_python_time.observe(labels, max(0.0, duration - recorder.db_time - recorder.pool_wait_time))
+        request_queries.observe(labels, recorder.queries)
+        request_rows.observe(labels, recorder.rows)
+        if size is not None:
+            response_size.observe(labels, size)
+
+        if SLOW_REQUEST_MS and duration * 1000 >= SLOW_REQUEST_MS:
+            log_slow_request(app.logger, recorder, method, route, status, duration, size)
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+            return Response('Unauthorized\n', status=401, mimetype='text/plain')
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
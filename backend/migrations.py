@@ -0,0 +1,513 @@
+import re
+
+from database import ensure_column, ensure_index, is_sqlite
+from cache import TABLE_VERSIONS_DDL
+from jobs import JOBS_DDL
+from patient_search import PATIENT_TRIGRAMS_DDL, index_patients, national_phone, normalize_phone
+from rollups import DAILY_STATS_DDL, rebuild as rebuild_daily_stats
+from sequences import PATIENT_CODE_PREFIX, SEQUENCES_DDL
+
+# Versioned schema migrations. Each migration runs once and is recorded in
+# schema_migrations; `flask --app app migrate` (or app start-up, unless
+# AUTO_MIGRATE=0) applies whatever is pending in order. MySQL commits DDL
+# implicitly, so a migration cannot be rolled back halfway: every step is
+# written to be safe to re-run (IF NOT EXISTS / ensure_* / type checks), and
+# a migration interrupted part-way simply runs again from the top. On SQLite
+# each migration runs in its own IMMEDIATE transaction instead, which both
+# serializes concurrent runners and makes it all-or-nothing.
+
+SCHEMA_MIGRATIONS_DDL = '''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INT PRIMARY KEY,
+        name VARCHAR(255) NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+'''
+
+# Serializes runners when several processes start at once
+MIGRATION_LOCK = 'metacore_schema_migrations'
+MIGRATION_LOCK_TIMEOUT = 60
+
+MIGRATIONS = []
+
+
+def migration(version, name):
+    def register(func):
+        MIGRATIONS.append((version, name, func))
+        MIGRATIONS.sort(key=lambda entry: entry[0])
+        return func
+    return register
+
+
+class MigrationError(Exception):
+    pass
+
+
+def column_type(db_cursor, table, column):
+    # (data_type, max length, nullable) or None when the column is missing
+    db_cursor.execute('''
+        SELECT DATA_TYPE, CHARACTER_MAXIMUM_LENGTH, IS_NULLABLE FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+    ''', (table, column))
+    row = db_cursor.fetchone()
+    if row is None:
+        return None
+    data_type, length, nullable = row
+    if isinstance(data_type, (bytes, bytearray)):
+        data_type = data_type.decode()
+    return data_type.lower(), length, nullable == 'YES'
+
+
+def ensure_varchar(db_cursor, table, column, length, nullable=False):
+    # Narrows TEXT columns (as created by the phpMyAdmin dump) to VARCHAR so
+    # they can be indexed in full. Refuses rather than truncating data.
+    if is_sqlite():
+        # Declared lengths mean nothing to SQLite and TEXT indexes in full
+        return False
+    current = column_type(db_cursor, table, column)
+    if current is None or (current[0] == 'varchar' and current[1] >= length):
+        return False
+    db_cursor.execute(f'SELECT COALESCE(MAX(CHAR_LENGTH({column})), 0) FROM {table}')
+    longest = db_cursor.fetchone()[0]
+    if longest > length:
+        raise MigrationError(
+            f'{table}.{column} has values of {longest} characters; '
+            f'shorten them or raise the limit of {length} before migrating'
+        )
+    db_cursor.execute(f'ALTER TABLE {table} MODIFY {column} VARCHAR({length}) {"NULL" if nullable else "NOT NULL"}')
+    return True
+
+
+@migration(1, 'baseline schema')
+def baseline(db_cursor):
+    # The tables as init_db() used to create them at import, plus the columns
+    # and indexes it added to existing databases
+    db_cursor.execute('''
+        CREATE TABLE IF NOT EXISTS patients (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            full_name VARCHAR(255) NOT NULL,
+            age INT NOT NULL,
+            gender VARCHAR(50) NOT NULL,
+            contact_number VARCHAR(50) NOT NULL,
+            email VARCHAR(255) NOT NULL,
+            patient_code VARCHAR(255) NOT NULL UNIQUE,
+            address TEXT NOT NULL,
+            ref_by VARCHAR(255),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    db_cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tests (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            patient_id INT NOT NULL,
+            test_category VARCHAR(255) NOT NULL,
+            test_subcategory VARCHAR(255) NOT NULL,
+            test_name VARCHAR(255) NOT NULL,
+            test_value TEXT NOT NULL,
+            normal_range TEXT,
+            unit VARCHAR(50),
+            test_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+            additional_note TEXT,
+            numeric_value DOUBLE,
+            result_status VARCHAR(16),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (patient_id) REFERENCES patients (id)
+        )
+    ''')
+    # Existing rows are filled in by `flask --app app backfill-test-status`
+    ensure_column(db_cursor, 'tests', 'numeric_value', 'DOUBLE NULL AFTER additional_note')
+    ensure_column(db_cursor, 'tests', 'result_status', 'VARCHAR(16) NULL AFTER numeric_value')
+
+    db_cursor.execute('''
+        CREATE TABLE IF NOT EXISTS lab_info (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            address TEXT NOT NULL,
+            phone VARCHAR(50) NOT NULL,
+            email VARCHAR(255) NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    db_cursor.execute('''
+        CREATE TABLE IF NOT EXISTS test_catalog (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            category VARCHAR(255) NOT NULL,
+            subcategory VARCHAR(255) NOT NULL,
+            price FLOAT,
+            reference_range TEXT,
+            unit VARCHAR(50),
+            analyzer_code VARCHAR(64),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Code the lab analyzers/LIS export for this test, used by result imports
+    ensure_column(db_cursor, 'test_catalog', 'analyzer_code', 'VARCHAR(64) NULL AFTER unit')
+
+    db_cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ref_doctors (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            specialization VARCHAR(255),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    db_cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reports (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            patient_id INT NOT NULL,
+            generated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (patient_id) REFERENCES patients (id)
+        )
+    ''')
+
+    db_cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            email VARCHAR(255) UNIQUE NOT NULL,
+            password VARCHAR(255) NOT NULL,
+            full_name VARCHAR(255),
+            phone VARCHAR(50),
+            role VARCHAR(50),
+            token_version INT NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Bumped whenever credentials change; tokens carrying an older version
+    # are rejected
+    ensure_column(db_cursor, 'users', 'token_version', 'INT NOT NULL DEFAULT 0 AFTER role')
+
+    # Per-table change counters used to validate cached responses
+    db_cursor.execute(TABLE_VERSIONS_DDL)
+
+    # Background job queue (see jobs.py)
+    db_cursor.execute(JOBS_DDL)
+    ensure_index(db_cursor, 'jobs', 'idx_jobs_claim', 'status, run_after, id')
+    ensure_index(db_cursor, 'jobs', 'idx_jobs_created', 'created_at')
+
+    # Indexes backing the paged/filtered patient listing. Prefix lengths keep
+    # these valid on the TEXT columns of databases imported from the SQL dump.
+    ensure_index(db_cursor, 'patients', 'idx_patients_created', 'created_at, id')
+    ensure_index(db_cursor, 'patients', 'idx_patients_full_name', 'full_name(64)')
+    ensure_index(db_cursor, 'patients', 'idx_patients_code', 'patient_code(32)')
+    ensure_index(db_cursor, 'patients', 'idx_patients_contact', 'contact_number(32)')
+    ensure_index(db_cursor, 'patients', 'idx_patients_ref_by', 'ref_by(64), created_at')
+
+    # Indexes backing the date-windowed analytics aggregates
+    ensure_index(db_cursor, 'tests', 'idx_tests_test_date', 'test_date')
+    ensure_index(db_cursor, 'tests', 'idx_tests_category_date', 'test_category(64), test_date')
+    ensure_index(db_cursor, 'reports', 'idx_reports_generated', 'generated_at')
+    ensure_index(db_cursor, 'tests', 'idx_tests_status_date', 'result_status, test_date')
+
+
+@migration(2, 'varchar columns for dump-imported tables')
+def varchar_columns(db_cursor):
+    # database/metacore_db.sql declares every string as TEXT; bring imported
+    # databases in line with the types the application creates
+    for table, column, length, nullable in (
+        ('patients', 'full_name', 255, False),
+        ('patients', 'gender', 50, False),
+        ('patients', 'contact_number', 50, False),
+        ('patients', 'email', 255, False),
+        ('patients', 'patient_code', 255, False),
+        ('patients', 'ref_by', 255, True),
+        ('tests', 'test_category', 255, False),
+        ('tests', 'test_subcategory', 255, False),
+        ('tests', 'test_name', 255, False),
+        ('tests', 'unit', 50, True),
+        ('test_catalog', 'name', 255, False),
+        ('test_catalog', 'category', 255, False),
+        ('test_catalog', 'subcategory', 255, False),
+        ('test_catalog', 'unit', 50, True),
+        ('ref_doctors', 'name', 255, False),
+        ('ref_doctors', 'specialization', 255, True),
+        ('lab_info', 'name', 255, False),
+        ('lab_info', 'phone', 50, False),
+        ('lab_info', 'email', 255, False),
+        ('users', 'email', 255, False),
+        ('users', 'password', 255, False),
+        ('users', 'full_name', 255, True),
+        ('users', 'phone', 50, True),
+        ('users', 'role', 50, True),
+    ):
+        ensure_varchar(db_cursor, table, column, length, nullable)
+
+
+@migration(3, 'composite indexes for report, catalog and listing queries')
+def hot_path_indexes(db_cursor):
+    # generate_report / fetch_report_tests: one patient's results in report
+    # order, read straight off the index with no filesort (MySQL 8 honours
+    # the DESC key part; older servers scan it backwards for that column)
+    ensure_index(db_cursor, 'tests', 'idx_tests_patient_report',
+                 'patient_id, test_category, test_subcategory, created_at DESC')
+    # get_test_categories walks the whole catalog in tree order
+    ensure_index(db_cursor, 'test_catalog', 'idx_test_catalog_tree', 'category, subcategory, name')
+    # get_recent_reports and per-patient report history
+    ensure_index(db_cursor, 'reports', 'idx_reports_patient_generated', 'patient_id, generated_at')
+
+
+@migration(4, 'patient code sequence')
+def patient_code_sequence(db_cursor):
+    # Continue numbering after the highest existing PAT code
+    db_cursor.execute(SEQUENCES_DDL)
+    db_cursor.execute('''
+        INSERT IGNORE INTO id_sequences (name, next_value)
+        SELECT 'patient_code', COALESCE(MAX(CAST(SUBSTRING(patient_code, %s) AS UNSIGNED)), 0) + 1
+        FROM patients
+        WHERE patient_code REGEXP %s
+    ''', (len(PATIENT_CODE_PREFIX) + 1, f'^{PATIENT_CODE_PREFIX}[0-9]+$'))
+
+
+
+@migration(5, 'keyset indexes for the test result listing')
+def test_listing_indexes(db_cursor):
+    # GET /api/tests pages newest first on (created_at, id), across the lab
+    # or within one patient; category and status filters ride the same walk
+    ensure_index(db_cursor, 'tests', 'idx_tests_created', 'created_at, id')
+    ensure_index(db_cursor, 'tests', 'idx_tests_patient_created', 'patient_id, created_at, id')
+
+
+@migration(6, 'daily analytics rollup')
+def daily_stats(db_cursor):
+    # Filled from history by migration 9, once results carry their price;
+    # write handlers keep it current from then on
+    db_cursor.execute(DAILY_STATS_DDL)
+
+
+@migration(7, 'per-patient result trend index')
+def trend_index(db_cursor):
+    # GET /api/patients/<id>/trends reads one patient's results for a few
+    # analytes in date order
+    ensure_index(db_cursor, 'tests', 'idx_tests_patient_trend', 'patient_id, test_name, test_date')
+
+
+# Rows per UPDATE batch when backfilling contact_digits
+CONTACT_DIGITS_BATCH = 1000
+
+
+@migration(8, 'patient search indexes')
+def patient_search_indexes(db_cursor):
+    # GET /api/patients/search: phone lookups match a prefix of the digits
+    # only, whatever punctuation the number was typed with
+    ensure_column(db_cursor, 'patients', 'contact_digits', 'VARCHAR(32) NULL AFTER contact_number')
+    last_id = 0
+    while True:
+        db_cursor.execute('''
+            SELECT id, contact_number FROM patients WHERE id > %s ORDER BY id LIMIT %s
+        ''', (last_id, CONTACT_DIGITS_BATCH))
+        rows = db_cursor.fetchall()
+        if not rows:
+            break
+        db_cursor.executemany('UPDATE patients SET contact_digits = %s WHERE id = %s',
+                              [(normalize_phone(contact_number), patient_id) for patient_id, contact_number in rows])
+        last_id = rows[-1][0]
+    ensure_index(db_cursor, 'patients', 'idx_patients_contact_digits', 'contact_digits')
+    # Name and address words; the ngram parser indexes bigrams, so partial
+    # words and names without spaces match too. SQLite deployments search
+    # patient_trigrams instead (migration 10)
+    if not is_sqlite():
+        ensure_index(db_cursor, 'patients', 'ft_patients_search', 'full_name, address',
+                     kind='FULLTEXT', options='WITH PARSER ngram')
+
+
+# Result ids per UPDATE when backfilling tests.price
+TEST_PRICE_BATCH = 10000
+
+
+@migration(9, 'price recorded on each test result')
+def test_result_prices(db_cursor):
+    # daily_stats revenue adds a result's price when it is recorded and
+    # subtracts the same amount when it is deleted, so the price has to live
+    # on the row. Existing rows take the current catalog price.
+    ensure_column(db_cursor, 'tests', 'price', 'DECIMAL(10, 2) NULL AFTER result_status')
+    db_cursor.execute('SELECT COALESCE(MAX(id), 0) FROM tests')
+    max_id = db_cursor.fetchone()[0]
+    for start in range(0, max_id, TEST_PRICE_BATCH):
+        db_cursor.execute('''
+            UPDATE tests SET price = (
+                SELECT MAX(c.price) FROM test_catalog c
+                WHERE c.category = tests.test_category AND c.subcategory = tests.test_subcategory
+                  AND c.name = tests.test_name
+            )
+            WHERE id > %s AND id <= %s AND price IS NULL
+        ''', (start, start + TEST_PRICE_BATCH))
+    rebuild_daily_stats(db_cursor)
+
+
+@migration(10, 'patient search trigram table')
+def patient_trigrams(db_cursor):
+    # SQLite's stand-in for the FULLTEXT index of migration 8, filled here
+    # and maintained by the patient write handlers
+    if not is_sqlite():
+        return
+    db_cursor.execute(PATIENT_TRIGRAMS_DDL)
+    ensure_index(db_cursor, 'patient_trigrams', 'idx_patient_trigrams_patient', 'patient_id')
+    last_id = 0
+    while True:
+        db_cursor.execute('''
+            SELECT id, full_name, address FROM patients WHERE id > %s ORDER BY id LIMIT %s
+        ''', (last_id, CONTACT_DIGITS_BATCH))
+        rows = db_cursor.fetchall()
+        if not rows:
+            break
+        index_patients(db_cursor, rows)
+        last_id = rows[-1][0]
+
+
+@migration(11, 'national phone numbers for patient search')
+def patient_national_phones(db_cursor):
+    # A phone query also matches the number without its country code, which
+    # contact_digits keeps ('98765' for '+91 98765 43210')
+    ensure_column(db_cursor, 'patients', 'contact_national', 'VARCHAR(32) NULL AFTER contact_digits')
+    last_id = 0
+    while True:
+        db_cursor.execute('''
+            SELECT id, contact_number FROM patients WHERE id > %s ORDER BY id LIMIT %s
+        ''', (last_id, CONTACT_DIGITS_BATCH))
+        rows = db_cursor.fetchall()
+        if not rows:
+            break
+        db_cursor.executemany('UPDATE patients SET contact_national = %s WHERE id = %s',
+                              [(national_phone(contact_number), patient_id) for patient_id, contact_number in rows])
+        last_id = rows[-1][0]
+    ensure_index(db_cursor, 'patients', 'idx_patients_contact_national', 'contact_national')
+
+
+def migrate(conn, target=None, on_apply=None):
+    # Applies pending migrations up to `target` (all by default); returns the
+    # versions applied
+    if is_sqlite():
+        return _migrate_sqlite(conn, target, on_apply)
+    db_cursor = conn.cursor()
+    db_cursor.execute('SELECT GET_LOCK(%s, %s)', (MIGRATION_LOCK, MIGRATION_LOCK_TIMEOUT))
+    if not db_cursor.fetchone()[0]:
+        raise MigrationError('Timed out waiting for another migration run to finish')
+    try:
+        db_cursor.execute(SCHEMA_MIGRATIONS_DDL)
+        db_cursor.execute('SELECT version FROM schema_migrations')
+        applied = {row[0] for row in db_cursor.fetchall()}
+
+        newly_applied = []
+        for version, name, func in MIGRATIONS:
+            if version in applied or (target is not None and version > target):
+                continue
+            func(db_cursor)
+            db_cursor.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s)', (version, name))
+            conn.commit()
+            newly_applied.append(version)
+            if on_apply:
+                on_apply(version, name)
+        return newly_applied
+    finally:
+        db_cursor.execute('SELECT RELEASE_LOCK(%s)', (MIGRATION_LOCK,))
+        db_cursor.fetchone()
+
+
+def _migrate_sqlite(conn, target, on_apply):
+    db_cursor = conn.cursor()
+    db_cursor.execute(SCHEMA_MIGRATIONS_DDL)
+    conn.commit()
+
+    newly_applied = []
+    for version, name, func in MIGRATIONS:
+        if target is not None and version > target:
+            break
+        # Takes the write lock up front; another process migrating holds it
+        # until its migration commits, and is re-checked below
+        db_cursor.execute('BEGIN IMMEDIATE')
+        try:
+            db_cursor.execute('SELECT 1 FROM schema_migrations WHERE version = %s', (version,))
+            if db_cursor.fetchone():
+                conn.rollback()
+                continue
+            func(db_cursor)
+            db_cursor.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s)', (version, name))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        newly_applied.append(version)
+        if on_apply:
+            on_apply(version, name)
+    return newly_applied
+
+
+def migration_status(db_cursor):
+    db_cursor.execute(SCHEMA_MIGRATIONS_DDL)
+    db_cursor.execute('SELECT version, applied_at FROM schema_migrations')
+    applied = dict(db_cursor.fetchall())
+    return [(version, name, applied.get(version)) for version, name, _ in MIGRATIONS]
+
+
+def explain_uses_index(dict_cursor, sql, params, expected):
+    # EXPLAIN a query (with a dictionary cursor) and check each table alias in
+    # `expected` is read via one of the listed indexes. Returns a list of
+    # (alias, ok, detail).
+    if is_sqlite():
+        plan = _sqlite_plan(dict_cursor, sql, params)
+    else:
+        dict_cursor.execute(f'EXPLAIN {sql}', params)
+        plan = {row['table']: row for row in dict_cursor.fetchall()}
+    findings = []
+    for alias, indexes in expected.items():
+        row = plan.get(alias)
+        if row is None:
+            findings.append((alias, False, 'table not in plan'))
+            continue
+        key = row.get('key')
+        extra = row.get('Extra') or ''
+        if key is not None and key in indexes:
+            detail = f"{row['type']} via {key}"
+            if 'filesort' in extra:
+                detail += ' (with filesort)'
+            findings.append((alias, True, detail))
+        elif key is None and None in indexes:
+            findings.append((alias, True, 'full scan (reads the whole table)'))
+        elif row['type'] == 'ALL' and any(index and index in (row.get('possible_keys') or '') for index in indexes):
+            # Chosen scan despite a usable index: expected on very small tables
+            findings.append((alias, True, f"full scan, {row['possible_keys']} usable once the table grows"))
+        else:
+            findings.append((alias, False, f"{row['type']} via {key or 'no index'}"))
+    return findings
+
+
+_PLAN_STEP = re.compile(r'^(SEARCH|SCAN) (\w+)(?: USING (?:COVERING )?INDEX (\w+)| USING INTEGER PRIMARY KEY)?')
+
+
+def _sqlite_plan(dict_cursor, sql, params):
+    # EXPLAIN QUERY PLAN rows reshaped like MySQL's EXPLAIN: a key per table
+    # alias (PRIMARY for rowid and primary key lookups, the column name for the
+    # automatic index behind a UNIQUE column, as MySQL names them), type ALL for a
+    # full scan and "filesort" when SQLite sorts in a temporary b-tree
+    dict_cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+    steps = [row['detail'] for row in dict_cursor.fetchall()]
+    plan = {}
+    for detail in steps:
+        match = _PLAN_STEP.match(detail)
+        if not match:
+            continue
+        operation, alias, index = match.groups()
+        if 'INTEGER PRIMARY KEY' in detail:
+            key = 'PRIMARY'
+        elif index and index.startswith('sqlite_autoindex_'):
+            dict_cursor.execute('SELECT tbl_name FROM sqlite_master WHERE name = %s', (index,))
+            dict_cursor.execute(f"PRAGMA index_list({dict_cursor.fetchone()['tbl_name']})")
+            if any(row['name'] == index and row['origin'] == 'pk' for row in dict_cursor.fetchall()):
+                # A composite PRIMARY KEY on a table without an integer rowid key
+                key = 'PRIMARY'
+            else:
+                dict_cursor.execute(f'PRAGMA index_info({index})')
+                key = dict_cursor.fetchone()['name']
+        else:
+            key = index
+        plan[alias] = {
+            'table': alias,
+            'key': key,
+            'type': 'ALL' if operation == 'SCAN' and key is None else operation.lower(),
+            'possible_keys': '',
+            'Extra': 'Using filesort' if any('TEMP B-TREE' in step for step in steps) else ''
+        }
+    return plan
@@ -0,0 +1,66 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+# Password hashing off the request path. bcrypt releases the GIL while it
+# works, so a small thread pool hashes in parallel while the number of hashes
+# in flight stays bounded: a burst of logins queues here (or is turned away
+# once the queue is full) instead of saturating every CPU the API needs.
+
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS') or 12)
+HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS') or 0) or min(4, os.cpu_count() or 1)
+# Hash requests allowed to wait for a worker before new ones are refused
+HASH_QUEUE_SIZE = int(os.getenv('PASSWORD_HASH_QUEUE') or 64)
+HASH_QUEUE_TIMEOUT = float(os.getenv('PASSWORD_HASH_QUEUE_TIMEOUT') or 5)
+
+
+class HashingBusy(Exception):
+    pass
+
+
+_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='bcrypt')
+_slots = threading.BoundedSemaphore(HASH_WORKERS + HASH_QUEUE_SIZE)
+
+
+def _run(func, *args):
+    if not _slots.acquire(timeout=HASH_QUEUE_TIMEOUT):
+        raise HashingBusy('Too many password operations in progress, try again shortly')
+    try:
+        return _executor.submit(func, *args).result()
+    finally:
+        _slots.release()
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check(password, hashed):
+    try:
+        return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    except ValueError:
+        # Not a bcrypt hash
+        return False
+
+
+def hash_password(password, rounds=None):
+    return _run(_hash, password, rounds or BCRYPT_ROUNDS)
+
+
+def check_password(password, hashed):
+    return _run(_check, password, hashed)
+
+
+def hash_rounds(hashed):
+    # '$2b$12$...' -> 12
+    try:
+        return int(hashed.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+def needs_rehash(hashed):
+    rounds = hash_rounds(hashed)
+    return rounds is None or rounds < BCRYPT_ROUNDS
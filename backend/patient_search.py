@@ -0,0 +1,250 @@
+import math
+import re
+import unicodedata
+
+from database import is_sqlite, like_prefix
+from sequences import format_patient_code
+
+# Front-desk patient lookup. A query is matched three ways and the results
+# merged by score:
+#
+#   code   exact patient code (or just its number), then code prefix
+#   phone  prefix of the digits of contact_number (patients.contact_digits)
+#          or of its national number (patients.contact_national), so
+#          '98765' finds '+91 98765 43210' and '01711' finds '+880 1711 ...'
+#   name   words in full_name or address; MySQL uses the ngram FULLTEXT
+#          index, SQLite the patient_trigrams table (below), which the
+#          patient write handlers keep current row by row
+#
+# Scores are comparable across the three: an exact code beats a code prefix,
+# which beats a phone prefix, which beats any name match (0..1).
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+MIN_QUERY_LENGTH = 2
+# Shortest digit run treated as a phone number prefix
+MIN_PHONE_DIGITS = 3
+# Name candidates considered before merging, per match type
+CANDIDATES = 200
+
+EXACT_CODE_SCORE = 4.0
+CODE_PREFIX_SCORE = 3.0
+PHONE_PREFIX_SCORE = 2.0
+# Added to a name match when the name starts with the query
+NAME_PREFIX_BONUS = 0.5
+# Address hits rank below name hits of the same quality
+ADDRESS_WEIGHT = 0.6
+# Minimum share of the query's trigrams a SQLite name match must contain
+MIN_TRIGRAM_SIMILARITY = 0.5
+
+# SQLite has no FULLTEXT with partial-word matching, so trigrams of each
+# patient's normalized name ('n') and address ('a') are stored here
+PATIENT_TRIGRAMS_DDL = '''
+    CREATE TABLE IF NOT EXISTS patient_trigrams (
+        trigram VARCHAR(3) NOT NULL,
+        field CHAR(1) NOT NULL,
+        patient_id INT NOT NULL,
+        PRIMARY KEY (trigram, field, patient_id)
+    )
+'''
+NAME_FIELD = 'n'
+ADDRESS_FIELD = 'a'
+
+_NON_DIGITS = re.compile(r'\D+')
+_NON_WORD = re.compile(r'[\W_]+')
+_CODE_QUERY = re.compile(r'^[A-Z]+\d*$')
+_PHONE_QUERY = re.compile(r'^[\d\s+()./-]+$')
+
+# ITU country calling codes are prefix-free: 1 and 7 are the only one-digit
+# codes, these are the two-digit ones, and every other code has three digits
+_TWO_DIGIT_CALLING_CODES = frozenset((
+    '20', '27', '30', '31', '32', '33', '34', '36', '39', '40', '41', '43', '44', '45', '46', '47',
+    '48', '49', '51', '52', '53', '54', '55', '56', '57', '58', '60', '61', '62', '63', '64', '65',
+    '66', '81', '82', '84', '86', '90', '91', '92', '93', '94', '95', '98'
+))
+
+
+def normalize_phone(value):
+    # Stored in patients.contact_digits
+    digits = _NON_DIGITS.sub('', value or '')
+    return digits[:32] or None
+
+
+def national_phone(value):
+    # Stored in patients.contact_national: the number without its country
+    # code ('+' or '00' form) or trunk zero, so the international and local
+    # spellings of one number index alike
+    text = (value or '').strip()
+    digits = _NON_DIGITS.sub('', text)
+    if text.startswith('+') or digits.startswith('00'):
+        if not text.startswith('+'):
+            digits = digits[2:]
+        if digits[:1] in ('1', '7'):
+            digits = digits[1:]
+        elif digits[:2] in _TWO_DIGIT_CALLING_CODES:
+            digits = digits[2:]
+        else:
+            digits = digits[3:]
+    return digits.lstrip('0')[:32] or None
+
+
+def normalize_text(value):
+    # Case-folded, accents stripped, punctuation collapsed to single spaces
+    decomposed = unicodedata.normalize('NFKD', str(value or '').casefold())
+    stripped = ''.join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return _NON_WORD.sub(' ', stripped).strip()
+
+
+def trigrams(text):
+    # pg_trgm style: each word padded with two leading spaces and one trailing
+    grams = set()
+    for word in text.split():
+        padded = f'  {word} '
+        grams.update(padded[position:position + 3] for position in range(len(padded) - 2))
+    return grams
+
+
+def index_patients(db_cursor, rows):
+    # rows: (id, full_name, address). Replaces those patients' entries in
+    # patient_trigrams, in the caller's transaction; MySQL maintains its
+    # FULLTEXT index itself, so this is SQLite only
+    if not is_sqlite() or not rows:
+        return
+    unindex_patients(db_cursor, [row[0] for row in rows])
+    entries = []
+    for patient_id, full_name, address in rows:
+        entries.extend((gram, NAME_FIELD, patient_id) for gram in trigrams(normalize_text(full_name)))
+        entries.extend((gram, ADDRESS_FIELD, patient_id) for gram in trigrams(normalize_text(address)))
+    if entries:
+        db_cursor.executemany('INSERT INTO patient_trigrams (trigram, field, patient_id) VALUES (%s, %s, %s)',
+                              entries)
+
+
+def unindex_patients(db_cursor, patient_ids):
+    if not is_sqlite() or not patient_ids:
+        return
+    placeholders = ', '.join(['%s'] * len(patient_ids))
+    db_cursor.execute(f'DELETE FROM patient_trigrams WHERE patient_id IN ({placeholders})', list(patient_ids))
+
+
+def _trigram_matches(db_cursor, query, limit):
+    # Candidates sharing at least MIN_TRIGRAM_SIMILARITY of the query's
+    # trigrams with the name or the address, each walked off the primary key
+    text = normalize_text(query)
+    grams = sorted(trigrams(text))
+    if not grams:
+        return []
+    placeholders = ', '.join(['%s'] * len(grams))
+    db_cursor.execute(f'''
+        SELECT patient_id, field, COUNT(*) AS shared
+        FROM patient_trigrams
+        WHERE trigram IN ({placeholders})
+        GROUP BY patient_id, field
+        HAVING COUNT(*) >= %s
+        ORDER BY shared DESC, patient_id
+        LIMIT %s
+    ''', grams + [math.ceil(len(grams) * MIN_TRIGRAM_SIMILARITY), limit])
+    candidates = db_cursor.fetchall()
+    names = {}
+    name_ids = sorted({patient_id for patient_id, field, _ in candidates if field == NAME_FIELD})
+    if name_ids:
+        placeholders = ', '.join(['%s'] * len(name_ids))
+        db_cursor.execute(f'SELECT id, full_name FROM patients WHERE id IN ({placeholders})', name_ids)
+        names = {patient_id: normalize_text(full_name) for patient_id, full_name in db_cursor.fetchall()}
+    matches = []
+    for patient_id, field, shared in candidates:
+        similarity = shared / len(grams)
+        if field == ADDRESS_FIELD:
+            matches.append((patient_id, similarity * ADDRESS_WEIGHT, 'address'))
+        elif patient_id in names:
+            bonus = NAME_PREFIX_BONUS if names[patient_id].startswith(text) else 0.0
+            matches.append((patient_id, similarity + bonus, 'name'))
+    return matches
+
+
+def _fulltext_query(text):
+    # Every word required, each as a phrase so the ngram parser matches its
+    # bigrams in sequence; words shorter than a bigram cannot be matched
+    words = [word for word in text.split() if len(word) >= 2]
+    return ' '.join(f'+"{word}"' for word in words)
+
+
+def _fulltext_matches(db_cursor, query, limit):
+    text = normalize_text(query)
+    expression = _fulltext_query(text)
+    if not expression:
+        return []
+    db_cursor.execute('''
+        SELECT id, full_name, MATCH(full_name, address) AGAINST (%s IN BOOLEAN MODE) AS relevance
+        FROM patients
+        WHERE MATCH(full_name, address) AGAINST (%s IN BOOLEAN MODE)
+        ORDER BY relevance DESC
+        LIMIT %s
+    ''', (expression, expression, limit))
+    rows = db_cursor.fetchall()
+    if not rows:
+        return []
+    # Relevance is unbounded; scale it to 0..1 within this result set
+    top = max(row[2] for row in rows) or 1.0
+    words = text.split()
+    matches = []
+    for patient_id, full_name, relevance in rows:
+        name = normalize_text(full_name)
+        if all(word in name for word in words):
+            score = relevance / top + (NAME_PREFIX_BONUS if name.startswith(text) else 0.0)
+            matches.append((patient_id, score, 'name'))
+        else:
+            matches.append((patient_id, relevance / top * ADDRESS_WEIGHT, 'address'))
+    return matches
+
+
+def _code_matches(db_cursor, query, limit):
+    code = query.strip().upper()
+    if code.isdigit():
+        # Just the number: "1234" finds PAT001234
+        db_cursor.execute('SELECT id FROM patients WHERE patient_code = %s', (format_patient_code(int(code)),))
+        return [(patient_id, EXACT_CODE_SCORE, 'code') for (patient_id,) in db_cursor.fetchall()]
+    if not _CODE_QUERY.match(code):
+        return []
+    db_cursor.execute('''
+        SELECT id, patient_code FROM patients WHERE patient_code LIKE %s ORDER BY patient_code LIMIT %s
+    ''', (like_prefix(code), limit))
+    return [
+        (patient_id, EXACT_CODE_SCORE if patient_code.upper() == code else CODE_PREFIX_SCORE, 'code')
+        for patient_id, patient_code in db_cursor.fetchall()
+    ]
+
+
+def _phone_matches(db_cursor, query, limit):
+    if not _PHONE_QUERY.match(query):
+        return []
+    digits = normalize_phone(query)
+    if not digits or len(digits) < MIN_PHONE_DIGITS:
+        return []
+    db_cursor.execute('SELECT id FROM patients WHERE contact_digits LIKE %s ORDER BY contact_digits LIMIT %s',
+                      (digits + '%', limit))
+    patient_ids = [patient_id for (patient_id,) in db_cursor.fetchall()]
+    national = national_phone(query)
+    if national and len(national) >= MIN_PHONE_DIGITS:
+        db_cursor.execute('SELECT id FROM patients WHERE contact_national LIKE %s ORDER BY contact_national LIMIT %s',
+                          (national + '%', limit))
+        patient_ids += [patient_id for (patient_id,) in db_cursor.fetchall()]
+    return [(patient_id, PHONE_PREFIX_SCORE, 'phone') for patient_id in dict.fromkeys(patient_ids)][:limit]
+
+
+def search(db_cursor, query, limit=DEFAULT_LIMIT):
+    # [(patient_id, score, match)] best first
+    best = {}
+    candidates = max(limit, CANDIDATES)
+    sources = [_code_matches(db_cursor, query, candidates), _phone_matches(db_cursor, query, candidates)]
+    if any(ch.isalpha() for ch in query):
+        if is_sqlite():
+            sources.append(_trigram_matches(db_cursor, query, candidates))
+        else:
+            sources.append(_fulltext_matches(db_cursor, query, candidates))
+    for matches in sources:
+        for patient_id, score, match in matches:
+            if score > best.get(patient_id, (0.0, None))[0]:
+                best[patient_id] = (score, match)
+    ranked = sorted(best.items(), key=lambda item: (-item[1][0], item[0]))[:limit]
+    return [(patient_id, score, match) for patient_id, (score, match) in ranked]
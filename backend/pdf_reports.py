@@ -0,0 +1,347 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+# Server-side rendering of patient reports to PDF. The writer below emits
+# plain PDF 1.4 using the built-in Helvetica fonts, so no rendering library is
+# needed. Rendered files are cached on disk under a key derived from everything
+# that appears on the page; a download only re-renders when that key changes.
+
+RENDERER_VERSION = 1
+
+PAGE_WIDTH = 595  # A4 in points
+PAGE_HEIGHT = 842
+MARGIN = 40
+LINE_HEIGHT = 14
+
+REGULAR = 'F1'
+BOLD = 'F2'
+
+# Column x offsets for the results table
+COLUMNS = (
+    ('Test', MARGIN),
+    ('Result', MARGIN + 200),
+    ('Unit', MARGIN + 280),
+    ('Reference Range', MARGIN + 345),
+    ('Status', MARGIN + 465),
+)
+
+
+def _escape(text):
+    encoded = str(text).encode('cp1252', errors='replace')
+    return encoded.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+
+
+def _text_width(text, size):
+    # Helvetica averages roughly half an em per character; close enough for
+    # truncating and wrapping table cells.
+    return len(text) * size * 0.5
+
+
+def _fit(text, width, size):
+    text = '' if text is None else str(text)
+    if _text_width(text, size) <= width:
+        return text
+    limit = max(1, int(width / (size * 0.5)) - 1)
+    return text[:limit] + '...'
+
+
+def _wrap(text, width, size):
+    words = str(text).split()
+    lines = []
+    current = ''
+    for word in words:
+        candidate = f'{current} {word}' if current else word
+        if current and _text_width(candidate, size) > width:
+            lines.append(current)
+            current = word
+        else:
+            current = candidate
+    if current:
+        lines.append(current)
+    return lines
+
+
+class PdfDocument:
+    def __init__(self):
+        self.pages = []
+        self.new_page()
+
+    def new_page(self):
+        self.pages.append([])
+
+    def text(self, x, y, text, font=REGULAR, size=10):
+        self.pages[-1].append(
+            b'BT /' + font.encode() + b' ' + str(size).encode() + b' Tf '
+            + f'{x:.1f} {y:.1f} Td ('.encode() + _escape(text) + b') Tj ET'
+        )
+
+    def line(self, x1, y1, x2, y2, width=0.5):
+        self.pages[-1].append(f'{width} w {x1:.1f} {y1:.1f} m {x2:.1f} {y2:.1f} l S'.encode())
+
+    def render(self):
+        # Object layout: 1 catalog, 2 page tree, 3-4 fonts, then a page object
+        # and its content stream per page.
+        objects = []
+        page_ids = [5 + 2 * index for index in range(len(self.pages))]
+        objects.append(b'<< /Type /Catalog /Pages 2 0 R >>')
+        kids = b' '.join(f'{page_id} 0 R'.encode() for page_id in page_ids)
+        objects.append(b'<< /Type /Pages /Kids [' + kids + b'] /Count ' + str(len(self.pages)).encode() + b' >>')
+        objects.append(b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>')
+        objects.append(b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>')
+        for page_id, operations in zip(page_ids, self.pages):
+            objects.append(
+                f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] '
+                f'/Resources << /Font << /F1 3 0 R /F2 4 0 R >> >> /Contents {page_id + 1} 0 R >>'.encode()
+            )
+            stream = b'\n'.join(operations)
+            objects.append(b'<< /Length ' + str(len(stream)).encode() + b' >>\nstream\n' + stream + b'\nendstream')
+
+        output = bytearray(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(len(output))
+            output += f'{number} 0 obj\n'.encode() + body + b'\nendobj\n'
+        xref_offset = len(output)
+        output += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode()
+        for offset in offsets:
+            output += f'{offset:010d} 00000 n \n'.encode()
+        output += (
+            f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n'
+            f'startxref\n{xref_offset}\n%%EOF\n'
+        ).encode()
+        return bytes(output)
+
+
+class ReportLayout:
+    def __init__(self, lab, patient):
+        self.doc = PdfDocument()
+        self.lab = lab or {}
+        self.patient = patient
+        self.y = 0
+        self._start_page()
+
+    def _start_page(self):
+        self.y = PAGE_HEIGHT - MARGIN
+        doc = self.doc
+        doc.text(MARGIN, self.y - 6, self.lab.get('name') or 'Laboratory Report', BOLD, 16)
+        self.y -= 24
+        for detail in (self.lab.get('address'), ' | '.join(
+            value for value in (self.lab.get('phone'), self.lab.get('email')) if value
+        )):
+            if detail:
+                doc.text(MARGIN, self.y, _fit(detail, PAGE_WIDTH - 2 * MARGIN, 9), REGULAR, 9)
+                self.y -= 12
+        self.y -= 4
+        doc.line(MARGIN, self.y, PAGE_WIDTH - MARGIN, self.y, 1)
+        self.y -= 18
+
+        patient = self.patient
+        left = (
+            ('Patient', patient.full_name),
+            ('Patient Code', patient.patient_code),
+            ('Ref. By', patient.ref_by or '-'),
+        )
+        right = (
+            ('Age / Gender', f'{patient.age} / {patient.gender}'),
+            ('Contact', patient.contact_number or '-'),
+            ('Generated', datetime.now().strftime('%Y-%m-%d %H:%M')),
+        )
+        for (left_label, left_value), (right_label, right_value) in zip(left, right):
+            doc.text(MARGIN, self.y, f'{left_label}:', BOLD, 10)
+            doc.text(MARGIN + 80, self.y, _fit(left_value, 180, 10), REGULAR, 10)
+            doc.text(MARGIN + 300, self.y, f'{right_label}:', BOLD, 10)
+            doc.text(MARGIN + 380, self.y, _fit(right_value, 135, 10), REGULAR, 10)
+            self.y -= LINE_HEIGHT
+        self.y -= 4
+        doc.line(MARGIN, self.y, PAGE_WIDTH - MARGIN, self.y, 1)
+        self.y -= 18
+
+    def _ensure_space(self, height):
+        if self.y - height < MARGIN + 20:
+            self.doc.new_page()
+            self._start_page()
+            return True
+        return False
+
+    def table_header(self):
+        self._ensure_space(LINE_HEIGHT * 2)
+        for label, x in COLUMNS:
+            self.doc.text(x, self.y, label, BOLD, 9)
+        self.y -= 4
+        self.doc.line(MARGIN, self.y, PAGE_WIDTH - MARGIN, self.y)
+        self.y -= 12
+
+    def heading(self, category, subcategory):
+        self._ensure_space(LINE_HEIGHT * 4)
+        self.y -= 4
+        self.doc.text(MARGIN, self.y, f'{category} - {subcategory}', BOLD, 11)
+        self.y -= LINE_HEIGHT + 2
+        self.table_header()
+
+    def result(self, test):
+        if self._ensure_space(LINE_HEIGHT):
+            self.table_header()
+        flagged = test.status not in ('Normal', None)
+        font = BOLD if flagged else REGULAR
+        cells = (
+            (test.test_name, 195),
+            (test.test_value, 75),
+            (test.unit, 60),
+            (test.normal_range, 115),
+            (test.status, 60),
+        )
+        for (value, width), (_, x) in zip(cells, COLUMNS):
+            self.doc.text(x, self.y, _fit(value if value is not None else '', width, 9), font, 9)
+        self.y -= LINE_HEIGHT
+
+    def note(self, text):
+        for line in _wrap(f'Note: {text}', PAGE_WIDTH - 2 * MARGIN, 9):
+            self._ensure_space(LINE_HEIGHT)
+            self.doc.text(MARGIN, self.y, line, REGULAR, 9)
+            self.y -= 12
+
+    def finish(self):
+        total = len(self.doc.pages)
+        for number, operations in enumerate(self.doc.pages, start=1):
+            operations.append(
+                b'BT /F1 8 Tf ' + f'{PAGE_WIDTH - MARGIN - 50:.1f} {MARGIN - 10:.1f} Td ('.encode()
+                + _escape(f'Page {number} of {total}') + b') Tj ET'
+            )
+        return self.doc.render()
+
+
+def render_report_pdf(lab, patient, tests):
+    # patient: a repository.Patient; tests: repository.TestResult rows already
+    # ordered by category and subcategory.
+    layout = ReportLayout(lab, patient)
+    current_group = None
+    notes = []
+    for test in tests:
+        group = (test.test_category, test.test_subcategory)
+        if group != current_group:
+            for note in notes:
+                layout.note(note)
+            notes = []
+            layout.heading(*group)
+            current_group = group
+        layout.result(test)
+        note = test.additional_note
+        if note and note not in notes:
+            notes.append(note)
+    for note in notes:
+        layout.note(note)
+    if current_group is None:
+        layout.doc.text(MARGIN, layout.y, 'No test results recorded.', REGULAR, 10)
+    return layout.finish()
+
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+# Below this many reports the cost of shipping work to other processes
+# outweighs rendering inline
+PARALLEL_RENDER_THRESHOLD = 4
+
+
+def _get_render_pool():
+    # Rendering is pure-Python CPU work, so batches go to worker processes.
+    # 'spawn' keeps the workers free of the parent's sockets and locks.
+    global _render_pool
+    if _render_pool is None:
+        with _render_pool_lock:
+            if _render_pool is None:
+                workers = int(os.getenv('REPORT_RENDER_WORKERS') or 0) or min(4, os.cpu_count() or 1)
+                _render_pool = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+    return _render_pool
+
+
+def _render_job(job):
+    return render_report_pdf(*job)
+
+
+def render_report_pdfs(jobs):
+    # jobs: (lab, patient, tests) tuples; returns PDFs in the same order
+    if len(jobs) < PARALLEL_RENDER_THRESHOLD:
+        return [render_report_pdf(*job) for job in jobs]
+    return list(_get_render_pool().map(_render_job, jobs, chunksize=8))
+
+
+REPORT_PATIENT_FIELDS = ('id', 'full_name', 'patient_code', 'age', 'gender', 'contact_number', 'ref_by')
+
+
+def report_cache_key(lab, patient, test_count, latest_test_id):
+    # Result rows are only inserted or deleted, so (count, max id) identifies
+    # the set on the report. Their statuses are rewritten in two places: a
+    # sex or age change (both part of the key) and backfill-test-status
+    # --all, which clears the cache. Patient and lab details are hashed in.
+    # Only patient fields printed on the page count, so editing e.g. the
+    # address does not force a re-render.
+    material = json.dumps({
+        'renderer': RENDERER_VERSION,
+        'lab': lab,
+        'patient': {field: getattr(patient, field) for field in REPORT_PATIENT_FIELDS},
+        'tests': [test_count, latest_test_id],
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class ReportPdfCache:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, patient_id, key):
+        return os.path.join(self.directory, str(patient_id), f'{key}.pdf')
+
+    def get(self, patient_id, key):
+        path = self.path(patient_id, key)
+        return path if os.path.exists(path) else None
+
+    def clear(self):
+        # Drop every cached render; they are re-rendered on next download
+        removed = 0
+        if not os.path.isdir(self.directory):
+            return removed
+        for patient_dir in os.listdir(self.directory):
+            path = os.path.join(self.directory, patient_dir)
+            if not os.path.isdir(path):
+                continue
+            for name in os.listdir(path):
+                if name.endswith('.pdf'):
+                    try:
+                        os.remove(os.path.join(path, name))
+                        removed += 1
+                    except OSError:
+                        pass
+        return removed
+
+    def put(self, patient_id, key, content):
+        path = self.path(patient_id, key)
+        patient_dir = os.path.dirname(path)
+        os.makedirs(patient_dir, exist_ok=True)
+        # Write to a temp file and rename so readers never see a partial PDF
+        fd, temp_path = tempfile.mkstemp(dir=patient_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as handle:
+                handle.write(content)
+            os.replace(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        # Older renders for this patient are superseded
+        for name in os.listdir(patient_dir):
+            if name.endswith('.pdf') and name != f'{key}.pdf':
+                try:
+                    os.remove(os.path.join(patient_dir, name))
+                except OSError:
+                    pass
+        return path
@@ -0,0 +1,71 @@
+import os
+import threading
+import time
+from collections import deque
+
+# Sliding-window counters kept in process memory. With several worker
+# processes each enforces its own window, so the effective limit is the
+# configured one times the number of processes.
+
+
+class RateLimiter:
+    def __init__(self, limit, window, max_keys=10000):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._hits = {}
+
+    def _recent(self, key, now):
+        hits = self._hits.get(key)
+        if hits is None:
+            return None
+        while hits and hits[0] <= now - self.window:
+            hits.popleft()
+        if not hits:
+            del self._hits[key]
+            return None
+        return hits
+
+    def retry_after(self, key):
+        # Seconds until another hit is allowed, or 0 when under the limit
+        now = time.monotonic()
+        with self._lock:
+            hits = self._recent(key, now)
+            if hits is None or len(hits) < self.limit:
+                return 0
+            return max(1, int(hits[0] + self.window - now) + 1)
+
+    def hit(self, key):
+        now = time.monotonic()
+        with self._lock:
+            hits = self._recent(key, now)
+            if hits is None:
+                if len(self._hits) >= self.max_keys:
+                    self._prune(now)
+                hits = self._hits[key] = deque()
+            hits.append(now)
+
+    def reset(self, key):
+        with self._lock:
+            self._hits.pop(key, None)
+
+    def _prune(self, now):
+        for key in list(self._hits):
+            self._recent(key, now)
+        # Still full: drop the keys idle the longest
+        if len(self._hits) >= self.max_keys:
+            for key in sorted(self._hits, key=lambda key: self._hits[key][-1])[:len(self._hits) // 10 + 1]:
+                del self._hits[key]
+
+
+# Every login attempt from an address costs a bcrypt hash
+login_ip_limiter = RateLimiter(
+    int(os.getenv('LOGIN_RATE_IP_LIMIT', '30')),
+    int(os.getenv('LOGIN_RATE_IP_WINDOW', '60'))
+)
+# Failed password checks per account (login and credential changes)
+login_account_limiter = RateLimiter(
+    int(os.getenv('LOGIN_RATE_ACCOUNT_LIMIT', '10')),
+    int(os.getenv('LOGIN_RATE_ACCOUNT_WINDOW', '900'))
+)
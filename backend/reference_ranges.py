@@ -0,0 +1,365 @@
+import re
+from functools import lru_cache
+
+# Reference ranges are free text typed into the test catalog ('13–16',
+# 'M: 13–16; F: 11.5–14.5', 'M 13-16 F 11.5-14.5', '<1.1', 'Up to 60',
+# 'Negative', 'Negative (<5)', '0.5-1.5 (Age >60: 0.7-2)', ...). Each distinct
+# string is compiled once into a ReferenceRange and cached, so classifying a
+# report only does float comparisons per row.
+#
+# A range that compiles to nothing (free text such as 'See comment') gives no
+# status. A range that does compile but has no branch for this patient, or
+# cannot be compared with this value, gives UNCLASSIFIED rather than passing
+# the result off as normal.
+
+NORMAL = 'Normal'
+LOW = 'Low'
+HIGH = 'High'
+ABNORMAL = 'Abnormal'
+UNCLASSIFIED = 'Unclassified'
+
+# Statuses that flag a result
+ABNORMAL_STATUSES = (LOW, HIGH, ABNORMAL)
+
+_NUM = r'-?\d[\d,]*(?:\.\d+)?|-?\.\d+'
+
+_DASHES = str.maketrans({'–': '-', '—': '-', '−': '-', '‐': '-'})
+
+_SEX_WORD = r'(?:males?|females?|men|women|man|woman|m|f)'
+
+# Split into branches on ';', '|' or newlines, on ',' or '/' only when the
+# next piece starts with a 'Label:' so thousands separators survive, and on
+# the space before a sex marker that follows a value ('M 10-20 F 5-8').
+_BRANCH_SPLIT = re.compile(
+    r'[;|\n]+|[,/](?=\s*[a-z][a-z0-9 .()<>=+\-]*:)'
+    rf'|(?<=[\d.)])\s+(?={_SEX_WORD}\b\s*:?\s*[<>\d.-])'
+)
+_LABELLED = re.compile(r'^\s*([a-z][a-z0-9 .()<>=+\-]*?)\s*:\s*(.+)$')
+_SEX_PREFIX = re.compile(rf'^({_SEX_WORD})\b\s*:?\s*(?=[<>\d.-])')
+# A labelled qualifier in brackets is a branch of its own:
+# '0.5-1.5 (Age >60: 0.7-2)' reads as '0.5-1.5; Age >60: 0.7-2'
+_BRACKETED_BRANCH = re.compile(r'\(([^():]*:[^()]*)\)')
+# 'Negative (<5)': a qualitative expectation with its numeric equivalent
+_ALTERNATIVE = re.compile(r'^(.*?)\s*\(([^()]*)\)$')
+
+_BETWEEN = re.compile(rf'^({_NUM})\s*(?:-|to)\s*({_NUM})')
+_UPPER = re.compile(
+    rf'^(<=|<|up\s*to|upto|below|less\s+than|not\s+more\s+than|max(?:imum)?|till)\s*:?\s*({_NUM})'
+)
+_LOWER = re.compile(
+    rf'^(>=|>|above|more\s+than|greater\s+than|not\s+less\s+than|min(?:imum)?|at\s+least)\s*:?\s*({_NUM})'
+)
+_VALUE = re.compile(rf'^\s*(?:[<>]=?)?\s*({_NUM})')
+
+_INCLUSIVE_UPPER = ('<=', 'up to', 'upto', 'not more than', 'max', 'maximum', 'till')
+_INCLUSIVE_LOWER = ('>=', 'not less than', 'min', 'minimum', 'at least')
+
+_AGE_BETWEEN = re.compile(r'(\d+(?:\.\d+)?)\s*(?:-|to)\s*(\d+(?:\.\d+)?)')
+_AGE_BOUND = re.compile(r'(<=|>=|<|>|above|below|over|under)\s*(\d+(?:\.\d+)?)')
+_AGE_LABELS = {
+    'newborn': (None, 1),
+    'neonate': (None, 1),
+    'infant': (None, 1),
+    'infants': (None, 1),
+    'child': (None, 18),
+    'children': (None, 18),
+    'paediatric': (None, 18),
+    'pediatric': (None, 18),
+    'adult': (18, None),
+    'adults': (18, None),
+    'elderly': (60, None),
+}
+_SEX_LABELS = {
+    'm': 'M', 'male': 'M', 'males': 'M', 'man': 'M', 'men': 'M',
+    'f': 'F', 'female': 'F', 'females': 'F', 'woman': 'F', 'women': 'F',
+}
+
+# Qualitative results are compared after folding common synonyms together.
+_QUALITATIVE = {
+    'negative': 'negative',
+    'nonreactive': 'negative',
+    'notdetected': 'negative',
+    'absent': 'negative',
+    'nil': 'negative',
+    'positive': 'positive',
+    'reactive': 'positive',
+    'detected': 'positive',
+    'present': 'positive',
+}
+
+
+def _number(text):
+    return float(text.replace(',', ''))
+
+
+def _fold(text):
+    return re.sub(r'[\s\-_]+', '', str(text).lower())
+
+
+def parse_numeric_value(value):
+    # Results are stored as text; most are plain numbers, so try float() first
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    match = _VALUE.match(str(value))
+    if not match:
+        return None
+    try:
+        return _number(match.group(1))
+    except ValueError:
+        return None
+
+
+class NumericRule:
+    __slots__ = ('low', 'low_inclusive', 'high', 'high_inclusive')
+
+    def __init__(self, low=None, high=None, low_inclusive=True, high_inclusive=True):
+        self.low = low
+        self.high = high
+        self.low_inclusive = low_inclusive
+        self.high_inclusive = high_inclusive
+
+    def classify(self, value):
+        number = parse_numeric_value(value)
+        if number is None:
+            return None
+        if self.low is not None:
+            if number < self.low or (number == self.low and not self.low_inclusive):
+                return LOW
+        if self.high is not None:
+            if number > self.high or (number == self.high and not self.high_inclusive):
+                return HIGH
+        return NORMAL
+
+    def __repr__(self):
+        low = '(' if not self.low_inclusive else '['
+        high = ')' if not self.high_inclusive else ']'
+        return f'NumericRule{low}{self.low}, {self.high}{high}'
+
+
+class QualitativeRule:
+    __slots__ = ('expected',)
+
+    def __init__(self, expected):
+        self.expected = expected
+
+    def classify(self, value):
+        if value is None or str(value).strip() == '':
+            return None
+        folded = _fold(value)
+        return NORMAL if _QUALITATIVE.get(folded, folded) == self.expected else ABNORMAL
+
+    def __repr__(self):
+        return f'QualitativeRule({self.expected!r})'
+
+
+class EitherRule:
+    # Numeric results are held to the numeric rule, text results to the
+    # qualitative one
+    __slots__ = ('qualitative', 'numeric')
+
+    def __init__(self, qualitative, numeric):
+        self.qualitative = qualitative
+        self.numeric = numeric
+
+    def classify(self, value):
+        if parse_numeric_value(value) is not None:
+            return self.numeric.classify(value)
+        return self.qualitative.classify(value)
+
+    def __repr__(self):
+        return f'EitherRule({self.qualitative!r}, {self.numeric!r})'
+
+
+class Branch:
+    __slots__ = ('sex', 'age_min', 'age_max', 'rule')
+
+    def __init__(self, rule, sex=None, age_min=None, age_max=None):
+        self.rule = rule
+        self.sex = sex
+        self.age_min = age_min
+        self.age_max = age_max
+
+    @property
+    def conditional(self):
+        return self.sex is not None or self.age_min is not None or self.age_max is not None
+
+    def applies(self, sex, age):
+        if self.sex is not None and self.sex != sex:
+            return False
+        if self.age_min is not None and (age is None or age < self.age_min):
+            return False
+        if self.age_max is not None and (age is None or age >= self.age_max):
+            return False
+        return True
+
+    def __repr__(self):
+        return f'Branch({self.rule!r}, sex={self.sex}, age=[{self.age_min}, {self.age_max}))'
+
+
+class ReferenceRange:
+    __slots__ = ('text', 'branches')
+
+    def __init__(self, text, branches):
+        self.text = text
+        self.branches = branches
+
+    def select(self, sex=None, age=None):
+        # The first matching conditional branch wins; an unconditional branch
+        # only applies when no sex/age-specific branch does.
+        fallback = None
+        for branch in self.branches:
+            if not branch.conditional:
+                if fallback is None:
+                    fallback = branch.rule
+            elif branch.applies(sex, age):
+                return branch.rule
+        return fallback
+
+    def classify(self, value, gender=None, age=None):
+        if not self.branches:
+            return None
+        if value is None or str(value).strip() == '':
+            return None
+        rule = self.select(normalize_sex(gender), age)
+        if rule is None:
+            return UNCLASSIFIED
+        return rule.classify(value) or UNCLASSIFIED
+
+    def __repr__(self):
+        return f'ReferenceRange({self.text!r}, {self.branches!r})'
+
+
+def normalize_sex(gender):
+    if not gender:
+        return None
+    return _SEX_LABELS.get(str(gender).strip().lower())
+
+
+def _parse_rule(text):
+    text = text.strip().rstrip('.').strip()
+    if not text:
+        return None
+
+    match = _ALTERNATIVE.match(text)
+    if match:
+        rules = [_parse_rule(match.group(1)), _parse_rule(match.group(2))]
+        qualitative = next((rule for rule in rules if isinstance(rule, QualitativeRule)), None)
+        numeric = next((rule for rule in rules if isinstance(rule, NumericRule)), None)
+        if qualitative and numeric:
+            return EitherRule(qualitative, numeric)
+        # Otherwise the brackets are a remark ('13-16 (g/dL)')
+        return rules[0] or rules[1]
+
+    match = _BETWEEN.match(text)
+    if match:
+        low, high = _number(match.group(1)), _number(match.group(2))
+        if low > high:
+            low, high = high, low
+        return NumericRule(low=low, high=high)
+
+    match = _UPPER.match(text)
+    if match:
+        operator = re.sub(r'\s+', ' ', match.group(1))
+        return NumericRule(high=_number(match.group(2)), high_inclusive=operator in _INCLUSIVE_UPPER)
+
+    match = _LOWER.match(text)
+    if match:
+        operator = re.sub(r'\s+', ' ', match.group(1))
+        return NumericRule(low=_number(match.group(2)), low_inclusive=operator in _INCLUSIVE_LOWER)
+
+    folded = _fold(text)
+    if folded in _QUALITATIVE:
+        return QualitativeRule(_QUALITATIVE[folded])
+    return None
+
+
+def _parse_condition(label):
+    sex = None
+    age_min = None
+    age_max = None
+
+    for word in re.findall(r'[a-z]+', label):
+        if word in _SEX_LABELS and sex is None:
+            sex = _SEX_LABELS[word]
+        elif word in _AGE_LABELS:
+            age_min, age_max = _AGE_LABELS[word]
+
+    # Explicit ages in the label ('Age 1-12 yrs', '>60y') override age words
+    match = _AGE_BETWEEN.search(label)
+    if match:
+        age_min, age_max = float(match.group(1)), float(match.group(2)) + 1
+    else:
+        match = _AGE_BOUND.search(label)
+        if match:
+            operator, bound = match.group(1), float(match.group(2))
+            if operator in ('>', 'above', 'over'):
+                age_min, age_max = bound + 1, None
+            elif operator == '>=':
+                age_min, age_max = bound, None
+            elif operator in ('<', 'below', 'under'):
+                age_min, age_max = None, bound
+            else:
+                age_min, age_max = None, bound + 1
+
+    return sex, age_min, age_max
+
+
+@lru_cache(maxsize=4096)
+def compile_range(text):
+    if text is None:
+        return ReferenceRange(text, [])
+    normalized = str(text).translate(_DASHES)
+    normalized = normalized.replace('≤', '<=').replace('≥', '>=').lower().strip()
+    if not normalized or normalized == 'none':
+        return ReferenceRange(text, [])
+    normalized = _BRACKETED_BRANCH.sub(r'; \1', normalized)
+
+    branches = []
+    for segment in _BRANCH_SPLIT.split(normalized):
+        segment = segment.strip()
+        if not segment:
+            continue
+
+        sex = age_min = age_max = None
+        labelled = _LABELLED.match(segment)
+        condition = _parse_condition(labelled.group(1)) if labelled else (None, None, None)
+        if condition != (None, None, None):
+            sex, age_min, age_max = condition
+            segment = labelled.group(2)
+        else:
+            sex_prefix = _SEX_PREFIX.match(segment)
+            if sex_prefix:
+                sex = _SEX_LABELS[sex_prefix.group(1)]
+                segment = segment[sex_prefix.end():]
+
+        rule = _parse_rule(segment)
+        if rule is not None:
+            branches.append(Branch(rule, sex=sex, age_min=age_min, age_max=age_max))
+
+    return ReferenceRange(text, branches)
+
+
+def classify(value, reference_range, gender=None, age=None):
+    return compile_range(reference_range).classify(value, gender, age)
+
+
+def classify_many(rows, gender=None, age=None):
+    # rows is an iterable of (value, reference_range) pairs for one patient;
+    # sex is normalized once and ranges come from the compiled cache
+    sex = normalize_sex(gender)
+    statuses = []
+    for value, reference_range in rows:
+        statuses.append(compile_range(reference_range).classify(value, sex, age))
+    return statuses
+
+
+def evaluate_result(value, reference_range, gender=None, age=None):
+    # (numeric_value, status) as persisted alongside a result row
+    return parse_numeric_value(value), classify(value, reference_range, gender, age)
+
@@ -0,0 +1,174 @@
+from collections import namedtuple
+
+from reference_ranges import compile_range
+
+# Row types and their API serializers, shared by the handlers, the report
+# endpoints and the PDF renderer. Rows are namedtuples (tuples with field
+# names, no per-instance dict), selected with the column lists below so a
+# driver row is already in field order: listings serialize the row tuples
+# directly and never build an intermediate dict per row.
+#
+# Serializers are generated once at import time from a (json key, field,
+# converter) spec into plain functions that index the tuple, so adding a
+# field to the API means adding one line to a spec here.
+#
+# Render jobs pickle these rows into worker processes, so the types must stay
+# at module level.
+
+Patient = namedtuple('Patient', (
+    'id', 'full_name', 'age', 'gender', 'contact_number', 'email', 'patient_code', 'address', 'ref_by',
+    'created_at'
+))
+
+# status is the persisted result_status, or the classification for rows
+# written before statuses were stored
+TestResult = namedtuple('TestResult', (
+    'id', 'patient_id', 'test_category', 'test_subcategory', 'test_name', 'test_value', 'normal_range', 'unit',
+    'additional_note', 'created_at', 'status'
+))
+
+CatalogEntry = namedtuple('CatalogEntry', (
+    'id', 'name', 'category', 'subcategory', 'reference_range', 'unit', 'price', 'analyzer_code'
+))
+
+Report = namedtuple('Report', ('patient', 'tests'))
+
+# Table columns behind each field, where the names differ
+_STORED_AS = {
+    TestResult: {'status': 'result_status'},
+}
+
+
+def columns(row_type, alias=None):
+    # SELECT list producing rows in row_type's field order
+    stored = _STORED_AS.get(row_type, {})
+    prefix = f'{alias}.' if alias else ''
+    return ', '.join(prefix + stored.get(field, field) for field in row_type._fields)
+
+
+PATIENT_COLUMNS = columns(Patient)
+TEST_RESULT_COLUMNS = columns(TestResult)
+CATALOG_ENTRY_COLUMNS = columns(CatalogEntry)
+
+
+def blank_if_none(value):
+    return '' if value is None else value
+
+
+def format_timestamp(value):
+    return value.strftime('%Y-%m-%d %H:%M:%S') if value else None
+
+
+def compile_serializer(row_type, spec, name):
+    # spec: (json key, field, converter or None) in output order
+    namespace = {}
+    items = []
+    for key, field, convert in spec:
+        value = f'row[{row_type._fields.index(field)}]'
+        if convert is not None:
+            namespace[f'_{field}'] = convert
+            value = f'_{field}({value})'
+        items.append(f'{key!r}: {value}')
+    source = f'def {name}(row):\n    return {{{", ".join(items)}}}\n'
+    exec(compile(source, f'<serializer {name}>', 'exec'), namespace)
+    return namespace[name]
+
+
+# GET /api/patients
+patient_json = compile_serializer(Patient, (
+    ('id', 'id', None),
+    ('fullName', 'full_name', None),
+    ('age', 'age', None),
+    ('gender', 'gender', None),
+    ('contactNumber', 'contact_number', None),
+    ('email', 'email', None),
+    ('patientCode', 'patient_code', None),
+    ('address', 'address', None),
+    ('refBy', 'ref_by', blank_if_none),
+    ('createdAt', 'created_at', None),
+), 'patient_json')
+
+# Report header, GET /api/reports/<id> and POST /api/reports/batch
+report_patient_json = compile_serializer(Patient, (
+    ('patientId', 'id', None),
+    ('patientName', 'full_name', None),
+    ('patientCode', 'patient_code', None),
+    ('patientAge', 'age', None),
+    ('patientGender', 'gender', None),
+    ('contactNumber', 'contact_number', None),
+    ('refBy', 'ref_by', None),
+), 'report_patient_json')
+
+test_result_json = compile_serializer(TestResult, (
+    ('id', 'id', None),
+    ('testCategory', 'test_category', None),
+    ('testSubcategory', 'test_subcategory', None),
+    ('testName', 'test_name', None),
+    ('testValue', 'test_value', None),
+    ('normalRange', 'normal_range', None),
+    ('unit', 'unit', None),
+    ('additionalNote', 'additional_note', None),
+    ('createdAt', 'created_at', format_timestamp),
+    ('status', 'status', None),
+), 'test_result_json')
+
+# Entries of the GET /api/tests/categories tree
+catalog_entry_json = compile_serializer(CatalogEntry, (
+    ('id', 'id', None),
+    ('name', 'name', None),
+    ('referenceRange', 'reference_range', None),
+    ('unit', 'unit', None),
+    ('price', 'price', None),
+    ('analyzerCode', 'analyzer_code', None),
+), 'catalog_entry_json')
+
+
+def report_json(report):
+    body = report_patient_json(report.patient)
+    body['tests'] = [test_result_json(test) for test in report.tests]
+    return body
+
+
+def make_test_result(row, gender, age):
+    # row: TEST_RESULT_COLUMNS values. Rows written before statuses were
+    # persisted are classified here; the compiled range comes from the cache,
+    # so this is no per-row parsing
+    test = TestResult._make(row)
+    if test.status:
+        return test
+    return test._replace(status=compile_range(test.normal_range).classify(test.test_value, gender, age) or 'Normal')
+
+
+def catalog_tree(rows):
+    # Catalog rows sorted by category, subcategory and name, grouped with
+    # dict lookups so each list is built in order
+    categories = {}
+    subcategories = {}
+    for row in rows:
+        entry = CatalogEntry._make(row)
+        tests = subcategories.get((entry.category, entry.subcategory))
+        if tests is None:
+            if entry.category not in categories:
+                categories[entry.category] = {'category': entry.category, 'subcategories': []}
+            tests = []
+            subcategories[(entry.category, entry.subcategory)] = tests
+            categories[entry.category]['subcategories'].append({'subcategory': entry.subcategory, 'tests': tests})
+        tests.append(catalog_entry_json(entry))
+    return list(categories.values())
+
+
+def fetch_report_tests(db_cursor, patients):
+    # Result rows for several patients (id -> Patient) in one query,
+    # classified and grouped per patient in report order
+    placeholders = ', '.join(['%s'] * len(patients))
+    db_cursor.execute(f'''
+        SELECT {TEST_RESULT_COLUMNS}
+        FROM tests
+        WHERE patient_id IN ({placeholders})
+        ORDER BY patient_id, test_category, test_subcategory, created_at DESC
+    ''', list(patients))
+    tests = {patient_id: [] for patient_id in patients}
+    for row in db_cursor.fetchall():
+        patient = patients[row[1]]
+        tests[patient.id].append(make_test_result(row, patient.gender, patient.age))
+    return tests
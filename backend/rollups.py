@@ -0,0 +1,213 @@
+from collections import defaultdict
+
+from database import is_sqlite
+
+# Pre-aggregated analytics: one daily_stats row per (day, test category,
+# ref doctor) holding the tests recorded (by test_date), their revenue,
+# patients registered and reports issued that day. Patient and report counts
+# carry an empty category. Revenue sums tests.price, the catalog price each
+# result was recorded at, so later catalog edits change neither the history
+# nor what a delete subtracts.
+#
+# Every write path that adds or removes tests, patients or reports applies
+# its deltas here in the same transaction, so the table always equals a
+# rebuild from the raw tables (`flask --app app rebuild-daily-stats`).
+#
+# Deltas are applied in key order so concurrent writers lock rows in the same
+# order and cannot deadlock one another.
+
+DAILY_STATS_DDL = '''
+    CREATE TABLE IF NOT EXISTS daily_stats (
+        stat_date DATE NOT NULL,
+        test_category VARCHAR(255) NOT NULL DEFAULT '',
+        ref_by VARCHAR(255) NOT NULL DEFAULT '',
+        tests INT NOT NULL DEFAULT 0,
+        revenue DECIMAL(14, 2) NOT NULL DEFAULT 0,
+        patients INT NOT NULL DEFAULT 0,
+        reports INT NOT NULL DEFAULT 0,
+        PRIMARY KEY (stat_date, test_category, ref_by)
+    )
+'''
+
+COUNTERS = ('tests', 'revenue', 'patients', 'reports')
+
+
+def _upsert_clause():
+    if is_sqlite():
+        return 'ON CONFLICT (stat_date, test_category, ref_by) DO UPDATE SET ' + ', '.join(
+            f'{column} = {column} + excluded.{column}' for column in COUNTERS
+        )
+    return 'ON DUPLICATE KEY UPDATE ' + ', '.join(
+        f'{column} = daily_stats.{column} + VALUES({column})' for column in COUNTERS
+    )
+
+
+def apply_deltas(db_cursor, deltas):
+    # deltas: {(day, category, ref_by): [tests, revenue, patients, reports]}
+    rows = [
+        (day, category, ref_by, *values)
+        for (day, category, ref_by), values in sorted(deltas.items())
+        if any(values)
+    ]
+    if not rows:
+        return
+    db_cursor.executemany(f'''
+        INSERT INTO daily_stats (stat_date, test_category, ref_by, {', '.join(COUNTERS)})
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        {_upsert_clause()}
+    ''', rows)
+
+
+def _new_deltas():
+    return defaultdict(lambda: [0, 0.0, 0, 0])
+
+
+def _day(value):
+    # test_date arrives as a datetime, a date or 'YYYY-MM-DD[ HH:MM:SS]' text
+    return str(value)[:10]
+
+
+def _today(db_cursor):
+    # The database clock, which stamps created_at and generated_at
+    db_cursor.execute('SELECT NOW()')
+    return _day(db_cursor.fetchone()[0])
+
+
+def _ref_doctors(db_cursor, patient_ids):
+    placeholders = ', '.join(['%s'] * len(patient_ids))
+    db_cursor.execute(f'SELECT id, ref_by FROM patients WHERE id IN ({placeholders})', list(patient_ids))
+    return {patient_id: ref_by or '' for patient_id, ref_by in db_cursor.fetchall()}
+
+
+def _add_tests(db_cursor, tests, sign):
+    # tests: (patient_id, category, test_date, price) tuples
+    if not tests:
+        return
+    ref_doctors = _ref_doctors(db_cursor, {test[0] for test in tests})
+    deltas = _new_deltas()
+    for patient_id, category, test_date, price in tests:
+        values = deltas[(_day(test_date), category, ref_doctors.get(patient_id, ''))]
+        values[0] += sign
+        values[1] += sign * float(price or 0)
+    apply_deltas(db_cursor, deltas)
+
+
+def record_test_results(db_cursor, rows):
+    # rows: as passed to database.insert_test_result_rows
+    _add_tests(db_cursor, [(row[0], row[1], row[7], row[11]) for row in rows], 1)
+
+
+def remove_test_result(db_cursor, test_id):
+    # Call before deleting the row
+    db_cursor.execute('SELECT patient_id, test_category, test_date, price FROM tests WHERE id = %s', (test_id,))
+    _add_tests(db_cursor, db_cursor.fetchall(), -1)
+
+
+def record_patient(db_cursor, ref_by):
+    # A patient registered now
+    apply_deltas(db_cursor, {(_today(db_cursor), '', ref_by or ''): [0, 0.0, 1, 0]})
+
+
+def record_reports(db_cursor, patient_ids):
+    # Reports issued now, one per entry in patient_ids
+    if not patient_ids:
+        return
+    ref_doctors = _ref_doctors(db_cursor, set(patient_ids))
+    today = _today(db_cursor)
+    deltas = _new_deltas()
+    for patient_id in patient_ids:
+        deltas[(today, '', ref_doctors.get(patient_id, ''))][3] += 1
+    apply_deltas(db_cursor, deltas)
+
+
+def _patient_contribution(db_cursor, patient_id):
+    # Everything one patient adds to daily_stats, without the ref doctor
+    contribution = defaultdict(lambda: [0, 0.0, 0, 0])
+    db_cursor.execute('''
+        SELECT DATE(t.test_date), t.test_category, COUNT(*), SUM(COALESCE(t.price, 0))
+        FROM tests t
+        WHERE t.patient_id = %s
+        GROUP BY DATE(t.test_date), t.test_category
+    ''', (patient_id,))
+    for day, category, tests, revenue in db_cursor.fetchall():
+        contribution[(_day(day), category)][:2] = [tests, float(revenue or 0)]
+    db_cursor.execute('SELECT DATE(created_at) FROM patients WHERE id = %s', (patient_id,))
+    for (day,) in db_cursor.fetchall():
+        contribution[(_day(day), '')][2] += 1
+    db_cursor.execute('''
+        SELECT DATE(generated_at), COUNT(*) FROM reports WHERE patient_id = %s GROUP BY DATE(generated_at)
+    ''', (patient_id,))
+    for day, reports in db_cursor.fetchall():
+        contribution[(_day(day), '')][3] += reports
+    return contribution
+
+
+def move_patient(db_cursor, patient_id, old_ref_by, new_ref_by):
+    # A patient's ref doctor changed: re-attribute their whole history
+    old_ref_by, new_ref_by = old_ref_by or '', new_ref_by or ''
+    if old_ref_by == new_ref_by:
+        return
+    deltas = _new_deltas()
+    for (day, category), values in _patient_contribution(db_cursor, patient_id).items():
+        deltas[(day, category, old_ref_by)] = [-value for value in values]
+        deltas[(day, category, new_ref_by)] = list(values)
+    apply_deltas(db_cursor, deltas)
+
+
+def remove_patient(db_cursor, patient_id, ref_by):
+    # Call before deleting the patient
+    deltas = _new_deltas()
+    for (day, category), values in _patient_contribution(db_cursor, patient_id).items():
+        deltas[(day, category, ref_by or '')] = [-value for value in values]
+    apply_deltas(db_cursor, deltas)
+
+
+def rebuild(db_cursor, start=None, end=None):
+    # Recompute [start, end) (dates; either may be None for open-ended) from
+    # the raw tables. Runs in the caller's transaction.
+    conditions = {'stat_date': [], 'test_date': [], 'created_at': [], 'generated_at': []}
+    params = {column: [] for column in conditions}
+    for column in conditions:
+        if start is not None:
+            conditions[column].append(f'{column} >= %s')
+            params[column].append(start)
+        if end is not None:
+            conditions[column].append(f'{column} < %s')
+            params[column].append(end)
+
+    def where(column, alias=''):
+        clauses = [f'{alias}{clause}' for clause in conditions[column]]
+        return 'WHERE ' + ' AND '.join(clauses) if clauses else ''
+
+    db_cursor.execute(f"DELETE FROM daily_stats {where('stat_date')}", params['stat_date'])
+    upsert = _upsert_clause()
+    # SQLite needs a WHERE before ON CONFLICT in INSERT ... SELECT to parse it
+    db_cursor.execute(f'''
+        INSERT INTO daily_stats (stat_date, test_category, ref_by, {', '.join(COUNTERS)})
+        SELECT DATE(t.test_date), t.test_category, COALESCE(p.ref_by, ''),
+               COUNT(*), SUM(COALESCE(t.price, 0)), 0, 0
+        FROM tests t
+        JOIN patients p ON p.id = t.patient_id
+        {where('test_date', 't.') or 'WHERE 1 = 1'}
+        GROUP BY DATE(t.test_date), t.test_category, COALESCE(p.ref_by, '')
+        {upsert}
+    ''', params['test_date'])
+    db_cursor.execute(f'''
+        INSERT INTO daily_stats (stat_date, test_category, ref_by, {', '.join(COUNTERS)})
+        SELECT DATE(created_at), '', COALESCE(ref_by, ''), 0, 0, COUNT(*), 0
+        FROM patients
+        {where('created_at') or 'WHERE 1 = 1'}
+        GROUP BY DATE(created_at), COALESCE(ref_by, '')
+        {upsert}
+    ''', params['created_at'])
+    db_cursor.execute(f'''
+        INSERT INTO daily_stats (stat_date, test_category, ref_by, {', '.join(COUNTERS)})
+        SELECT DATE(r.generated_at), '', COALESCE(p.ref_by, ''), 0, 0, 0, COUNT(*)
+        FROM reports r
+        JOIN patients p ON p.id = r.patient_id
+        {where('generated_at', 'r.') or 'WHERE 1 = 1'}
+        GROUP BY DATE(r.generated_at), COALESCE(p.ref_by, '')
+        {upsert}
+    ''', params['generated_at'])
+    db_cursor.execute('SELECT COUNT(*) FROM daily_stats')
+    return db_cursor.fetchone()[0]
@@ -0,0 +1,90 @@
+import os
+import threading
+
+from database import get_db_connection, is_sqlite
+
+# Counters handed out by the database instead of derived from the highest
+# existing row. Reserving a value is one UPDATE using the LAST_INSERT_ID(expr)
+# idiom: the row lock makes concurrent reservations serialize, and the new
+# value comes back in the OK packet (cursor.lastrowid), so no SELECT follows.
+# SQLite gets the same from UPDATE ... RETURNING.
+#
+# With a block size above 1 each process reserves a range in its own
+# autocommitted statement and hands codes out of it locally, so most
+# registrations touch no shared row at all. Codes left in a block when the
+# process exits are skipped, so sequences may have gaps.
+
+SEQUENCES_DDL = '''
+    CREATE TABLE IF NOT EXISTS id_sequences (
+        name VARCHAR(64) PRIMARY KEY,
+        next_value BIGINT NOT NULL
+    )
+'''
+
+PATIENT_CODE_PREFIX = 'PAT'
+PATIENT_CODE_DIGITS = 6
+
+
+def reserve(db_cursor, name, count=1):
+    # Reserves `count` values and returns the first; part of the caller's
+    # transaction
+    if is_sqlite():
+        # The write lock taken by the UPDATE serializes reservations, and
+        # RETURNING hands back the new value
+        db_cursor.execute(
+            'UPDATE id_sequences SET next_value = next_value + %s WHERE name = %s RETURNING next_value',
+            (count, name)
+        )
+        row = db_cursor.fetchone()
+        next_value = row[0] if row else None
+    else:
+        db_cursor.execute(
+            'UPDATE id_sequences SET next_value = LAST_INSERT_ID(next_value + %s) WHERE name = %s',
+            (count, name)
+        )
+        next_value = db_cursor.lastrowid if db_cursor.rowcount == 1 else None
+    if next_value is None:
+        raise LookupError(f'Sequence {name!r} does not exist; run the migrations')
+    return next_value - count
+
+
+def peek(db_cursor, name):
+    db_cursor.execute('SELECT next_value FROM id_sequences WHERE name = %s', (name,))
+    row = db_cursor.fetchone()
+    return row[0] if row else None
+
+
+class SequenceAllocator:
+    def __init__(self, name, block_size=1):
+        self.name = name
+        self.block_size = max(1, block_size)
+        self._lock = threading.Lock()
+        self._next = 0
+        self._end = 0
+
+    def allocate(self, db_cursor):
+        if self.block_size == 1:
+            # Reserved inside the caller's transaction, so a rolled back
+            # insert also gives its value back
+            return reserve(db_cursor, self.name)
+        with self._lock:
+            if self._next >= self._end:
+                # The block must survive the caller's rollback, so it is
+                # reserved on a connection of its own
+                conn = get_db_connection()
+                try:
+                    start = reserve(conn.cursor(), self.name, self.block_size)
+                    conn.commit()
+                finally:
+                    conn.close()
+                self._next, self._end = start, start + self.block_size
+            value = self._next
+            self._next += 1
+            return value
+
+
+def format_patient_code(value):
+    return f'{PATIENT_CODE_PREFIX}{value:0{PATIENT_CODE_DIGITS}d}'
+
+
+patient_codes = SequenceAllocator('patient_code', int(os.getenv('PATIENT_CODE_BLOCK_SIZE', '1')))
@@ -0,0 +1,178 @@
+import atexit
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+from datetime import date, datetime
+from functools import lru_cache
+
+# SQLite driver for single-box installs, tests and benchmarks. The
+# application's SQL is written for MySQL; SQLiteCursor rewrites the handful of
+# MySQL-only constructs it uses on the way through (placeholders,
+# AUTO_INCREMENT, NOW() arithmetic, IF, INSERT IGNORE, ...) and the functions
+# SQLite lacks (DATE_FORMAT, REGEXP) are registered on every connection.
+# Statements that cannot be rewritten mechanically (upserts, GET_LOCK,
+# information_schema, EXPLAIN) branch on database.is_sqlite() where they are
+# issued.
+#
+# Connections run in WAL mode so readers never block the single writer, with
+# synchronous=NORMAL (durable across application crashes, at worst the last
+# transactions lost on power failure) and a busy timeout so concurrent
+# writers queue instead of failing.
+
+SQLITE_PATH = os.getenv('SQLITE_PATH') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'metacore.db')
+BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', '10'))
+CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', '16384'))
+MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(128 * 1024 * 1024)))
+
+MEMORY_PATH = ':memory:'
+
+_REWRITES = [
+    (re.compile(r'\b(?:BIG)?INT\s+AUTO_INCREMENT\s+PRIMARY\s+KEY', re.I), 'INTEGER PRIMARY KEY AUTOINCREMENT'),
+    (re.compile(r'\s+ON\s+UPDATE\s+CURRENT_TIMESTAMP', re.I), ''),
+    (re.compile(r'\bDEFAULT\s+CURRENT_TIMESTAMP', re.I), "DEFAULT (datetime('now', 'localtime'))"),
+    (re.compile(r'\bNOW\(\)\s*([+-])\s*INTERVAL\s+(\?|\d+)\s+SECOND\b', re.I),
+     r"datetime('now', 'localtime', '\1' || \2 || ' seconds')"),
+    (re.compile(r'\bNOW\(\)', re.I), "datetime('now', 'localtime')"),
+    (re.compile(r'\bIF\(', re.I), 'IIF('),
+    (re.compile(r'\s+FOR\s+UPDATE(?:\s+SKIP\s+LOCKED)?', re.I), ''),
+    (re.compile(r'\bINSERT\s+IGNORE\b', re.I), 'INSERT OR IGNORE'),
+    (re.compile(r'\bAS\s+UNSIGNED\b', re.I), 'AS INTEGER'),
+    (re.compile(r'\bCHAR_LENGTH\(', re.I), 'LENGTH('),
+    # MySQL escapes LIKE patterns with a backslash by default; SQLite needs
+    # to be told
+    (re.compile(r'\bLIKE\s+\?', re.I), r"LIKE ? ESCAPE '\\'"),
+]
+_PLACEHOLDER = re.compile(r'%(s|%)')
+
+
+@lru_cache(maxsize=1024)
+def translate(sql, parameterized=True):
+    if parameterized:
+        sql = _PLACEHOLDER.sub(lambda match: '?' if match.group(1) == 's' else '%', sql)
+    for pattern, replacement in _REWRITES:
+        sql = pattern.sub(replacement, sql)
+    return sql
+
+
+class SQLiteCursor(sqlite3.Cursor):
+    def execute(self, sql, params=None):
+        if params is None:
+            return super().execute(translate(sql, False))
+        return super().execute(translate(sql), params)
+
+    def executemany(self, sql, seq_of_params):
+        return super().executemany(translate(sql), seq_of_params)
+
+
+def _dict_row(cursor, row):
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+class SQLiteConnection(sqlite3.Connection):
+    # Accepts the mysql.connector cursor options the application passes
+
+    def cursor(self, dictionary=False, buffered=None):
+        cursor = super().cursor(SQLiteCursor)
+        if dictionary:
+            cursor.row_factory = _dict_row
+        return cursor
+
+    def ping(self, reconnect=False):
+        # Nothing to lose between requests: the database is a local file
+        return True
+
+
+# MySQL DATE_FORMAT specifiers the application uses, as strftime ones
+_DATE_FORMAT_CODES = {
+    'Y': '%Y', 'y': '%y', 'm': '%m', 'c': '%m', 'd': '%d', 'e': '%d', 'H': '%H', 'h': '%I',
+    'i': '%M', 's': '%S', 'S': '%S', 'p': '%p', 'M': '%B', 'b': '%b', 'W': '%A', 'a': '%a', 'j': '%j', '%': '%%',
+}
+
+
+def _date_format(value, mysql_format):
+    if value is None or mysql_format is None:
+        return None
+    try:
+        moment = datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+    strftime_format = re.sub(r'%(.)', lambda match: _DATE_FORMAT_CODES.get(match.group(1), match.group(1)),
+                             mysql_format)
+    return moment.strftime(strftime_format)
+
+
+@lru_cache(maxsize=64)
+def _compiled(pattern):
+    return re.compile(pattern)
+
+
+def _regexp(pattern, value):
+    if pattern is None or value is None:
+        return None
+    return _compiled(pattern).search(str(value)) is not None
+
+
+def _convert_datetime(raw):
+    text = raw.decode()
+    try:
+        return datetime.fromisoformat(text)
+    except ValueError:
+        return text
+
+
+def _convert_date(raw):
+    text = raw.decode()
+    try:
+        return date.fromisoformat(text[:10])
+    except ValueError:
+        return text
+
+
+# Store datetimes the way MySQL DATETIME does (no fraction, local time) so
+# text comparisons against datetime('now', 'localtime') line up
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(' ', 'seconds'))
+sqlite3.register_adapter(date, lambda value: value.isoformat())
+sqlite3.register_converter('TIMESTAMP', _convert_datetime)
+sqlite3.register_converter('DATETIME', _convert_datetime)
+sqlite3.register_converter('DATE', _convert_date)
+
+
+_memory_dir = None
+
+
+def resolve_path(path):
+    # ':memory:' gets a throwaway file on RAM-backed storage rather than a true
+    # in-memory database, so the pool's connections share it and WAL
+    # concurrency works exactly as it does on disk
+    global _memory_dir
+    if path != MEMORY_PATH:
+        return path
+    if _memory_dir is None:
+        _memory_dir = tempfile.mkdtemp(prefix='metacore-', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        atexit.register(shutil.rmtree, _memory_dir, True)
+    return os.path.join(_memory_dir, 'metacore.db')
+
+
+def connect(path=None):
+    path = path or SQLITE_PATH
+    in_memory = path == MEMORY_PATH
+    conn = sqlite3.connect(
+        resolve_path(path),
+        timeout=BUSY_TIMEOUT,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        # The pool hands a connection to one thread at a time
+        check_same_thread=False,
+        factory=SQLiteConnection
+    )
+    conn.create_function('DATE_FORMAT', 2, _date_format, deterministic=True)
+    conn.create_function('REGEXP', 2, _regexp, deterministic=True)
+    conn.execute('PRAGMA journal_mode = WAL')
+    # A throwaway database need not survive a crash at all
+    conn.execute(f"PRAGMA synchronous = {'OFF' if in_memory else 'NORMAL'}")
+    conn.execute('PRAGMA foreign_keys = ON')
+    conn.execute(f'PRAGMA cache_size = {-CACHE_SIZE_KB}')
+    conn.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    return conn
@@ -0,0 +1,225 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+
+# The whole API against a throwaway SQLite database, so the MySQL dialect the
+# application writes goes through sqlite_backend's translation on every call.
+# Configuration is read at import time, hence before `app` is imported.
+_scratch = tempfile.mkdtemp(prefix='lab-api-tests-')
+os.environ.update({
+    'DB_BACKEND': 'sqlite',
+    'SQLITE_PATH': ':memory:',
+    'JWT_SECRET_KEY': 'test-secret',
+    'ADMIN_EMAIL': 'admin@example.com',
+    'ADMIN_PASSWORD': 'admin-password',
+    'BCRYPT_ROUNDS': '4',
+    'AUTO_MIGRATE': '1',
+    'JOB_EMBEDDED_WORKERS': '0',
+    'JOB_SPOOL_DIR': os.path.join(_scratch, 'jobs'),
+    'REPORT_CACHE_DIR': os.path.join(_scratch, 'reports'),
+})
+
+import app as api  # noqa: E402
+import jobs  # noqa: E402
+import migrations  # noqa: E402
+from sqlite_backend import translate  # noqa: E402
+
+
+@pytest.fixture(scope='module', autouse=True)
+def scratch_dir():
+    yield _scratch
+    shutil.rmtree(_scratch, ignore_errors=True)
+
+
+@pytest.fixture(scope='module')
+def client():
+    return api.app.test_client()
+
+
+@pytest.fixture(scope='module')
+def headers(client):
+    response = client.post('/api/login', json={'email': 'admin@example.com', 'password': 'admin-password'})
+    assert response.status_code == 200
+    return {'Authorization': f"Bearer {response.json['token']}"}
+
+
+@pytest.fixture(scope='module')
+def patient(client, headers):
+    response = client.post('/api/tests', headers=headers, json={
+        'name': 'Hemoglobin', 'category': 'Hematology', 'subcategory': 'CBC',
+        'price': 100, 'referenceRange': 'M: 13-17; F: 12-15', 'unit': 'g/dL'
+    })
+    assert response.status_code == 201
+    response = client.post('/api/patients', headers=headers, json={
+        'fullName': 'Jane Doe', 'age': 30, 'gender': 'Female',
+        'contactNumber': '+91 98765 43210', 'email': 'jane@example.com', 'address': 'Street 1'
+    })
+    assert response.status_code == 201
+    return response.json
+
+
+def add_result(client, headers, patient_id, value):
+    return client.post('/api/test-results', headers=headers, json={
+        'patientId': patient_id, 'category': 'Hematology', 'subcategory': 'CBC',
+        'tests': [{'testName': 'Hemoglobin', 'value': value}]
+    })
+
+
+@pytest.mark.parametrize('mysql, sqlite', [
+    ('SELECT IF(a, 1, 0) FROM t', 'SELECT IIF(a, 1, 0) FROM t'),
+    ('SELECT id FROM jobs WHERE id = %s FOR UPDATE SKIP LOCKED', 'SELECT id FROM jobs WHERE id = ?'),
+    ('SELECT id FROM patients WHERE id = %s FOR UPDATE', 'SELECT id FROM patients WHERE id = ?'),
+    ('INSERT IGNORE INTO t (a) VALUES (%s)', 'INSERT OR IGNORE INTO t (a) VALUES (?)'),
+    ("SELECT DATE_FORMAT(d, '%%Y-%%m') FROM t", "SELECT DATE_FORMAT(d, '%Y-%m') FROM t"),
+    ('SELECT a FROM t WHERE b LIKE %s', "SELECT a FROM t WHERE b LIKE ? ESCAPE '\\'"),
+])
+def test_translate(mysql, sqlite):
+    assert translate(mysql) == sqlite
+
+
+def test_login_rejects_bad_password(client):
+    response = client.post('/api/login', json={'email': 'admin@example.com', 'password': 'wrong'})
+    assert response.status_code == 401
+
+
+def test_migrations_are_applied_once():
+    conn = api.get_db_connection()
+    try:
+        assert migrations.migrate(conn) == []
+    finally:
+        conn.close()
+
+
+def test_check_indexes():
+    result = api.app.test_cli_runner().invoke(args=['check-indexes'])
+    assert result.exit_code == 0, result.output
+
+
+def test_patients(client, headers, patient):
+    assert patient['patientCode'].startswith('PAT')
+    patients = client.get('/api/patients', headers=headers).json
+    assert [row['fullName'] for row in patients] == ['Jane Doe']
+
+    # '_' is a literal in a name filter, not a LIKE wildcard
+    response = client.get('/api/patients?name=Ja_&limit=5', headers=headers)
+    assert response.json['patients'] == []
+    response = client.get('/api/patients?name=Ja&limit=5', headers=headers)
+    assert [row['id'] for row in response.json['patients']] == [patient['id']]
+
+    response = client.get('/api/patients/search?q=jane', headers=headers)
+    assert [row['id'] for row in response.json['results']] == [patient['id']]
+
+
+@pytest.mark.parametrize('query', ['+91 98765', '919876', '98765', '098765 432'])
+def test_phone_search(client, headers, patient, query):
+    # Stored as '+91 98765 43210'
+    response = client.get('/api/patients/search', headers=headers, query_string={'q': query})
+    assert [(row['id'], row['match']) for row in response.json['results']] == [(patient['id'], 'phone')]
+
+
+def test_patient_list_revalidates(client, headers, patient):
+    response = client.get('/api/patients', headers=headers)
+    etag = response.headers['ETag']
+    assert client.get('/api/patients', headers={**headers, 'If-None-Match': etag}).status_code == 304
+
+
+def test_results_and_report(client, headers, patient):
+    assert add_result(client, headers, patient['id'], '12.5').status_code == 201
+    report = client.get(f"/api/reports/{patient['id']}", headers=headers).json
+    assert [(test['testName'], test['status']) for test in report['tests']] == [('Hemoglobin', 'Normal')]
+
+    response = client.get(f"/api/reports/{patient['id']}/pdf", headers=headers)
+    assert response.status_code == 200
+    assert response.mimetype == 'application/pdf'
+    assert response.data.startswith(b'%PDF')
+
+
+def test_update_patient_reclassifies(client, headers, patient):
+    # Takes the patient row with SELECT ... FOR UPDATE
+    response = client.put(f"/api/patients/{patient['id']}", headers=headers, json={
+        'fullName': 'Jane Doe', 'age': 30, 'gender': 'Male', 'patientCode': patient['patientCode'],
+        'contactNumber': '+91 98765 43210', 'email': 'jane@example.com', 'address': 'Street 1'
+    })
+    assert response.status_code == 200
+    # 12.5 is normal for a woman but low for a man
+    report = client.get(f"/api/reports/{patient['id']}", headers=headers).json
+    assert [test['status'] for test in report['tests']] == ['Low']
+
+
+def test_analytics(client, headers, patient):
+    summary = client.get('/api/analytics/summary', headers=headers).json
+    assert summary['totalPatients'] == 1
+    assert summary['testsInWindow'] == summary['totalTests']
+
+    # Buckets come from DATE_FORMAT, registered as a SQLite function
+    volume = client.get('/api/analytics/tests/volume?interval=month', headers=headers).json
+    assert sum(bucket['count'] for bucket in volume['series']) == summary['testsInWindow']
+    assert all(len(bucket['period']) == len('2026-01') for bucket in volume['series'])
+
+    for path in ('/api/analytics/tests/by-category', '/api/analytics/patients/demographics',
+                 '/api/analytics/ref-doctors', '/api/analytics/recent-activity'):
+        assert client.get(path, headers=headers).status_code == 200, path
+
+
+def test_ref_doctors(client, headers):
+    etag = client.get('/api/ref-doctors', headers=headers).headers['ETag']
+    response = client.post('/api/ref-doctors', headers=headers, json={'name': 'Dr Rao'})
+    assert response.status_code == 201
+    # The table version is bumped once the insert has committed
+    response = client.get('/api/ref-doctors', headers={**headers, 'If-None-Match': etag})
+    assert response.status_code == 200
+    doctors = response.json
+    doctor = next(row for row in doctors if row['name'] == 'Dr Rao')
+    assert client.delete(f"/api/ref-doctors/{doctor['id']}", headers=headers).status_code == 200
+
+
+def test_jobs(client, headers, patient):
+    response = client.post('/api/jobs', headers=headers, json={'kind': 'backfill-test-status'})
+    assert response.status_code == 202
+    job_id = response.json['jobId']
+
+    # Claimed with FOR UPDATE SKIP LOCKED
+    worker = jobs.Worker(api.app, concurrency=1)
+    job = worker._claim()
+    assert job[0] == job_id
+    worker._execute(*job)
+    assert client.get(f'/api/jobs/{job_id}', headers=headers).json['status'] == jobs.SUCCEEDED
+
+    response = client.post(f'/api/jobs/{job_id}/retry', headers=headers)
+    assert response.status_code == 409
+
+
+def test_stale_job_is_requeued(client, headers):
+    job_id = client.post('/api/jobs', headers=headers, json={'kind': 'backfill-test-status'}).json['jobId']
+    worker = jobs.Worker(api.app, concurrency=1)
+    assert worker._claim()[0] == job_id
+
+    conn = api.get_db_connection()
+    try:
+        db_cursor = conn.cursor()
+        db_cursor.execute("UPDATE jobs SET heartbeat_at = '2000-01-01 00:00:00' WHERE id = %s", (job_id,))
+        conn.commit()
+    finally:
+        conn.close()
+    # The stale-job sweep picks the new status with IF(...)
+    jobs.Worker(api.app, concurrency=1)._heartbeat()
+    job = client.get(f'/api/jobs/{job_id}', headers=headers).json
+    assert (job['status'], job['error']) == (jobs.QUEUED, 'Worker stopped responding')
+
+
+def test_get_endpoints_respond(client, headers, patient):
+    for rule in api.app.url_map.iter_rules():
+        if 'GET' not in rule.methods or '<' in rule.rule or not rule.rule.startswith('/api'):
+            continue
+        response = client.get(rule.rule, headers=headers)
+        assert response.status_code < 500, (rule.rule, response.get_data(as_text=True))
+
+
+def test_delete_result(client, headers, patient):
+    report = client.get(f"/api/reports/{patient['id']}", headers=headers).json
+    test_id = report['tests'][0]['id']
+    assert client.delete(f'/api/test-results/{test_id}', headers=headers).status_code == 200
+    report = client.get(f"/api/reports/{patient['id']}", headers=headers).json
+    assert test_id not in [test['id'] for test in report['tests']]
@@ -0,0 +1,107 @@
+import pytest
+
+from reference_ranges import (
+    ABNORMAL, HIGH, LOW, NORMAL, UNCLASSIFIED,
+    classify, classify_many, compile_range, evaluate_result
+)
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('1.0', NORMAL),
+    ('1.09', NORMAL),
+    ('1.1', HIGH),
+    ('2', HIGH),
+])
+def test_strict_upper_bound(value, expected):
+    assert classify(value, '<1.1') == expected
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('0', NORMAL),
+    ('60', NORMAL),
+    ('60.5', HIGH),
+])
+def test_up_to(value, expected):
+    assert classify(value, 'Up to 60') == expected
+
+
+@pytest.mark.parametrize('reference_range', [
+    'M: 13–16; F: 11.5–14.5',
+    'Male: 13-16, Female: 11.5-14.5',
+    'M 13-16 F 11.5-14.5',
+    'Men 13 - 16 Women 11.5 - 14.5',
+])
+def test_sex_branches(reference_range):
+    assert len(compile_range(reference_range).branches) == 2
+    assert classify('12', reference_range, 'Male') == LOW
+    assert classify('12', reference_range, 'Female') == NORMAL
+    assert classify('15', reference_range, 'M') == NORMAL
+    assert classify('15', reference_range, 'F') == HIGH
+    # No branch applies to an unknown sex
+    assert classify('15', reference_range, None) == UNCLASSIFIED
+
+
+def test_inclusive_range_bounds():
+    assert classify('13', '13-16') == NORMAL
+    assert classify('16', '13-16') == NORMAL
+    assert classify('12.9', '13-16') == LOW
+    assert classify('16.1', '13-16') == HIGH
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('Negative', NORMAL),
+    ('Non-reactive', NORMAL),
+    ('Nil', NORMAL),
+    ('Not detected', NORMAL),
+    ('Absent', NORMAL),
+    ('Positive', ABNORMAL),
+    ('Reactive', ABNORMAL),
+    ('Present', ABNORMAL),
+    ('Detected', ABNORMAL),
+])
+def test_qualitative_synonyms(value, expected):
+    assert classify(value, 'Negative') == expected
+
+
+def test_age_branches():
+    reference_range = 'Adult: 10-20, Child: 5-10'
+    assert classify('8', reference_range, age=30) == LOW
+    assert classify('8', reference_range, age=8) == NORMAL
+    assert classify('15', reference_range, age=8) == HIGH
+
+
+def test_bracketed_age_qualifier():
+    reference_range = '0.5-1.5 (Age >60: 0.7-2)'
+    assert classify('1.8', reference_range, age=30) == HIGH
+    assert classify('1.8', reference_range, age=70) == NORMAL
+    assert classify('0.6', reference_range, age=70) == LOW
+
+
+def test_qualitative_with_numeric_cutoff():
+    reference_range = 'Negative (<5)'
+    assert classify('Negative', reference_range) == NORMAL
+    assert classify('Positive', reference_range) == ABNORMAL
+    assert classify('3', reference_range) == NORMAL
+    assert classify('7', reference_range) == HIGH
+
+
+def test_bracketed_remark_is_ignored():
+    assert classify('17', '13-16 (g/dL)') == HIGH
+
+
+def test_unclassifiable_values():
+    assert classify('see note', '10-20') == UNCLASSIFIED
+    assert classify('', '10-20') is None
+    # Free text compiles to nothing, so gives no status at all
+    assert classify('12', 'See comment') is None
+
+
+def test_evaluate_result_parses_value():
+    assert evaluate_result('1,250', '1,000-4,000') == (1250.0, NORMAL)
+    assert evaluate_result('Positive', 'Negative') == (None, ABNORMAL)
+
+
+def test_classify_many():
+    rows = [('12', 'M: 13-16; F: 11.5-14.5'), ('1.1', '<1.1'), ('Nil', 'Negative')]
+    assert classify_many(rows, 'Female', 40) == [NORMAL, HIGH, NORMAL]
+    assert classify_many(rows, 'Male', 40) == [LOW, HIGH, NORMAL]
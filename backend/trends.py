@@ -0,0 +1,118 @@
+from reference_ranges import ABNORMAL_STATUSES, NORMAL, compile_range, parse_numeric_value
+
+# Per-patient result trends. Each analyte becomes a time series of its numeric
+# results, flagged against the previous result (delta, status changes), then
+# thinned to at most max_points with Largest-Triangle-Three-Buckets, which
+# keeps the visual shape of the line - peaks and troughs survive, flat
+# stretches are dropped. Flags are computed on the full series first, so a
+# point's delta is always against the result recorded just before it.
+
+DEFAULT_MAX_POINTS = 200
+MAX_POINTS = 2000
+MAX_TESTS = 10
+
+# SELECT list for trend_series(), in the order it unpacks rows
+TREND_COLUMNS = 'id, test_name, test_date, test_value, numeric_value, result_status, unit, normal_range'
+
+
+def _timestamp(value):
+    return value.strftime('%Y-%m-%d %H:%M:%S') if hasattr(value, 'strftime') else str(value)
+
+
+def _seconds(value):
+    # x coordinate for downsampling; text dates only occur on rows the
+    # driver could not convert, and they still sort correctly
+    return value.timestamp() if hasattr(value, 'timestamp') else 0.0
+
+
+def downsample(points, max_points, x, y):
+    # Largest-Triangle-Three-Buckets over points sorted by x(point); always
+    # keeps the first and last point
+    if len(points) <= max_points:
+        return points
+    if max_points < 3:
+        return [points[0], points[-1]][:max_points]
+    sampled = [points[0]]
+    bucket_size = (len(points) - 2) / (max_points - 2)
+    previous = points[0]
+    for bucket in range(max_points - 2):
+        start = int(bucket * bucket_size) + 1
+        end = int((bucket + 1) * bucket_size) + 1
+        # Average of the next bucket (or the last point) as the third corner
+        next_start, next_end = end, min(int((bucket + 2) * bucket_size) + 1, len(points))
+        following = points[next_start:next_end] or points[-1:]
+        average_x = sum(x(point) for point in following) / len(following)
+        average_y = sum(y(point) for point in following) / len(following)
+        previous_x, previous_y = x(previous), y(previous)
+        best, best_area = None, -1.0
+        for point in points[start:end]:
+            area = abs(
+                (previous_x - average_x) * (y(point) - previous_y)
+                - (previous_x - x(point)) * (average_y - previous_y)
+            )
+            if area > best_area:
+                best, best_area = point, area
+        sampled.append(best)
+        previous = best
+    sampled.append(points[-1])
+    return sampled
+
+
+def trend_series(rows, test_names, gender, age, max_points=DEFAULT_MAX_POINTS):
+    # rows: TREND_COLUMNS ordered by test_name, test_date, id. Returns one
+    # series per requested test, in the order requested.
+    # MySQL matches names case-insensitively, so group the same way
+    grouped = {name.casefold(): [] for name in test_names}
+    for row in rows:
+        grouped.setdefault(row[1].casefold(), []).append(row)
+
+    series = []
+    for name in test_names:
+        points = []
+        non_numeric = 0
+        previous = None
+        for test_id, _, test_date, test_value, numeric_value, result_status, unit, normal_range in grouped[name.casefold()]:
+            # Rows written before values were parsed and classified on insert
+            if numeric_value is None:
+                numeric_value = parse_numeric_value(test_value)
+            if numeric_value is None:
+                non_numeric += 1
+                continue
+            status = result_status or compile_range(normal_range).classify(test_value, gender, age) or NORMAL
+            point = {
+                'id': test_id,
+                'date': _timestamp(test_date),
+                'value': float(numeric_value),
+                'testValue': test_value,
+                'unit': unit,
+                'normalRange': normal_range,
+                'status': status,
+                'abnormal': status in ABNORMAL_STATUSES,
+                'delta': None,
+                'deltaPercent': None,
+                'statusChanged': False,
+                '_x': _seconds(test_date)
+            }
+            if previous is not None:
+                point['delta'] = round(point['value'] - previous['value'], 6)
+                if previous['value']:
+                    point['deltaPercent'] = round(point['delta'] / abs(previous['value']) * 100, 2)
+                point['statusChanged'] = status != previous['status']
+            points.append(point)
+            previous = point
+
+        sampled = downsample(points, max_points, lambda point: point['_x'], lambda point: point['value'])
+        for point in points:
+            del point['_x']
+        latest = points[-1] if points else None
+        series.append({
+            'testName': name,
+            'unit': latest['unit'] if latest else None,
+            'normalRange': latest['normalRange'] if latest else None,
+            'count': len(points),
+            'nonNumeric': non_numeric,
+            'downsampled': len(sampled) < len(points),
+            'latest': latest,
+            'points': sampled
+        })
+    return series
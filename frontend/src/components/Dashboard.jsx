@@ -1,5 +1,5 @@
 import React, { useState, useEffect } from 'react';
-import { patientService, testService, reportService } from '../services/api';
+import { analyticsService } from '../services/api';
 
 const Dashboard = () => {
     const [stats, setStats] = useState({
@@ -43,66 +43,53 @@ const Dashboard = () => {
         const fetchStats = async () => {
             try {
                 setError(null);
-                const [patientsRes, testsRes, reportsCountRes] = await Promise.all([
-                    patientService.getAll(),
-                    testService.getAll(),
-                    reportService.getCount()
+                const [summaryRes, activityRes] = await Promise.all([
+                    analyticsService.getSummary(),
+                    analyticsService.getRecentActivity({ limit: 5 })
                 ]);
 
-                if (!patientsRes.success || !testsRes.success || !reportsCountRes.success) {
+                if (!summaryRes.success || !activityRes.success) {
                     throw new Error('Failed to fetch dashboard data');
                 }
 
-                const patients = patientsRes.data;
-                const tests = testsRes.data;
-                const reportsCount = reportsCountRes.data;
-
-                // Calculate tests done today
-                const today = new Date().toLocaleDateString();
-                const testsToday = Array.isArray(tests) ? tests.filter(test => 
-                    new Date(test.createdAt).toLocaleDateString() === today
-                ).length : 0;
+                const summary = summaryRes.data;
+                const { patients, tests } = activityRes.data;
 
                 setStats({
-                    totalPatients: Array.isArray(patients) ? patients.length : 0,
-                    totalTests: Array.isArray(tests) ? tests.length : 0,
-                    reportsGenerated: reportsCount?.count || 0,
-                    testsToday
+                    totalPatients: summary.totalPatients,
+                    totalTests: summary.totalTests,
+                    reportsGenerated: summary.reportsGenerated,
+                    testsToday: summary.testsToday
                 });
 
                 // Process recent activity
                 const activities = [];
                 
                 // Add patient registrations
-                if (Array.isArray(patients)) {
-                    patients.slice(-5).forEach(patient => {
-                        if (patient.createdAt) {
-                            activities.push({
-                                type: 'patient',
-                                title: 'New Patient Registration',
-                                description: `${patient.fullName} registered as a new patient`,
-                                time: new Date(patient.createdAt).toLocaleString(),
-                                icon: <span className="material-icons text-blue-500">person_add</span>
-                            });
-                        }
-                    });
-                }
+                patients.forEach(patient => {
+                    if (patient.createdAt) {
+                        activities.push({
+                            type: 'patient',
+                            title: 'New Patient Registration',
+                            description: `${patient.fullName} registered as a new patient`,
+                            time: new Date(patient.createdAt).toLocaleString(),
+                            icon: <span className="material-icons text-blue-500">person_add</span>
+                        });
+                    }
+                });
 
                 // Add test completions
-                if (Array.isArray(tests)) {
-                    tests.slice(-5).forEach(test => {
-                        if (test.createdAt) {
-                            const patient = Array.isArray(patients) ? patients.find(p => p.id === test.patientId) : null;
-                            activities.push({
-                                type: 'test',
-                                title: 'Test Completed',
-                                description: `${test.testName} results are ready for ${patient ? patient.fullName : 'Unknown'}`,
-                                time: new Date(test.createdAt).toLocaleString(),
-                                icon: <span className="material-icons text-green-500">science</span>
-                            });
-                        }
-                    });
-                }
+                tests.forEach(test => {
+                    if (test.createdAt) {
+                        activities.push({
+                            type: 'test',
+                            title: 'Test Completed',
+                            description: `${test.testName} results are ready for ${test.patientName || 'Unknown'}`,
+                            time: new Date(test.createdAt).toLocaleString(),
+                            icon: <span className="material-icons text-green-500">science</span>
+                        });
+                    }
+                });
 
                 // Sort activities by date and take the most recent 5
                 activities.sort((a, b) => new Date(b.time) - new Date(a.time));
@@ -30,28 +30,10 @@ const AddEditPatient = ({ onPatientAdded, onCancel, editPatient }) => {
         refBy: editPatient.refBy || '',
         patientCode: editPatient.patientCode || ''
       });
-    } else {
-      fetchLatestPatientCode();
     }
     fetchRefDoctors();
   }, [editPatient]);
 
-  const fetchLatestPatientCode = async () => {
-    try {
-      const response = await patientService.getLatestCode();
-      if (response.success) {
-        setFormData(prev => ({ ...prev, patientCode: response.data.code || '' }));
-      } else {
-        setError('Failed to fetch latest patient code');
-        setFormData(prev => ({ ...prev, patientCode: '' }));
-      }
-    } catch (e) {
-      // console.error('Failed to fetch latest patient code:', e);
-      setError('Failed to fetch latest patient code');
-      setFormData(prev => ({ ...prev, patientCode: '' }));
-    }
-  };
-
   const fetchRefDoctors = async () => {
     try {
       const response = await doctorService.getAll();
@@ -100,11 +82,12 @@ const AddEditPatient = ({ onPatientAdded, onCancel, editPatient }) => {
         : await patientService.create(formData);
 
       if (response.success) {
-        setSuccess(editPatient ? 'Patient updated successfully!' : 'Patient added successfully!');
+        // New patients get their code from the server when saved
+        setSuccess(editPatient
+          ? 'Patient updated successfully!'
+          : `Patient added successfully! Patient code: ${response.data.patientCode}`);
         if (onPatientAdded) onPatientAdded();
         if (!editPatient) {
-          // Fetch new patient code after successful addition
-          fetchLatestPatientCode();
           setFormData({
             fullName: '',
             age: '',
@@ -240,6 +223,7 @@ const AddEditPatient = ({ onPatientAdded, onCancel, editPatient }) => {
               type="text"
               name="patientCode"
               value={formData.patientCode}
+              placeholder="Assigned when saved"
               readOnly
               className="w-full px-3 py-2 border border-gray-300 rounded-md bg-gray-50"
             />
@@ -278,6 +262,8 @@ const AddEditPatient = ({ onPatientAdded, onCancel, editPatient }) => {
   );
 };
 
+const MIN_SEARCH_LENGTH = 2;
+
 const PatientList = ({ refreshFlag }) => {
   const [patients, setPatients] = useState([]);
   const [editingPatient, setEditingPatient] = useState(null);
@@ -285,6 +271,7 @@ const PatientList = ({ refreshFlag }) => {
   const [loading, setLoading] = useState(true);
   const navigate = useNavigate();
   const [search, setSearch] = useState('');
+  const [searchResults, setSearchResults] = useState(null);
 
   useEffect(() => {
     fetchPatients();
@@ -307,12 +294,28 @@ const PatientList = ({ refreshFlag }) => {
     }
   };
 
-  // Filter patients by search
-  const filteredPatients = patients.filter(patient => 
-    patient.fullName.toLowerCase().includes(search.toLowerCase()) ||
-    patient.patientCode.toLowerCase().includes(search.toLowerCase()) ||
-    patient.contactNumber.includes(search)
-  );
+  // Search runs on the server once the query is long enough; until then the
+  // full list is shown. Re-runs after the list is refetched (edit, delete).
+  useEffect(() => {
+    const query = search.trim();
+    if (query.length < MIN_SEARCH_LENGTH) {
+      setSearchResults(null);
+      return;
+    }
+    let cancelled = false;
+    const timer = setTimeout(async () => {
+      const response = await patientService.search(query, 100);
+      if (!cancelled) {
+        setSearchResults(response.success ? response.data.results : []);
+      }
+    }, 250);
+    return () => {
+      cancelled = true;
+      clearTimeout(timer);
+    };
+  }, [search, patients]);
+
+  const filteredPatients = searchResults ?? patients;
 
   const handleEdit = (p) => {
     setEditingPatient(p.id);
@@ -119,6 +119,11 @@ const Security = () => {
         throw new Error(data.error || 'Failed to update password');
       }
 
+      // Older sessions are revoked; keep this one signed in with the new token
+      if (data.token) {
+        localStorage.setItem('token', data.token);
+      }
+
       setSuccessMessage('Password updated successfully');
       setPasswordForm({
         currentPassword: '',
@@ -160,6 +165,10 @@ const Security = () => {
         throw new Error(data.error || 'Failed to update email');
       }
 
+      if (data.token) {
+        localStorage.setItem('token', data.token);
+      }
+
       // Update auth context with new email
       const auth = JSON.parse(localStorage.getItem('auth'));
       auth.email = emailForm.newEmail;
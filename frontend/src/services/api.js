@@ -86,6 +86,26 @@ export const patientService = {
       return { success: false, error: error.response?.data?.error || 'Failed to fetch patients' };
     }
   },
+  // Server-side paged search: params may include limit, cursor, name, patientCode,
+  // contactNumber, refBy, createdFrom and createdTo. Resolves to { patients, nextCursor }.
+  list: async (params = {}) => {
+    try {
+      const response = await api.get('/patients', { params: { limit: 50, ...params } });
+      return { success: true, data: response.data };
+    } catch (error) {
+      return { success: false, error: error.response?.data?.error || 'Failed to fetch patients' };
+    }
+  },
+  // Ranked search over name, address, phone digits and patient code (at least
+  // two characters). Resolves to { query, results }.
+  search: async (q, limit = 20) => {
+    try {
+      const response = await api.get('/patients/search', { params: { q, limit } });
+      return { success: true, data: response.data };
+    } catch (error) {
+      return { success: false, error: error.response?.data?.error || 'Failed to search patients' };
+    }
+  },
   getById: async (id) => {
     try {
       const response = await api.get(`/patients/${id}`);
@@ -161,6 +181,28 @@ export const testService = {
       return { success: false, error: error.response?.data?.error || 'Failed to add test results' };
     }
   },
+  // panels: [{ patientId, category, subcategory, tests, testDate, notes }, ...]
+  addResultsBatch: async (panels) => {
+    try {
+      const response = await api.post('/test-results', { panels });
+      return { success: true, data: response.data };
+    } catch (error) {
+      return { success: false, error: error.response?.data?.error || 'Failed to add test results', data: error.response?.data };
+    }
+  },
+  importResults: async (file, format) => {
+    try {
+      const form = new FormData();
+      form.append('file', file);
+      if (format) form.append('format', format);
+      const response = await api.post('/test-results/import', form, {
+        headers: { 'Content-Type': 'multipart/form-data' }
+      });
+      return { success: true, data: response.data };
+    } catch (error) {
+      return { success: false, error: error.response?.data?.error || 'Failed to import test results', data: error.response?.data };
+    }
+  },
   update: async (id, data) => {
     try {
       const response = await api.put(`/tests/${id}`, data);
@@ -212,6 +254,25 @@ export const reportService = {
       return { success: false, error: error.response?.data?.error || 'Failed to generate report' };
     }
   },
+  // Server-rendered PDF; the backend records the report as generated
+  downloadPdf: async (patientId) => {
+    try {
+      const response = await api.get(`/reports/${patientId}/pdf`, { responseType: 'blob' });
+      return { success: true, data: response.data };
+    } catch (error) {
+      return { success: false, error: 'Failed to download report PDF' };
+    }
+  },
+  // Many reports at once: { patientIds } or { date }; format 'zip' returns PDFs
+  generateBatch: async (selection, format = 'json') => {
+    try {
+      const response = await api.post('/reports/batch', { ...selection, format },
+        format === 'zip' ? { responseType: 'blob' } : undefined);
+      return { success: true, data: response.data };
+    } catch (error) {
+      return { success: false, error: error.response?.data?.error || 'Failed to generate reports' };
+    }
+  },
   track: async (data) => {
     try {
       const response = await api.post('/reports/track', data);
@@ -238,6 +299,57 @@ export const reportService = {
   }
 };
 
+export const analyticsService = {
+  getSummary: async (params = {}) => {
+    try {
+      const response = await api.get('/analytics/summary', { params });
+      return { success: true, data: response.data };
+    } catch (error) {
+      return { success: false, error: error.response?.data?.error || 'Failed to fetch analytics summary' };
+    }
+  },
+  getTestVolume: async (params = {}) => {
+    try {
+      const response = await api.get('/analytics/tests/volume', { params });
+      return { success: true, data: response.data };
+    } catch (error) {
+      return { success: false, error: error.response?.data?.error || 'Failed to fetch test volume' };
+    }
+  },
+  getTestsByCategory: async (params = {}) => {
+    try {
+      const response = await api.get('/analytics/tests/by-category', { params });
+      return { success: true, data: response.data };
+    } catch (error) {
+      return { success: false, error: error.response?.data?.error || 'Failed to fetch category volumes' };
+    }
+  },
+  getDemographics: async (params = {}) => {
+    try {
+      const response = await api.get('/analytics/patients/demographics', { params });
+      return { success: true, data: response.data };
+    } catch (error) {
+      return { success: false, error: error.response?.data?.error || 'Failed to fetch patient demographics' };
+    }
+  },
+  getRefDoctors: async (params = {}) => {
+    try {
+      const response = await api.get('/analytics/ref-doctors', { params });
+      return { success: true, data: response.data };
+    } catch (error) {
+      return { success: false, error: error.response?.data?.error || 'Failed to fetch reference doctor volumes' };
+    }
+  },
+  getRecentActivity: async (params = {}) => {
+    try {
+      const response = await api.get('/analytics/recent-activity', { params });
+      return { success: true, data: response.data };
+    } catch (error) {
+      return { success: false, error: error.response?.data?.error || 'Failed to fetch recent activity' };
+    }
+  }
+};
+
 export const labService = {
   getInfo: async () => {
     try {
@@ -323,18 +435,10 @@ export const securityService = {
   changeEmail: async (data) => {
     try {
       const response = await api.post('/security/change-email', data);
-      if (response.data.message === 'Email updated successfully') {
-        // Get new token with updated email
-        const tokenResponse = await api.post('/login', {
-          email: data.newEmail,
-          password: data.currentPassword
-        });
-        
-        if (tokenResponse.data.token) {
-          // Update stored token and auth data
-          localStorage.setItem('token', tokenResponse.data.token);
-          localStorage.setItem('auth', JSON.stringify({ email: data.newEmail }));
-        }
+      if (response.data.token) {
+        // The old token is revoked; the response carries one for the new email
+        localStorage.setItem('token', response.data.token);
+        localStorage.setItem('auth', JSON.stringify({ email: data.newEmail }));
       }
       return { success: true, data: response.data };
     } catch (error) {
@@ -344,6 +448,9 @@ export const securityService = {
   changePassword: async (data) => {
     try {
       const response = await api.post('/security/change-password', data);
+      if (response.data.token) {
+        localStorage.setItem('token', response.data.token);
+      }
       return { success: true, data: response.data };
     } catch (error) {
       return { success: false, error: error.response?.data?.error || 'Failed to change password' };
@@ -351,4 +458,56 @@ export const securityService = {
   }
 };
 
+// Background jobs started by endpoints called with ?async=true
+export const jobService = {
+  list: async (params = {}) => {
+    try {
+      const response = await api.get('/jobs', { params });
+      return { success: true, data: response.data };
+    } catch (error) {
+      return { success: false, error: error.response?.data?.error || 'Failed to fetch jobs' };
+    }
+  },
+  get: async (jobId) => {
+    try {
+      const response = await api.get(`/jobs/${jobId}`);
+      return { success: true, data: response.data };
+    } catch (error) {
+      return { success: false, error: error.response?.data?.error || 'Failed to fetch job' };
+    }
+  },
+  submit: async (kind, payload = {}) => {
+    try {
+      const response = await api.post('/jobs', { kind, payload });
+      return { success: true, data: response.data };
+    } catch (error) {
+      return { success: false, error: error.response?.data?.error || 'Failed to queue job' };
+    }
+  },
+  cancel: async (jobId) => {
+    try {
+      const response = await api.post(`/jobs/${jobId}/cancel`);
+      return { success: true, data: response.data };
+    } catch (error) {
+      return { success: false, error: error.response?.data?.error || 'Failed to cancel job' };
+    }
+  },
+  retry: async (jobId) => {
+    try {
+      const response = await api.post(`/jobs/${jobId}/retry`);
+      return { success: true, data: response.data };
+    } catch (error) {
+      return { success: false, error: error.response?.data?.error || 'Failed to retry job' };
+    }
+  },
+  downloadFile: async (jobId) => {
+    try {
+      const response = await api.get(`/jobs/${jobId}/file`, { responseType: 'blob' });
+      return { success: true, data: response.data };
+    } catch (error) {
+      return { success: false, error: 'Failed to download job output' };
+    }
+  }
+};
+
 export default api; 
\ No newline at end of file